@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+#
+"""Benchmarks for mylibrary.
+
+Times compute.f() against np.sqrt() over a grid of array sizes, dtypes, memory
+layouts, thread counts (1, 2, 4, ... up to the number of CPUs available) and
+with / without a preallocated output array, compute.map() on many small arrays
+over the same thread counts, the call overhead of dostuff.hello(), and the time
+of importing mylibrary, mylibrary.compute and mylibrary.dostuff in a fresh
+interpreter.
+
+Results are written as JSON, so that two runs (e.g. before and after upgrading
+mylibrary, or a compiler) can be compared.
+
+Usage:
+    python bench_mylibrary.py run [-o results.json] [--sizes 10,1000,1000000] [--quick]
+    python bench_mylibrary.py compare old.json new.json [--threshold 0.1]
+
+"compare" exits with status 1 if any benchmark got slower by more than the threshold
+(default: 10%).
+
+This requires mylibrary to be compiled and installed first (using the top-level setup.py).
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+
+import numpy as np
+
+import mylibrary
+import mylibrary.compute as compute
+import mylibrary.dostuff as dostuff
+from mylibrary._compute_common import available_cpus
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000, 1000000, 10000000]
+DEFAULT_DTYPES = ["float32", "float64"]
+IMPORTS = ["mylibrary", "mylibrary.compute", "mylibrary.dostuff"]
+
+
+#-------------------------------------------------------------------------------
+# Timing
+#-------------------------------------------------------------------------------
+
+def best_time(func, min_time=0.05, repeat=5):
+    """Return the best time per call of func(), in seconds.
+
+func is called in a loop until the loop takes at least min_time; the best
+of repeat such loops is used.
+"""
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(1.2 * min_time / elapsed))
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - t0) / number)
+    return best
+
+
+def thread_counts():
+    """Return the thread counts to time: 1, 2, 4, ... and the number of CPUs
+available (only 1 without OpenMP)."""
+    cpus = available_cpus() if compute.HAVE_OPENMP else 1
+    counts = {cpus}
+    n = 1
+    while n < cpus:
+        counts.add(n)
+        n *= 2
+    return sorted(counts)
+
+
+def make_input(size, dtype, layout):
+    """Return an array of about size elements: contiguous, with a stride of two
+elements, or the first three columns of a 2-D array of ten ("subblock")."""
+    if layout == "contiguous":
+        return np.random.rand(size).astype(dtype)
+    if layout == "subblock":
+        return np.random.rand(max(1, size // 3), 10).astype(dtype)[:, :3]
+    return np.random.rand(2 * size).astype(dtype)[::2]
+
+
+#-------------------------------------------------------------------------------
+# Benchmarks
+#-------------------------------------------------------------------------------
+
+def bench_compute(sizes, dtypes, min_time, repeat):
+    for size in sizes:
+        for dtype in dtypes:
+            for layout in ("contiguous", "strided", "subblock"):
+                x = make_input(size, dtype, layout)
+                out = np.empty_like(x)
+                for use_out in (False, True):
+                    params = dict(size=size, dtype=dtype, layout=layout, out=use_out)
+                    kw = dict(out=out) if use_out else {}
+
+                    yield dict(params, name="numpy.sqrt",
+                               seconds=best_time(lambda: np.sqrt(x, **kw), min_time, repeat))
+                    for threads in thread_counts():
+                        yield dict(params, name="compute.f", threads=threads,
+                                   seconds=best_time(lambda: compute.f(x, num_threads=threads, **kw),
+                                                     min_time, repeat))
+                del x, out
+
+
+def bench_map(min_time, repeat, count=10000, size=100):
+    # Many small arrays: the per-array overhead, and how map() spreads the work
+    xs = [np.random.rand(size) for _ in range(count)]
+    params = dict(count=count, size=size)
+    yield dict(params, name="numpy.sqrt-list", seconds=best_time(lambda: [np.sqrt(x) for x in xs], min_time, repeat))
+    for threads in thread_counts():
+        yield dict(params, name="compute.map", threads=threads,
+                   seconds=best_time(lambda: compute.map(xs, workers=threads), min_time, repeat))
+
+
+def bench_hello(min_time, repeat):
+    # Discard the output; we are interested in the overhead of the call chain
+    with redirect_stdout(io.StringIO()) as sink:
+        def call():
+            dostuff.hello("Hello world")
+            sink.seek(0)
+            sink.truncate()
+        yield dict(name="dostuff.hello", seconds=best_time(call, min_time, repeat))
+
+
+def bench_import(repeat):
+    # Each run in a fresh interpreter; the best of repeat runs is reported,
+    # less that of an empty program. Submodules of mylibrary are loaded on
+    # first use, so "import mylibrary" alone hardly does anything.
+    def best_run(code):
+        best = float("inf")
+        for _ in range(max(repeat, 5)):
+            t0 = time.perf_counter()
+            subprocess.check_call([sys.executable, "-c", code])
+            best = min(best, time.perf_counter() - t0)
+        return best
+
+    baseline = best_run("pass")
+    for module in IMPORTS:
+        yield dict(name="import " + module, seconds=max(0.0, best_run("import " + module) - baseline))
+
+
+def key(result):
+    """Unique name of a benchmark, from its name and parameters."""
+    params = ",".join("{}={}".format(k, result[k]) for k in sorted(result) if k not in ("name", "seconds"))
+    return "{}[{}]".format(result["name"], params) if params else result["name"]
+
+
+#-------------------------------------------------------------------------------
+# Commands
+#-------------------------------------------------------------------------------
+
+def run(args):
+    sizes = [int(float(s)) for s in args.sizes.split(",")]
+    dtypes = args.dtypes.split(",")
+    min_time, repeat = (0.01, 3) if args.quick else (0.05, 5)
+
+    meta = dict(
+        mylibrary=mylibrary.__version__,
+        numpy=np.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        machine=platform.machine(),
+        cpus=os.cpu_count(),
+        num_threads=compute.get_num_threads(),
+        openmp=compute.HAVE_OPENMP,
+        simd_kernel=compute.get_simd_kernel(),
+        date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+    results = []
+    for benchmarks in (bench_compute(sizes, dtypes, min_time, repeat),
+                       bench_map(min_time, repeat),
+                       bench_hello(min_time, repeat),
+                       bench_import(repeat)):
+        for result in benchmarks:
+            results.append(result)
+            print("{:<90s} {:12.3f} us".format(key(result), result["seconds"] * 1e6), file=sys.stderr)
+
+    data = dict(meta=meta, results=results)
+    if args.output == "-":
+        json.dump(data, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=1)
+    return 0
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = {key(r): r["seconds"] for r in json.load(f)["results"]}
+    with open(args.new) as f:
+        new = {key(r): r["seconds"] for r in json.load(f)["results"]}
+
+    regressions = 0
+    for name in sorted(set(old) & set(new)):
+        ratio = new[name] / old[name] if old[name] > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = "  SLOWER"
+            regressions += 1
+        elif ratio < 1 / (1 + args.threshold):
+            flag = "  faster"
+        print("{:<90s} {:12.3f} {:12.3f} us {:7.2f}x{}".format(name, old[name] * 1e6, new[name] * 1e6, ratio, flag))
+    for name in sorted(set(old) ^ set(new)):
+        print("{:<90s} only in {}".format(name, args.old if name in old else args.new))
+
+    print("\n{} of {} benchmarks slower by more than {:.0%}".format(regressions, len(set(old) & set(new)), args.threshold))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    p = commands.add_parser("run", help="run the benchmarks")
+    p.add_argument("-o", "--output", default="bench_results.json", help="JSON output file, or - for stdout")
+    p.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                   help="comma-separated array sizes (default: %(default)s); 1e9 float64 needs 16 GB of RAM")
+    p.add_argument("--dtypes", default=",".join(DEFAULT_DTYPES), help="comma-separated dtypes (default: %(default)s)")
+    p.add_argument("--quick", action="store_true", help="shorter timing loops, less accurate")
+    p.set_defaults(func=run)
+
+    p = commands.add_parser("compare", help="compare two result files")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.1, help="relative slowdown to report (default: %(default)s)")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,9 +4,120 @@
 
 from __future__ import absolute_import
 
+import sys
+
 # Version string is automatically generated from git tags (using miniver)
+#
+# It is only determined when mylibrary.__version__ is first accessed, so that
+# importing mylibrary never needs to run git.
+#
+# Likewise, the submodules are only imported when first accessed as attributes
+# (mylibrary.compute etc.), so that e.g. a program using only dostuff never
+# imports NumPy.
+
+_submodules = ("compute", "dostuff", "expr", "subpackage")
+
+def __getattr__(name):
+    global __version__
+    if name == "__version__":
+        from ._version import get_version
+        __version__ = get_version()
+        return __version__
+    if name in _submodules:
+        import importlib
+        return importlib.import_module("." + name, __name__)  # also sets the attribute
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules) | {"__version__"})
+
+
+# Backend of mylibrary.compute
+#
+# mylibrary.compute is normally the compiled extension. Where it is missing
+# (e.g. after installing with setup-purepython.py), the import falls through
+# to the finder below, which loads the pure NumPy implementation in
+# _compute_numpy.py under the same name. The environment variable
+# MYLIBRARY_BACKEND selects a backend explicitly: "numpy" always uses the
+# fallback, "cython" never does (a missing extension is an ImportError).
+
+class _ComputeFallbackFinder(object):
+    """Meta path finder serving mylibrary.compute from _compute_numpy.py."""
+
+    @staticmethod
+    def find_spec(fullname, path=None, target=None):
+        if fullname != __name__ + ".compute":
+            return None
+        import os.path
+        from importlib.util import spec_from_file_location
+        return spec_from_file_location(fullname, os.path.join(os.path.dirname(__file__), "_compute_numpy.py"))
+
+
+def _install_compute_fallback():
+    import os
+    backend = os.environ.get("MYLIBRARY_BACKEND", "").lower()
+    if backend == "numpy":
+        sys.meta_path.insert(0, _ComputeFallbackFinder)
+    elif backend != "cython":
+        sys.meta_path.append(_ComputeFallbackFinder)
+
+_install_compute_fallback()
+del sys
+
+
+def backend():
+    """Return the backend of mylibrary.compute in use.
+
+Return value:
+    "cython" for the compiled extension, "numpy" for the pure NumPy fallback.
+"""
+    from . import compute
+    return compute.BACKEND
+
+
+# Runtime counters of the kernels (see _stats.pyx); off by default, or on if
+# the environment variable MYLIBRARY_STATS is 1.
+
+def stats(reset=False):
+    """Return the counters of calls into the kernels of mylibrary.
+
+For each of "compute.f", "compute.map", "dostuff.hello" and
+"dostuff.hello_many", a dict with:
+
+    calls       number of calls
+    elements    array elements (for dostuff: lines) processed
+    bytes_in    bytes read
+    bytes_out   bytes written (for dostuff: characters, if the output is
+                not a file descriptor)
+    seconds     time spent in the kernels (for compute: without the GIL)
+    histogram   number of calls by size: {0: calls with no elements,
+                1: with 1, 2: with 2-3, 4: with 4-7, ...}
+
+Nothing is counted unless enabled with enable_stats().
+
+Parameters:
+    reset : bool, optional
+        Reset the counters after reading them.
+"""
+    from ._stats import stats
+    return stats(reset)
+
+
+def reset_stats():
+    """Reset all counters of stats() to zero."""
+    from ._stats import reset
+    reset()
+
+
+def enable_stats(flag=True):
+    """Turn the counters of stats() on or off.
 
-from ._version import __version__
-del _version
+When off, the instrumented functions only check a flag, so that the counters
+can be left on in production. Returns the previous setting.
+"""
+    from . import _stats
+    previous = _stats.is_enabled()
+    _stats.enable(flag)
+    return previous
 
 # Add any imports here, if you wish to bring things into the library's top-level namespace when the library is imported.
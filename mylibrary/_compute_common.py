@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+"""Python layer of mylibrary.compute: argument handling, blocking and asyncio.
+
+Shared by the compiled and the pure NumPy backends of mylibrary.compute. The
+functions taking f run the f() of the backend calling them; asyncio and the
+thread pool executor are only imported when first needed.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import array
+import functools
+import os
+import threading
+
+import numpy as np
+
+
+# Default block size of f_chunked() and f_async(), in elements (8 MB of float64).
+#
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+#-------------------------------------------------------------------------------
+# Arguments
+#-------------------------------------------------------------------------------
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))  # honours taskset / cgroup cpusets
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def check_num_threads(n):
+    n = int(n)
+    if n < 1:
+        raise ValueError("number of threads must be at least 1, got {}".format(n))
+    return n
+
+
+# np.asarray(), but viewing bytes as uint8 (like bytearray and memoryview),
+# rather than as a single string.
+#
+def asarray(x):
+    if isinstance(x, bytes):
+        return np.frombuffer(x, dtype=np.uint8)
+    return np.asarray(x)
+
+
+# Return a new writable buffer of the type of obj, which exported x, or None
+# for types without one (f() then returns a new np.array).
+#
+def empty_like_input(obj, x):
+    if isinstance(obj, array.array):
+        return array.array(obj.typecode, [0]) * len(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return bytearray(len(obj))
+    if isinstance(obj, memoryview):
+        return memoryview(np.empty_like(x))
+    return None
+
+
+# Return out as an array, or a new array like x if out is None.
+#
+def check_out(x, out):
+    if out is None:
+        return np.empty_like(x)  # order="K": same layout as x, but contiguous
+    res = np.asarray(out)
+    if res.shape != x.shape:
+        raise ValueError("out has shape {}, expected {}".format(res.shape, x.shape))
+    if res.dtype != x.dtype:
+        raise ValueError("out has dtype {}, expected {}".format(res.dtype, x.dtype))
+    if not res.flags.writeable:
+        raise ValueError("out is read-only")
+    if np.may_share_memory(x, res) and not (x.__array_interface__["data"][0] == res.__array_interface__["data"][0]
+                                            and x.strides == res.strides):
+        raise ValueError("out must be either x itself or not overlap with x")
+    return res
+
+
+# Index of the first element of res (in C order) that the kernels marked as
+# invalid with errors="raise": NaN, or -1 for integers.
+#
+def first_invalid(res):
+    invalid = np.isnan(res) if res.dtype.kind == "f" else res < 0
+    return tuple(int(i) for i in np.unravel_index(np.argmax(invalid), res.shape))
+
+
+#-------------------------------------------------------------------------------
+# Streaming
+#-------------------------------------------------------------------------------
+
+def _check_chunk_size(chunk_size):
+    if chunk_size is None:
+        return DEFAULT_CHUNK_SIZE
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1, got {}".format(chunk_size))
+    return chunk_size
+
+
+def chunked(f, x, out, chunk_size, num_threads):
+    """f_chunked() of the backend with f()."""
+    x = np.asarray(x)
+    res = check_out(x, out)  # as a whole: blocks of a partially overlapping out pass on their own
+    if x.ndim == 0 or x.shape[0] == 0:
+        f(x, out=res, num_threads=num_threads)
+    else:
+        chunk_size = _check_chunk_size(chunk_size)
+        rows = max(1, chunk_size // max(1, x[0].size))  # along the first axis, per block
+        for start in range(0, x.shape[0], rows):
+            f(x[start:start + rows], out=res[start:start + rows], num_threads=num_threads)
+    return res if out is None else out
+
+
+def stream(f, blocks, num_threads):
+    """f_stream() of the backend with f()."""
+    for block in blocks:
+        yield f(block, num_threads=num_threads)
+
+
+#-------------------------------------------------------------------------------
+# asyncio
+#-------------------------------------------------------------------------------
+
+# Executor that runs the kernels for f_async(); created on first use.
+#
+_async_executor = None
+_async_workers = None
+_async_lock = threading.Lock()
+
+
+def set_async_workers(n=None):
+    """Set the number of worker threads used by f_async() and f_async_batch().
+
+Parameters:
+    n : int or None
+        Number of worker threads (>= 1). If None, use the environment
+        variable MYLIBRARY_ASYNC_WORKERS if set, otherwise all CPUs available
+        to this process.
+
+Calls already running finish on the previous executor.
+"""
+    global _async_executor, _async_workers
+    if n is None:
+        n = os.environ.get("MYLIBRARY_ASYNC_WORKERS") or available_cpus()
+    n = check_num_threads(n)
+    with _async_lock:
+        old, _async_executor, _async_workers = _async_executor, None, n
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+def get_async_workers():
+    """Return the number of worker threads used by f_async() and f_async_batch()."""
+    return _async_workers
+
+
+def get_async_executor():
+    global _async_executor
+    with _async_lock:
+        if _async_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _async_executor = ThreadPoolExecutor(max_workers=_async_workers,
+                                                 thread_name_prefix="mylibrary.compute")
+        return _async_executor
+
+
+set_async_workers()
+
+
+async def sqrt_async(f, x, out, num_threads, chunk_size):
+    """f_async() of the backend with f()."""
+    x = np.asarray(x)
+    res = check_out(x, out)  # as a whole, see chunked()
+    chunk_size = _check_chunk_size(chunk_size)
+
+    import asyncio
+    loop = asyncio.get_running_loop()
+    executor = get_async_executor()
+    if x.ndim == 0 or x.size <= chunk_size:
+        await loop.run_in_executor(executor, functools.partial(f, x, res, num_threads))
+        return res if out is None else out
+
+    rows = max(1, chunk_size // max(1, x[0].size))
+    blocks = [loop.run_in_executor(executor, functools.partial(f, x[start:start + rows], res[start:start + rows], num_threads))
+              for start in range(0, x.shape[0], rows)]
+    try:
+        await asyncio.gather(*blocks)
+    except BaseException:
+        # Cancellation, or an error in one block: don't start the others
+        for block in blocks:
+            block.cancel()
+        raise
+    return res if out is None else out
+
+
+async def sqrt_async_batch(f, xs, outs, num_threads, chunk_size):
+    """f_async_batch() of the backend with f()."""
+    import asyncio
+    xs = list(xs)
+    outs = [None] * len(xs) if outs is None else list(outs)
+    if len(outs) != len(xs):
+        raise ValueError("got {} output arrays for {} inputs".format(len(outs), len(xs)))
+    tasks = [asyncio.ensure_future(sqrt_async(f, x, out, num_threads, chunk_size)) for x, out in zip(xs, outs)]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+"""Pure NumPy backend of mylibrary.compute.
+
+Used as mylibrary.compute when the compiled extension is not available (e.g.
+when mylibrary was installed with setup-purepython.py), or when the
+environment variable MYLIBRARY_BACKEND is "numpy"; see mylibrary/__init__.py.
+
+The Python API and the results are the same as those of the compiled module,
+with these differences:
+
+  - f() and friends run NumPy's (vectorized) ufuncs on blocks of at most
+    DEFAULT_CHUNK_SIZE elements, so that temporary arrays stay small; large
+    contiguous arrays are split across threads (NumPy releases the GIL).
+  - precision= is accepted, but results are always exact.
+  - sqrt is a function, not a ufunc (no where=, casting=, etc.).
+  - f_processes() computes in this process.
+  - There is no C-level API (compute.pxd), and mylibrary.stats() does not
+    count calls.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import threading
+
+import numpy as np
+
+from mylibrary import _compute_common as _common
+from mylibrary._compute_common import DEFAULT_CHUNK_SIZE, set_async_workers, get_async_workers
+
+
+BACKEND = "numpy"
+
+HAVE_OPENMP = False
+
+_types = tuple(np.dtype(t) for t in (np.int8,    np.uint8,   np.int16,     np.uint16,
+                                     np.int32,   np.uint32,  np.int64,     np.uint64,
+                                     np.float32, np.float64, np.complex64, np.complex128))
+
+_precisions = ("exact", "fast", "approx")
+
+_error_policies = ("ignore", "raise", "clip", "nan_count")
+
+
+#-------------------------------------------------------------------------------
+# Kernels
+#-------------------------------------------------------------------------------
+
+# Compute res = sqrt(x) for 1-D arrays x and res under the policy errors (see
+# f() of the compiled module); return the number of invalid inputs (for
+# float, 0 with "ignore", which skips the check). Under "raise", invalid
+# integers give -1, for f() to find them. As in the compiled module, f()
+# reports invalid inputs through errors= only, not through np.errstate().
+#
+def _sqrt_block(x, res, errors="ignore"):
+    if x.dtype.kind == "c" or (x.dtype.kind == "f" and errors == "ignore"):
+        with np.errstate(invalid="ignore"):
+            np.sqrt(x, out=res)
+        return 0
+    if x.dtype.kind == "f":
+        bad = x.size - int(np.count_nonzero(x >= 0))
+        with np.errstate(invalid="ignore"):
+            np.sqrt(np.where(x < 0, 0, x) if bad and errors == "clip" else x, out=res)
+        return bad
+
+    bad = 0
+    if x.dtype.kind == "i":
+        negative = x < 0
+        bad = int(np.count_nonzero(negative))
+        if bad:
+            x = np.where(negative, 0, x)
+    r = np.sqrt(x, dtype=np.float64).astype(x.dtype)  # floor, as r >= 0
+    if x.dtype.itemsize == 8:
+        # Above 2**53, rounding x to double can put r off by one in either direction
+        r -= r > x // np.maximum(r, 1)
+        r1 = r + 1
+        r += r1 <= x // r1
+    if bad and errors == "raise":
+        r[negative] = -1
+    res[...] = r
+    return bad
+
+
+# Same, in blocks of at most DEFAULT_CHUNK_SIZE elements.
+#
+def _sqrt_blocks(x, res, errors="ignore"):
+    bad = 0
+    for start in range(0, x.shape[0], DEFAULT_CHUNK_SIZE):
+        bad += _sqrt_block(x[start:start + DEFAULT_CHUNK_SIZE], res[start:start + DEFAULT_CHUNK_SIZE], errors)
+    return bad
+
+
+#-------------------------------------------------------------------------------
+# Thread count
+#-------------------------------------------------------------------------------
+
+# Each thread gets at least this many elements (as in the compiled module).
+#
+_min_elements_per_thread = 32768
+
+_num_threads = 1
+_thread_pool = None
+_thread_pool_size = 0
+_thread_lock = threading.Lock()
+
+
+def set_num_threads(n=None):
+    """Set the process-wide default number of threads used by f().
+
+See the compiled module; here, the threads run NumPy ufuncs, which release
+the GIL.
+"""
+    global _num_threads
+    if n is None:
+        n = os.environ.get("MYLIBRARY_NUM_THREADS") or _common.available_cpus()
+    _num_threads = _common.check_num_threads(n)
+
+
+def get_num_threads():
+    """Return the process-wide default number of threads used by f()."""
+    return _num_threads
+
+
+def _effective_num_threads(num_threads, n):
+    nthreads = _num_threads if num_threads is None else _common.check_num_threads(num_threads)
+    return max(1, min(nthreads, n // _min_elements_per_thread))
+
+
+def _get_thread_pool(nthreads):
+    global _thread_pool, _thread_pool_size
+    with _thread_lock:
+        if _thread_pool is None or _thread_pool_size < nthreads:
+            if _thread_pool is not None:
+                _thread_pool.shutdown(wait=False)
+            from concurrent.futures import ThreadPoolExecutor
+            _thread_pool = ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix="mylibrary.compute")
+            _thread_pool_size = nthreads
+        return _thread_pool
+
+
+set_num_threads()
+
+
+#-------------------------------------------------------------------------------
+# SIMD kernel selection (NumPy does its own)
+#-------------------------------------------------------------------------------
+
+def supported_simd_kernels():
+    """Return the names of the SIMD kernels; only "generic" in this backend."""
+    return ("generic",)
+
+
+def set_simd_kernel(name=None):
+    """Select the SIMD kernel; only "generic" (or None) in this backend."""
+    if name not in (None, "generic"):
+        raise ValueError("SIMD kernel {!r} is not supported by the NumPy backend".format(name))
+
+
+def get_simd_kernel():
+    """Return the name of the SIMD kernel currently used by f()."""
+    return "generic"
+
+
+#-------------------------------------------------------------------------------
+# Public API
+#-------------------------------------------------------------------------------
+
+def f( x, out=None, num_threads=None, precision="exact", like_input=False, errors=None ):
+    """Example math function.
+
+Take the square root, elementwise, in the type of x (integer inputs get the
+exact integer square root floor(sqrt(x))). See the compiled module for
+details; precision is accepted, but the results are always exact.
+
+Raises:
+    TypeError
+        If the dtype of x is not supported.
+    ValueError
+        If out does not match x, if there are invalid inputs and errors is
+        "raise", or if precision or errors is unknown.
+"""
+    if precision not in _precisions:
+        raise ValueError("unknown precision {!r}; expected one of {}".format(precision, _precisions))
+    if errors is not None and errors not in _error_policies:
+        raise ValueError("unknown errors {!r}; expected one of {}".format(errors, _error_policies))
+    obj, x = x, _common.asarray(x)
+    if x.dtype not in _types:
+        raise TypeError("f() not supported for dtype {}".format(x.dtype))
+    if errors is None:
+        errors = "ignore" if x.dtype.kind in "fc" else "raise"
+    if like_input and out is None:
+        out = _common.empty_like_input(obj, x)
+    res = _common.check_out(x, out)
+
+    if ((x.flags.c_contiguous and res.flags.c_contiguous) or
+        (x.flags.f_contiguous and res.flags.f_contiguous)):
+        xf, rf = x.ravel(order="K"), res.ravel(order="K")
+        nthreads = _effective_num_threads(num_threads, xf.shape[0])
+        if nthreads > 1:
+            step = -(-xf.shape[0] // nthreads)
+            pieces = [(xf[start:start + step], rf[start:start + step]) for start in range(0, xf.shape[0], step)]
+            bad = sum(_get_thread_pool(nthreads).map(lambda piece: _sqrt_blocks(*piece, errors=errors), pieces))
+        else:
+            bad = _sqrt_blocks(xf, rf, errors)
+    else:
+        # Buffered iteration hands out (copies of) blocks of any layout
+        bad = 0
+        it = np.nditer([x, res], flags=["external_loop", "buffered", "zerosize_ok"],
+                       op_flags=[["readonly"], ["writeonly"]], order="K", buffersize=DEFAULT_CHUNK_SIZE)
+        with it:
+            for xs, rs in it:
+                bad += _sqrt_block(xs, rs, errors)
+
+    if bad and errors == "raise":
+        raise ValueError("f() of {} at index {}".format("negative integer" if x.dtype.kind in "iu" else "negative number or NaN",
+                                                        _common.first_invalid(res)))
+
+    if out is None:
+        out = res
+    if errors == "nan_count":
+        return out, bad
+    return out
+
+
+def sqrt(x, out=None):
+    """Square root, elementwise, like the ufunc of the compiled module.
+
+Only x and out= are supported (out is written with broadcasting). A negative
+integer input gives 0, and is reported like invalid floating-point operations
+(see np.errstate()).
+"""
+    x = np.asarray(x)
+    if x.dtype not in _types:
+        raise TypeError("sqrt() not supported for dtype {}".format(x.dtype))
+    if x.dtype.kind in "fc":
+        res = np.sqrt(x)  # reports invalid inputs under np.errstate() itself
+    else:
+        res = np.empty(x.shape, x.dtype)
+        if _sqrt_blocks(np.ravel(x), res.reshape(-1)):
+            np.sqrt(np.float64(-1.0))  # raises "invalid" under np.errstate()
+    if out is None:
+        return res
+    np.copyto(out, res, casting="same_kind")
+    return out
+
+
+def map( xs, out=None, workers=None ):
+    """Square roots of many arrays; see the compiled module."""
+    xs = [np.asarray(x) for x in xs]
+    for x in xs:
+        if x.dtype not in _types:
+            raise TypeError("map() not supported for dtype {}".format(x.dtype))
+    if out is None:
+        outs = [None] * len(xs)
+    elif isinstance(out, np.ndarray):
+        total = sum(x.size for x in xs)
+        if out.ndim != 1 or out.shape[0] != total:
+            raise ValueError("out has shape {}, expected ({},)".format(out.shape, total))
+        outs = []
+        start = 0
+        for x in xs:
+            outs.append(out[start:start + x.size].reshape(x.shape))
+            start += x.size
+    else:
+        outs = list(out)
+        if len(outs) != len(xs):
+            raise ValueError("got {} output arrays for {} inputs".format(len(outs), len(xs)))
+    outs = [_common.check_out(x, res) for x, res in zip(xs, outs)]
+
+    bad = False
+    for x, res in zip(xs, outs):
+        try:
+            f(x, out=res, num_threads=workers)
+        except ValueError:
+            bad = True
+    if bad:
+        raise ValueError("map() of negative integer")
+    return outs
+
+
+#-------------------------------------------------------------------------------
+# Streaming
+#-------------------------------------------------------------------------------
+
+def f_chunked( x, out=None, chunk_size=None, num_threads=None ):
+    """Square root of a large array, one block at a time; see the compiled module."""
+    return _common.chunked(f, x, out, chunk_size, num_threads)
+
+
+def f_stream( blocks, num_threads=None ):
+    """Square root of a stream of blocks; see the compiled module."""
+    return _common.stream(f, blocks, num_threads)
+
+
+def f_file( in_path, out_path, dtype=np.float64, chunk_size=None, num_threads=None ):
+    """Square root of a raw binary file, with overlapped I/O; see the compiled module."""
+    from mylibrary import _file_pipeline
+    dtype = np.dtype(dtype)
+    if dtype not in _types:
+        raise TypeError("f_file() not supported for dtype {}".format(dtype))
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    return _file_pipeline.run(f, in_path, out_path, dtype, chunk_size, num_threads)
+
+
+def f_processes( x, out=None, chunk_size=None ):
+    """Square root of a large array; computed in this process by the NumPy backend."""
+    return f_chunked(x, out=out, chunk_size=chunk_size)
+
+
+def set_process_workers(n=None):
+    """Accepted for compatibility; the NumPy backend has no worker processes."""
+    global _process_workers
+    if n is None:
+        n = os.environ.get("MYLIBRARY_PROCESS_WORKERS") or _common.available_cpus()
+    _process_workers = _common.check_num_threads(n)
+
+
+def get_process_workers():
+    """Return the number set with set_process_workers()."""
+    return _process_workers
+
+
+def shutdown_processes():
+    """Accepted for compatibility; the NumPy backend has no worker processes."""
+
+
+set_process_workers()
+
+
+#-------------------------------------------------------------------------------
+# asyncio
+#-------------------------------------------------------------------------------
+
+async def f_async( x, out=None, num_threads=1, chunk_size=None ):
+    """Square root for asyncio code, computed on a thread pool; see the compiled module."""
+    return await _common.sqrt_async(f, x, out, num_threads, chunk_size)
+
+
+async def f_async_batch( xs, outs=None, num_threads=1, chunk_size=None ):
+    """Square roots of several arrays for asyncio code, see f_async()."""
+    return await _common.sqrt_async_batch(f, xs, outs, num_threads, chunk_size)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+"""Out-of-core file-to-file processing with overlapped I/O; see compute.f_file().
+
+Shared by the compiled and the pure NumPy backends of mylibrary.compute.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+# Blocks in flight: one being read, one being computed, one being written.
+#
+NBUFFERS = 3
+
+
+# Fill the byte buffer buf from the raw file fh, short only at end of file;
+# return the number of bytes read.
+#
+def _read_block(fh, buf):
+    n = 0
+    while n < len(buf):
+        k = fh.readinto(buf[n:])
+        if not k:
+            break
+        n += k
+    return n
+
+
+def _write_block(fh, buf):
+    n = 0
+    while n < len(buf):
+        n += fh.write(buf[n:])
+
+
+def run(func, in_path, out_path, dtype, chunk_size, num_threads):
+    """Apply func(block, out=block, num_threads=num_threads) to the file in_path, writing out_path.
+
+The blocks of chunk_size elements go through a reader thread, the calling
+thread (func) and a writer thread, connected by queues, so that reading,
+computing and writing overlap. Returns the dict described in compute.f_file().
+"""
+    dtype = np.dtype(dtype)
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1, got {}".format(chunk_size))
+    size = os.path.getsize(in_path)
+    if size % dtype.itemsize:
+        raise ValueError("size of {} ({} bytes) is not a multiple of the size of {}".format(in_path, size, dtype))
+
+    # Unbuffered: blocks go straight between the files and the arrays
+    infile = open(in_path, "rb", buffering=0)
+    try:
+        # In place, every block is written after it was read
+        same = os.path.exists(out_path) and os.path.samefile(in_path, out_path)
+        outfile = open(out_path, "r+b" if same else "wb", buffering=0)
+    except BaseException:
+        infile.close()
+        raise
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(infile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    free = queue.Queue()
+    for _ in range(NBUFFERS):
+        free.put(np.empty(chunk_size, dtype=dtype))
+    filled = queue.Queue()
+    computed = queue.Queue()
+    stop = threading.Event()
+    errors = []
+    timing = {"read": 0.0, "write": 0.0}
+
+    # Blocks travel as (array, number of elements); None ends the stream, and
+    # None in free stops the reader.
+    #
+    def reader():
+        try:
+            while not stop.is_set():
+                buf = free.get()
+                if buf is None:
+                    break
+                t0 = time.perf_counter()
+                n = _read_block(infile, memoryview(buf).cast("B"))
+                timing["read"] += time.perf_counter() - t0
+                if n == 0:
+                    break
+                filled.put((buf, n // dtype.itemsize))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            filled.put(None)
+
+    def writer():
+        while True:
+            item = computed.get()
+            if item is None:
+                return
+            buf, n = item
+            if not errors:
+                try:
+                    t0 = time.perf_counter()
+                    _write_block(outfile, memoryview(buf[:n]).cast("B"))
+                    timing["write"] += time.perf_counter() - t0
+                except BaseException as e:
+                    errors.append(e)
+                    stop.set()
+            free.put(buf)
+
+    threads = [threading.Thread(target=reader, name="mylibrary.compute.f_file-reader", daemon=True),
+               threading.Thread(target=writer, name="mylibrary.compute.f_file-writer", daemon=True)]
+    elements = 0
+    compute_time = 0.0
+    start = time.perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        while True:
+            item = filled.get()
+            if item is None:
+                break
+            buf, n = item
+            if stop.is_set():
+                free.put(buf)
+                continue
+            try:
+                t0 = time.perf_counter()
+                func(buf[:n], out=buf[:n], num_threads=num_threads)
+                compute_time += time.perf_counter() - t0
+            except BaseException:
+                # Let the reader finish (it may wait for a free buffer), then re-raise
+                stop.set()
+                free.put(buf)
+                while filled.get() is not None:
+                    pass
+                raise
+            elements += n
+            computed.put((buf, n))
+    finally:
+        stop.set()
+        free.put(None)
+        computed.put(None)
+        for thread in threads:
+            if thread.ident is not None:
+                thread.join()
+        infile.close()
+        outfile.close()
+    if errors:
+        raise errors[0]
+
+    seconds = time.perf_counter() - start
+    nbytes = elements * dtype.itemsize
+    return dict(elements=elements, bytes=nbytes, seconds=seconds,
+                throughput=nbytes / seconds if seconds > 0 else float("inf"),
+                read_seconds=timing["read"], compute_seconds=compute_time,
+                write_seconds=timing["write"])
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+"""Training workload for profile-guided optimization (PGO) builds.
+
+Run by "python setup.py build_ext --pgo" on the instrumented extensions, to
+collect the profile the final build is optimized with. It exercises the hot
+paths of mylibrary with the mix of sizes, dtypes and layouts they typically
+see; the work done is fixed (seeded inputs, fixed repetitions), so that the
+profile, and hence the build, is reproducible.
+
+Usage:
+    python -m mylibrary._pgo_training [scale]
+
+scale (default 1) multiplies the number of repetitions.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+import io
+import os
+import sys
+from contextlib import redirect_stdout
+
+import numpy as np
+
+import mylibrary
+import mylibrary.compute as compute
+import mylibrary.dostuff as dostuff
+import mylibrary.expr as expr
+
+
+SIZES = [1, 10, 100, 1000, 10000, 100000, 1000000]
+
+
+def train_compute(rng, repeat):
+    default = compute.get_simd_kernel()
+    try:
+        for kernel in compute.supported_simd_kernels():
+            compute.set_simd_kernel(kernel)
+            for size in SIZES:
+                for dtype in (np.float32, np.float64):
+                    x = rng.random(size).astype(dtype)
+                    out = np.empty_like(x)
+                    for _ in range(max(1, repeat * 1000 // size)):
+                        compute.f(x)
+                        compute.f(x, out=out)
+                        compute.f(x, out=out, precision="fast")
+                        compute.f(x, out=out, precision="approx")
+                    compute.f(x[::2])
+    finally:
+        compute.set_simd_kernel(default)
+
+    for size in SIZES[:-1]:
+        for dtype in (np.int8, np.uint8, np.int16, np.uint16, np.int32, np.uint32,
+                      np.int64, np.uint64, np.complex64, np.complex128):
+            x = (rng.random(size) * 100).astype(dtype)
+            for _ in range(max(1, repeat * 100 // size)):
+                compute.f(x)
+                compute.sqrt(x)
+
+    x = rng.random((300, 400))
+    for _ in range(repeat):
+        compute.f(x.T)
+        compute.f(x[:, ::3])
+        compute.f_chunked(x, chunk_size=10000)
+        compute.map([x, x[0], x[:, 0], x.astype(np.float32)])
+
+
+def train_expr(rng, repeat):
+    a, b = rng.random(100000), rng.random(100000)
+    x, y = expr.var("x"), expr.var("y")
+    e = 2.5 * expr.sqrt(x * x + y * y)
+    for _ in range(repeat * 10):
+        e.evaluate(x=a, y=b)
+        ((x - 1) / (abs(y) + 2) - 3 * x).evaluate(x=a[:1000], y=b[:1000])
+
+
+def train_dostuff(repeat):
+    lines = ["line {}".format(i) for i in range(10000)]
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            dostuff.hello_many(lines, fd=devnull.fileno())
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeat * 100):
+            dostuff.hello("Hello world")
+
+
+def run(scale=1.0):
+    """Run the training workload, scale times the default amount of work."""
+    rng = np.random.default_rng(0)
+    repeat = max(1, int(round(10 * scale)))
+    previous = mylibrary.enable_stats(True)
+    try:
+        train_compute(rng, repeat)
+        train_expr(rng, repeat)
+        train_dostuff(repeat)
+    finally:
+        mylibrary.enable_stats(previous)
+        mylibrary.reset_stats()
+
+
+if __name__ == '__main__':
+    run(float(sys.argv[1]) if len(sys.argv) > 1 else 1.0)
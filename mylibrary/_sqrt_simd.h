@@ -0,0 +1,529 @@
+/*
+ * Explicitly vectorized square root kernels for contiguous float and double
+ * arrays, for use by mylibrary/compute.pyx.
+ *
+ * On x86 with GCC or clang, there are SSE2, AVX2 and AVX-512 versions of each
+ * kernel, compiled with per-function target attributes, so that the extension
+ * itself can be built with generic compiler flags. Which one is used is decided
+ * at runtime (mylib_simd_select()), based on what the CPU supports.
+ *
+ * Elsewhere, only the generic (plain C) kernels are available.
+ *
+ * All kernels compute correctly rounded square roots, so their results are
+ * identical. x and y may be the same array, but must not overlap otherwise.
+ *
+ * In addition, on x86 there are reduced-precision kernels, which start from
+ * the hardware reciprocal square root estimate r ~ 1/sqrt(x) and refine it by
+ * Newton steps r' = r (3/2 - x r^2 / 2) before computing sqrt(x) = x r. They
+ * are used with mylib_sqrt_d_prec() and mylib_sqrt_f_prec(), for:
+ *
+ *     MYLIB_PRECISION_FAST    a few ULP of error
+ *     MYLIB_PRECISION_APPROX  the estimate only; relative error below
+ *                             1.5 * 2**-12 (SSE2, AVX2) or 2**-14 (AVX-512)
+ *
+ * Inputs outside the normal range of the estimate (zero, subnormal, too large,
+ * negative, infinite or NaN) get the exact result. Elsewhere, and with the
+ * generic kernels, all precisions compute exact results. So does FAST for
+ * double with SSE2 and AVX2: from the float estimate, it would take three
+ * Newton steps, which is slower than the hardware square root.
+ *
+ * mylib_count_invalid_d() and mylib_count_invalid_f() count the inputs outside
+ * the domain of sqrt(), i.e. negative (but not -0.0) or NaN, for the errors=
+ * policies of f().
+ */
+
+#ifndef MYLIBRARY_SQRT_SIMD_H
+#define MYLIBRARY_SQRT_SIMD_H
+
+#include <float.h>
+#include <math.h>
+#include <stddef.h>
+
+enum {
+    MYLIB_SIMD_GENERIC = 0,
+    MYLIB_SIMD_SSE2    = 1,
+    MYLIB_SIMD_AVX2    = 2,
+    MYLIB_SIMD_AVX512  = 3
+};
+
+enum {
+    MYLIB_PRECISION_EXACT  = 0,
+    MYLIB_PRECISION_FAST   = 1,
+    MYLIB_PRECISION_APPROX = 2
+};
+
+typedef void (*mylib_sqrt_d_func)(const double *x, double *y, ptrdiff_t n);
+typedef void (*mylib_sqrt_f_func)(const float *x, float *y, ptrdiff_t n);
+
+/* Reduced-precision kernels, with the number of Newton steps */
+typedef void (*mylib_rsqrt_d_func)(const double *x, double *y, ptrdiff_t n, int steps);
+typedef void (*mylib_rsqrt_f_func)(const float *x, float *y, ptrdiff_t n, int steps);
+
+/* Counts of invalid inputs */
+typedef ptrdiff_t (*mylib_count_invalid_d_func)(const double *x, ptrdiff_t n);
+typedef ptrdiff_t (*mylib_count_invalid_f_func)(const float *x, ptrdiff_t n);
+
+
+/* Generic kernels */
+
+static void mylib_sqrt_d_generic(const double *x, double *y, ptrdiff_t n) {
+    ptrdiff_t i;
+    for (i = 0; i < n; i++)
+        y[i] = sqrt(x[i]);
+}
+
+static void mylib_sqrt_f_generic(const float *x, float *y, ptrdiff_t n) {
+    ptrdiff_t i;
+    for (i = 0; i < n; i++)
+        y[i] = sqrtf(x[i]);
+}
+
+static ptrdiff_t mylib_count_invalid_d_generic(const double *x, ptrdiff_t n) {
+    ptrdiff_t i, count = 0;
+    for (i = 0; i < n; i++)
+        count += !(x[i] >= 0);
+    return count;
+}
+
+static ptrdiff_t mylib_count_invalid_f_generic(const float *x, ptrdiff_t n) {
+    ptrdiff_t i, count = 0;
+    for (i = 0; i < n; i++)
+        count += !(x[i] >= 0);
+    return count;
+}
+
+
+#if (defined(__GNUC__) || defined(__clang__)) && (defined(__x86_64__) || defined(__i386__))
+
+#define MYLIB_SIMD_X86 1
+
+#include <immintrin.h>
+
+/* SSE2 */
+
+__attribute__((target("sse2")))
+static void mylib_sqrt_d_sse2(const double *x, double *y, ptrdiff_t n) {
+    ptrdiff_t i = 0;
+    for (; i + 2 <= n; i += 2)
+        _mm_storeu_pd(y + i, _mm_sqrt_pd(_mm_loadu_pd(x + i)));
+    for (; i < n; i++)
+        y[i] = sqrt(x[i]);
+}
+
+__attribute__((target("sse2")))
+static void mylib_sqrt_f_sse2(const float *x, float *y, ptrdiff_t n) {
+    ptrdiff_t i = 0;
+    for (; i + 4 <= n; i += 4)
+        _mm_storeu_ps(y + i, _mm_sqrt_ps(_mm_loadu_ps(x + i)));
+    for (; i < n; i++)
+        y[i] = sqrtf(x[i]);
+}
+
+/* AVX2 */
+
+__attribute__((target("avx2")))
+static void mylib_sqrt_d_avx2(const double *x, double *y, ptrdiff_t n) {
+    ptrdiff_t i = 0;
+    for (; i + 4 <= n; i += 4)
+        _mm256_storeu_pd(y + i, _mm256_sqrt_pd(_mm256_loadu_pd(x + i)));
+    for (; i < n; i++)
+        y[i] = sqrt(x[i]);
+}
+
+__attribute__((target("avx2")))
+static void mylib_sqrt_f_avx2(const float *x, float *y, ptrdiff_t n) {
+    ptrdiff_t i = 0;
+    for (; i + 8 <= n; i += 8)
+        _mm256_storeu_ps(y + i, _mm256_sqrt_ps(_mm256_loadu_ps(x + i)));
+    for (; i < n; i++)
+        y[i] = sqrtf(x[i]);
+}
+
+/* AVX-512; the tail is handled with masked loads and stores */
+
+__attribute__((target("avx512f")))
+static void mylib_sqrt_d_avx512(const double *x, double *y, ptrdiff_t n) {
+    ptrdiff_t i = 0;
+    for (; i + 8 <= n; i += 8)
+        _mm512_storeu_pd(y + i, _mm512_sqrt_pd(_mm512_loadu_pd(x + i)));
+    if (i < n) {
+        __mmask8 m = (__mmask8)((1u << (n - i)) - 1u);
+        _mm512_mask_storeu_pd(y + i, m, _mm512_sqrt_pd(_mm512_maskz_loadu_pd(m, x + i)));
+    }
+}
+
+__attribute__((target("avx512f")))
+static void mylib_sqrt_f_avx512(const float *x, float *y, ptrdiff_t n) {
+    ptrdiff_t i = 0;
+    for (; i + 16 <= n; i += 16)
+        _mm512_storeu_ps(y + i, _mm512_sqrt_ps(_mm512_loadu_ps(x + i)));
+    if (i < n) {
+        __mmask16 m = (__mmask16)((1u << (n - i)) - 1u);
+        _mm512_mask_storeu_ps(y + i, m, _mm512_sqrt_ps(_mm512_maskz_loadu_ps(m, x + i)));
+    }
+}
+
+/* Reduced precision; the estimate for double is computed in float, so that
+ * lanes with x outside [FLT_MIN, FLT_MAX] need the exact fallback. Values
+ * are saved before the results are stored, as y may be x. Tails are exact. */
+
+__attribute__((target("sse2")))
+static void mylib_rsqrt_d_sse2(const double *x, double *y, ptrdiff_t n, int steps) {
+    const __m128d lo = _mm_set1_pd(FLT_MIN), hi = _mm_set1_pd(FLT_MAX);
+    const __m128d half = _mm_set1_pd(0.5), three_halves = _mm_set1_pd(1.5);
+    double v_saved[2];
+    ptrdiff_t i = 0;
+    int k, j, ok;
+    for (; i + 2 <= n; i += 2) {
+        __m128d v = _mm_loadu_pd(x + i);
+        __m128d r = _mm_cvtps_pd(_mm_rsqrt_ps(_mm_cvtpd_ps(v)));
+        __m128d hv = _mm_mul_pd(half, v);
+        for (k = 0; k < steps; k++)
+            r = _mm_mul_pd(r, _mm_sub_pd(three_halves, _mm_mul_pd(hv, _mm_mul_pd(r, r))));
+        ok = _mm_movemask_pd(_mm_and_pd(_mm_cmpge_pd(v, lo), _mm_cmple_pd(v, hi)));
+        if (ok != 0x3)
+            _mm_storeu_pd(v_saved, v);
+        _mm_storeu_pd(y + i, _mm_mul_pd(v, r));
+        for (j = 0; ok != 0x3 && j < 2; j++)
+            if (!(ok & (1 << j)))
+                y[i + j] = sqrt(v_saved[j]);
+    }
+    for (; i < n; i++)
+        y[i] = sqrt(x[i]);
+}
+
+__attribute__((target("sse2")))
+static void mylib_rsqrt_f_sse2(const float *x, float *y, ptrdiff_t n, int steps) {
+    const __m128 lo = _mm_set1_ps(FLT_MIN), hi = _mm_set1_ps(FLT_MAX);
+    const __m128 half = _mm_set1_ps(0.5f), three_halves = _mm_set1_ps(1.5f);
+    float v_saved[4];
+    ptrdiff_t i = 0;
+    int k, j, ok;
+    for (; i + 4 <= n; i += 4) {
+        __m128 v = _mm_loadu_ps(x + i);
+        __m128 r = _mm_rsqrt_ps(v);
+        __m128 hv = _mm_mul_ps(half, v);
+        for (k = 0; k < steps; k++)
+            r = _mm_mul_ps(r, _mm_sub_ps(three_halves, _mm_mul_ps(hv, _mm_mul_ps(r, r))));
+        ok = _mm_movemask_ps(_mm_and_ps(_mm_cmpge_ps(v, lo), _mm_cmple_ps(v, hi)));
+        if (ok != 0xf)
+            _mm_storeu_ps(v_saved, v);
+        _mm_storeu_ps(y + i, _mm_mul_ps(v, r));
+        for (j = 0; ok != 0xf && j < 4; j++)
+            if (!(ok & (1 << j)))
+                y[i + j] = sqrtf(v_saved[j]);
+    }
+    for (; i < n; i++)
+        y[i] = sqrtf(x[i]);
+}
+
+__attribute__((target("avx2")))
+static void mylib_rsqrt_d_avx2(const double *x, double *y, ptrdiff_t n, int steps) {
+    const __m256d lo = _mm256_set1_pd(FLT_MIN), hi = _mm256_set1_pd(FLT_MAX);
+    const __m256d half = _mm256_set1_pd(0.5), three_halves = _mm256_set1_pd(1.5);
+    double v_saved[4];
+    ptrdiff_t i = 0;
+    int k, j, ok;
+    for (; i + 4 <= n; i += 4) {
+        __m256d v = _mm256_loadu_pd(x + i);
+        __m256d r = _mm256_cvtps_pd(_mm_rsqrt_ps(_mm256_cvtpd_ps(v)));
+        __m256d hv = _mm256_mul_pd(half, v);
+        for (k = 0; k < steps; k++)
+            r = _mm256_mul_pd(r, _mm256_sub_pd(three_halves, _mm256_mul_pd(hv, _mm256_mul_pd(r, r))));
+        ok = _mm256_movemask_pd(_mm256_and_pd(_mm256_cmp_pd(v, lo, _CMP_GE_OQ), _mm256_cmp_pd(v, hi, _CMP_LE_OQ)));
+        if (ok != 0xf)
+            _mm256_storeu_pd(v_saved, v);
+        _mm256_storeu_pd(y + i, _mm256_mul_pd(v, r));
+        for (j = 0; ok != 0xf && j < 4; j++)
+            if (!(ok & (1 << j)))
+                y[i + j] = sqrt(v_saved[j]);
+    }
+    for (; i < n; i++)
+        y[i] = sqrt(x[i]);
+}
+
+__attribute__((target("avx2")))
+static void mylib_rsqrt_f_avx2(const float *x, float *y, ptrdiff_t n, int steps) {
+    const __m256 lo = _mm256_set1_ps(FLT_MIN), hi = _mm256_set1_ps(FLT_MAX);
+    const __m256 half = _mm256_set1_ps(0.5f), three_halves = _mm256_set1_ps(1.5f);
+    float v_saved[8];
+    ptrdiff_t i = 0;
+    int k, j, ok;
+    for (; i + 8 <= n; i += 8) {
+        __m256 v = _mm256_loadu_ps(x + i);
+        __m256 r = _mm256_rsqrt_ps(v);
+        __m256 hv = _mm256_mul_ps(half, v);
+        for (k = 0; k < steps; k++)
+            r = _mm256_mul_ps(r, _mm256_sub_ps(three_halves, _mm256_mul_ps(hv, _mm256_mul_ps(r, r))));
+        ok = _mm256_movemask_ps(_mm256_and_ps(_mm256_cmp_ps(v, lo, _CMP_GE_OQ), _mm256_cmp_ps(v, hi, _CMP_LE_OQ)));
+        if (ok != 0xff)
+            _mm256_storeu_ps(v_saved, v);
+        _mm256_storeu_ps(y + i, _mm256_mul_ps(v, r));
+        for (j = 0; ok != 0xff && j < 8; j++)
+            if (!(ok & (1 << j)))
+                y[i + j] = sqrtf(v_saved[j]);
+    }
+    for (; i < n; i++)
+        y[i] = sqrtf(x[i]);
+}
+
+/* AVX-512 has a more accurate estimate, in double as well; the exact fallback
+ * is a masked square root, and the tail is handled with masks as above. */
+
+__attribute__((target("avx512f")))
+static inline __m512d mylib_rsqrt_d_avx512_vec(__m512d v, int steps) {
+    const __m512d half = _mm512_set1_pd(0.5), three_halves = _mm512_set1_pd(1.5);
+    __m512d r = _mm512_rsqrt14_pd(v);
+    __m512d hv = _mm512_mul_pd(half, v);
+    __mmask8 ok;
+    int k;
+    for (k = 0; k < steps; k++)
+        r = _mm512_mul_pd(r, _mm512_sub_pd(three_halves, _mm512_mul_pd(hv, _mm512_mul_pd(r, r))));
+    ok = _mm512_cmp_pd_mask(v, _mm512_set1_pd(DBL_MIN), _CMP_GE_OQ) &
+         _mm512_cmp_pd_mask(v, _mm512_set1_pd(DBL_MAX), _CMP_LE_OQ);
+    r = _mm512_mul_pd(v, r);
+    return ok == 0xff ? r : _mm512_mask_sqrt_pd(r, (__mmask8)~ok, v);
+}
+
+__attribute__((target("avx512f")))
+static void mylib_rsqrt_d_avx512(const double *x, double *y, ptrdiff_t n, int steps) {
+    ptrdiff_t i = 0;
+    for (; i + 8 <= n; i += 8)
+        _mm512_storeu_pd(y + i, mylib_rsqrt_d_avx512_vec(_mm512_loadu_pd(x + i), steps));
+    if (i < n) {
+        __mmask8 m = (__mmask8)((1u << (n - i)) - 1u);
+        _mm512_mask_storeu_pd(y + i, m, mylib_rsqrt_d_avx512_vec(_mm512_maskz_loadu_pd(m, x + i), steps));
+    }
+}
+
+__attribute__((target("avx512f")))
+static inline __m512 mylib_rsqrt_f_avx512_vec(__m512 v, int steps) {
+    const __m512 half = _mm512_set1_ps(0.5f), three_halves = _mm512_set1_ps(1.5f);
+    __m512 r = _mm512_rsqrt14_ps(v);
+    __m512 hv = _mm512_mul_ps(half, v);
+    __mmask16 ok;
+    int k;
+    for (k = 0; k < steps; k++)
+        r = _mm512_mul_ps(r, _mm512_sub_ps(three_halves, _mm512_mul_ps(hv, _mm512_mul_ps(r, r))));
+    ok = _mm512_cmp_ps_mask(v, _mm512_set1_ps(FLT_MIN), _CMP_GE_OQ) &
+         _mm512_cmp_ps_mask(v, _mm512_set1_ps(FLT_MAX), _CMP_LE_OQ);
+    r = _mm512_mul_ps(v, r);
+    return ok == 0xffff ? r : _mm512_mask_sqrt_ps(r, (__mmask16)~ok, v);
+}
+
+__attribute__((target("avx512f")))
+static void mylib_rsqrt_f_avx512(const float *x, float *y, ptrdiff_t n, int steps) {
+    ptrdiff_t i = 0;
+    for (; i + 16 <= n; i += 16)
+        _mm512_storeu_ps(y + i, mylib_rsqrt_f_avx512_vec(_mm512_loadu_ps(x + i), steps));
+    if (i < n) {
+        __mmask16 m = (__mmask16)((1u << (n - i)) - 1u);
+        _mm512_mask_storeu_ps(y + i, m, mylib_rsqrt_f_avx512_vec(_mm512_maskz_loadu_ps(m, x + i), steps));
+    }
+}
+
+/* Counts of invalid inputs: !(x >= 0) is the unordered compare NGE, which is
+ * also true for NaN */
+
+__attribute__((target("sse2")))
+static ptrdiff_t mylib_count_invalid_d_sse2(const double *x, ptrdiff_t n) {
+    ptrdiff_t i = 0, count = 0;
+    for (; i + 2 <= n; i += 2)
+        count += __builtin_popcount(_mm_movemask_pd(_mm_cmpnge_pd(_mm_loadu_pd(x + i), _mm_setzero_pd())));
+    for (; i < n; i++)
+        count += !(x[i] >= 0);
+    return count;
+}
+
+__attribute__((target("sse2")))
+static ptrdiff_t mylib_count_invalid_f_sse2(const float *x, ptrdiff_t n) {
+    ptrdiff_t i = 0, count = 0;
+    for (; i + 4 <= n; i += 4)
+        count += __builtin_popcount(_mm_movemask_ps(_mm_cmpnge_ps(_mm_loadu_ps(x + i), _mm_setzero_ps())));
+    for (; i < n; i++)
+        count += !(x[i] >= 0);
+    return count;
+}
+
+__attribute__((target("avx2,popcnt")))
+static ptrdiff_t mylib_count_invalid_d_avx2(const double *x, ptrdiff_t n) {
+    ptrdiff_t i = 0, count = 0;
+    for (; i + 4 <= n; i += 4)
+        count += __builtin_popcount(_mm256_movemask_pd(_mm256_cmp_pd(_mm256_loadu_pd(x + i), _mm256_setzero_pd(), _CMP_NGE_UQ)));
+    for (; i < n; i++)
+        count += !(x[i] >= 0);
+    return count;
+}
+
+__attribute__((target("avx2,popcnt")))
+static ptrdiff_t mylib_count_invalid_f_avx2(const float *x, ptrdiff_t n) {
+    ptrdiff_t i = 0, count = 0;
+    for (; i + 8 <= n; i += 8)
+        count += __builtin_popcount(_mm256_movemask_ps(_mm256_cmp_ps(_mm256_loadu_ps(x + i), _mm256_setzero_ps(), _CMP_NGE_UQ)));
+    for (; i < n; i++)
+        count += !(x[i] >= 0);
+    return count;
+}
+
+__attribute__((target("avx512f,popcnt")))
+static ptrdiff_t mylib_count_invalid_d_avx512(const double *x, ptrdiff_t n) {
+    ptrdiff_t i = 0, count = 0;
+    for (; i + 8 <= n; i += 8)
+        count += __builtin_popcount(_mm512_cmp_pd_mask(_mm512_loadu_pd(x + i), _mm512_setzero_pd(), _CMP_NGE_UQ));
+    for (; i < n; i++)
+        count += !(x[i] >= 0);
+    return count;
+}
+
+__attribute__((target("avx512f,popcnt")))
+static ptrdiff_t mylib_count_invalid_f_avx512(const float *x, ptrdiff_t n) {
+    ptrdiff_t i = 0, count = 0;
+    for (; i + 16 <= n; i += 16)
+        count += __builtin_popcount(_mm512_cmp_ps_mask(_mm512_loadu_ps(x + i), _mm512_setzero_ps(), _CMP_NGE_UQ));
+    for (; i < n; i++)
+        count += !(x[i] >= 0);
+    return count;
+}
+
+#endif  /* x86 */
+
+
+/* Runtime selection
+ *
+ * The kernels of each level, with the Newton steps of their reduced-precision
+ * kernels for MYLIB_PRECISION_FAST (-1: use the exact kernel), form one
+ * constant table. mylib_simd_select() publishes a pointer to the table of the
+ * selected level, and every entry point below reads that pointer once, so a
+ * call uses the kernels and the steps of a single level even if another
+ * thread selects a different one meanwhile. */
+
+typedef struct mylib_kernels {
+    int                        level;
+    mylib_sqrt_d_func          sqrt_d;
+    mylib_sqrt_f_func          sqrt_f;
+    mylib_rsqrt_d_func         rsqrt_d;          /* NULL: exact only */
+    mylib_rsqrt_f_func         rsqrt_f;
+    int                        rsqrt_d_steps;
+    int                        rsqrt_f_steps;
+    mylib_count_invalid_d_func count_invalid_d;
+    mylib_count_invalid_f_func count_invalid_f;
+} mylib_kernels;
+
+static const mylib_kernels mylib_kernels_generic = {
+    MYLIB_SIMD_GENERIC, mylib_sqrt_d_generic, mylib_sqrt_f_generic, NULL, NULL, 0, 0,
+    mylib_count_invalid_d_generic, mylib_count_invalid_f_generic
+};
+
+#ifdef MYLIB_SIMD_X86
+/* Newton steps: each one squares the relative error of the estimate, from
+ * 2**-12 (2**-14 for AVX-512), until it is down to rounding error */
+static const mylib_kernels mylib_kernels_sse2 = {
+    MYLIB_SIMD_SSE2, mylib_sqrt_d_sse2, mylib_sqrt_f_sse2, mylib_rsqrt_d_sse2, mylib_rsqrt_f_sse2, -1, 1,
+    mylib_count_invalid_d_sse2, mylib_count_invalid_f_sse2
+};
+
+static const mylib_kernels mylib_kernels_avx2 = {
+    MYLIB_SIMD_AVX2, mylib_sqrt_d_avx2, mylib_sqrt_f_avx2, mylib_rsqrt_d_avx2, mylib_rsqrt_f_avx2, -1, 1,
+    mylib_count_invalid_d_avx2, mylib_count_invalid_f_avx2
+};
+
+static const mylib_kernels mylib_kernels_avx512 = {
+    MYLIB_SIMD_AVX512, mylib_sqrt_d_avx512, mylib_sqrt_f_avx512, mylib_rsqrt_d_avx512, mylib_rsqrt_f_avx512, 2, 1,
+    mylib_count_invalid_d_avx512, mylib_count_invalid_f_avx512
+};
+#endif
+
+static const mylib_kernels *mylib_kernels_current = &mylib_kernels_generic;
+
+#if defined(__GNUC__) || defined(__clang__)
+#define MYLIB_KERNELS_LOAD() __atomic_load_n(&mylib_kernels_current, __ATOMIC_ACQUIRE)
+#define MYLIB_KERNELS_STORE(k) __atomic_store_n(&mylib_kernels_current, (k), __ATOMIC_RELEASE)
+#else
+#define MYLIB_KERNELS_LOAD() (*(const mylib_kernels * volatile *)&mylib_kernels_current)
+#define MYLIB_KERNELS_STORE(k) (*(const mylib_kernels * volatile *)&mylib_kernels_current = (k))
+#endif
+
+/* Return 1 if this CPU (and OS) can run the kernels of the given level. */
+static int mylib_simd_supported(int level) {
+    switch (level) {
+    case MYLIB_SIMD_GENERIC:
+        return 1;
+#ifdef MYLIB_SIMD_X86
+    case MYLIB_SIMD_SSE2:
+        return __builtin_cpu_supports("sse2") != 0;
+    case MYLIB_SIMD_AVX2:
+        return __builtin_cpu_supports("avx2") != 0;
+    case MYLIB_SIMD_AVX512:
+        return __builtin_cpu_supports("avx512f") != 0;
+#endif
+    default:
+        return 0;
+    }
+}
+
+/* Use the kernels of the given level; return 0 if not supported (nothing is changed then). */
+static int mylib_simd_select(int level) {
+    const mylib_kernels *k;
+    if (!mylib_simd_supported(level))
+        return 0;
+    switch (level) {
+#ifdef MYLIB_SIMD_X86
+    case MYLIB_SIMD_SSE2:
+        k = &mylib_kernels_sse2;
+        break;
+    case MYLIB_SIMD_AVX2:
+        k = &mylib_kernels_avx2;
+        break;
+    case MYLIB_SIMD_AVX512:
+        k = &mylib_kernels_avx512;
+        break;
+#endif
+    default:
+        k = &mylib_kernels_generic;
+    }
+    MYLIB_KERNELS_STORE(k);
+    return 1;
+}
+
+/* The level currently selected. */
+static int mylib_simd_current(void) {
+    return MYLIB_KERNELS_LOAD()->level;
+}
+
+static void mylib_sqrt_d(const double *x, double *y, ptrdiff_t n) {
+    MYLIB_KERNELS_LOAD()->sqrt_d(x, y, n);
+}
+
+static void mylib_sqrt_f(const float *x, float *y, ptrdiff_t n) {
+    MYLIB_KERNELS_LOAD()->sqrt_f(x, y, n);
+}
+
+/* Same, with one of the MYLIB_PRECISION_* values. */
+
+static void mylib_sqrt_d_prec(const double *x, double *y, ptrdiff_t n, int precision) {
+    const mylib_kernels *k = MYLIB_KERNELS_LOAD();
+    if (precision == MYLIB_PRECISION_EXACT || k->rsqrt_d == NULL ||
+        (precision == MYLIB_PRECISION_FAST && k->rsqrt_d_steps < 0))
+        k->sqrt_d(x, y, n);
+    else
+        k->rsqrt_d(x, y, n, precision == MYLIB_PRECISION_FAST ? k->rsqrt_d_steps : 0);
+}
+
+static void mylib_sqrt_f_prec(const float *x, float *y, ptrdiff_t n, int precision) {
+    const mylib_kernels *k = MYLIB_KERNELS_LOAD();
+    if (precision == MYLIB_PRECISION_EXACT || k->rsqrt_f == NULL ||
+        (precision == MYLIB_PRECISION_FAST && k->rsqrt_f_steps < 0))
+        k->sqrt_f(x, y, n);
+    else
+        k->rsqrt_f(x, y, n, precision == MYLIB_PRECISION_FAST ? k->rsqrt_f_steps : 0);
+}
+
+static ptrdiff_t mylib_count_invalid_d(const double *x, ptrdiff_t n) {
+    return MYLIB_KERNELS_LOAD()->count_invalid_d(x, n);
+}
+
+static ptrdiff_t mylib_count_invalid_f(const float *x, ptrdiff_t n) {
+    return MYLIB_KERNELS_LOAD()->count_invalid_f(x, n);
+}
+
+#endif  /* MYLIBRARY_SQRT_SIMD_H */
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+# Cython-level declarations for mylibrary._stats, the counters behind mylibrary.stats().
+#
+# Instrumented functions only read the flag enabled when the counters are off,
+# which costs next to nothing:
+#
+#     cimport mylibrary._stats as _stats
+#
+#     cdef double t0 = _stats.now() if _stats.enabled else 0.0
+#     ...                                   # the kernel
+#     if t0 != 0.0:
+#         _stats.record(_stats.COMPUTE_F, elements, bytes_in, bytes_out, _stats.now() - t0)
+#
+# record() must be called with the GIL held (if the GIL is enabled); it takes a
+# lock, so that the counters also add up on free-threaded Python.
+
+from __future__ import absolute_import
+
+# Instrumented functions; see _names in _stats.pyx
+cdef enum:
+    COMPUTE_F
+    COMPUTE_MAP
+    DOSTUFF_HELLO
+    DOSTUFF_HELLO_MANY
+    NCOUNTERS
+
+cdef bint enabled
+
+# Monotonic clock, in seconds
+cdef double now() noexcept nogil
+
+cdef void record(int counter, Py_ssize_t elements, Py_ssize_t bytes_in, Py_ssize_t bytes_out,
+                 double seconds) noexcept
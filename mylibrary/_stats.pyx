@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# cython: wraparound  = False
+# cython: boundscheck = False
+# cython: cdivision   = True
+# cython: freethreading_compatible = True
+"""Counters of calls into the kernels of mylibrary; see mylibrary.stats()."""
+
+from __future__ import division, print_function, absolute_import
+
+cimport cython
+
+from libc.stdint cimport int64_t
+from libc.string cimport memset
+from posix.time  cimport clock_gettime, timespec, CLOCK_MONOTONIC
+
+import os
+
+
+# Buckets of the call-size histogram: bucket k counts calls with between
+# 2**(k-1) and 2**k - 1 elements (bucket 0: no elements).
+#
+cdef enum:
+    _NBUCKETS = 64
+
+cdef struct _Counter:
+    int64_t calls
+    int64_t elements
+    int64_t bytes_in
+    int64_t bytes_out
+    double  seconds
+    int64_t histogram[_NBUCKETS]
+
+cdef _Counter _counters[NCOUNTERS]
+
+# Serializes updates and reads of _counters; the GIL doesn't, on free-threaded
+# Python (where it is disabled).
+#
+cdef cython.pymutex _lock
+
+# Names of the counters, in the order of the enum in _stats.pxd
+#
+_names = ("compute.f", "compute.map", "dostuff.hello", "dostuff.hello_many")
+
+enabled = os.environ.get("MYLIBRARY_STATS", "0") == "1"
+memset(_counters, 0, sizeof(_counters))
+
+
+cdef double now() noexcept nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + 1e-9 * ts.tv_nsec
+
+
+cdef void record(int counter, Py_ssize_t elements, Py_ssize_t bytes_in, Py_ssize_t bytes_out,
+                 double seconds) noexcept:
+    cdef _Counter* c = &_counters[counter]
+    cdef int k = 0
+    cdef size_t v = elements
+    while v:
+        v >>= 1
+        k += 1
+    with _lock:
+        c.calls += 1
+        c.elements += elements
+        c.bytes_in += bytes_in
+        c.bytes_out += bytes_out
+        c.seconds += seconds
+        c.histogram[min(k, _NBUCKETS - 1)] += 1
+
+
+def enable(flag=True):
+    global enabled
+    enabled = bool(flag)
+
+
+def is_enabled():
+    return enabled
+
+
+def reset():
+    with _lock:
+        memset(_counters, 0, sizeof(_counters))
+
+
+def stats(reset_counters=False):
+    cdef _Counter[NCOUNTERS] counters
+    cdef _Counter* c
+    cdef int i, k
+    with _lock:
+        counters = _counters
+        if reset_counters:
+            memset(_counters, 0, sizeof(_counters))
+    result = {}
+    for i, name in enumerate(_names):
+        c = &counters[i]
+        result[name] = dict(calls=c.calls, elements=c.elements, bytes_in=c.bytes_in,
+                            bytes_out=c.bytes_out, seconds=c.seconds,
+                            histogram={(<int64_t>1 << k - 1 if k else 0): c.histogram[k]
+                                       for k in range(_NBUCKETS) if c.histogram[k]})
+    return result
@@ -2,12 +2,15 @@
 # This file is part of 'miniver': https://github.com/jbweston/miniver
 #
 from collections import namedtuple
+import hashlib
 import os
 import subprocess
 import sys
 
-from distutils.command.build import build as build_orig
-from setuptools.command.sdist import sdist as sdist_orig
+# Note: This module is imported (lazily) at runtime, when mylibrary.__version__ is
+# first accessed. To keep that cheap, setuptools is only imported when 'cmdclass'
+# is requested by setup.py, and git is only run if the version for the current
+# state of the checkout is not cached yet (see get_version()).
 
 Version = namedtuple('Version', ('release', 'dev', 'labels'))
 
@@ -19,24 +22,142 @@ package_name = os.path.basename(package_root)
 distr_root = os.path.dirname(package_root)
 
 STATIC_VERSION_FILE = '_static_version.py'
+VERSION_CACHE_FILE = package_name + '_version_cache'
+# The version is only cached in checkouts that have been built with setup.py
+CACHE_DIR = os.path.join(distr_root, 'build')
 
 
-def get_version(version_file=STATIC_VERSION_FILE):
+def get_version(version_file=STATIC_VERSION_FILE, cached=True):
     version_info = {}
     with open(os.path.join(package_root, version_file), 'rb') as f:
         exec(f.read(), {}, version_info)
     version = version_info['version']
     if version == "__use_git__":
+        # Running git takes tens to hundreds of milliseconds, so the result
+        # is cached (see read_cached_version()); the key is read without
+        # running git.
+        git_dir, head = get_git_head()
+        key = "{}:{}".format(head, get_git_state(git_dir)) if head else None
+        if cached:
+            version = read_cached_version(key)
+            if version:
+                return version
         version = get_version_from_git()
         if not version:
             version = get_version_from_git_archive(version_info)
         if not version:
             version = Version("unknown", None, None)
-        return pep440_format(version)
+        version = pep440_format(version)
+        write_cached_version(key, version)
+        return version
     else:
         return version
 
 
+def get_git_head():
+    """Return the .git directory of distr_root and the commit hash of its HEAD.
+
+Returns (None, None) if distr_root is not the top-level directory of a git
+checkout, or if HEAD cannot be resolved (e.g. a branch without commits).
+"""
+    git_dir = os.path.join(distr_root, '.git')
+    try:
+        if os.path.isfile(git_dir):
+            # Worktrees and submodules: '.git' is a file pointing to the git directory
+            with open(git_dir) as f:
+                content = f.read().strip()
+            if not content.startswith('gitdir:'):
+                return None, None
+            git_dir = os.path.join(distr_root, content[len('gitdir:'):].strip())
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+    except (IOError, OSError):
+        return None, None
+    if not head.startswith('ref:'):
+        return git_dir, head  # detached HEAD
+
+    # Branches of worktrees live in the common git directory
+    ref = head[len('ref:'):].strip()
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            common_dir = os.path.join(git_dir, f.read().strip())
+    except (IOError, OSError):
+        pass
+    for d in (git_dir, common_dir):
+        try:
+            with open(os.path.join(d, ref)) as f:
+                return git_dir, f.read().strip()
+        except (IOError, OSError):
+            pass
+    try:
+        with open(os.path.join(common_dir, 'packed-refs')) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return git_dir, parts[0]
+    except (IOError, OSError):
+        pass
+    return None, None
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except (IOError, OSError):
+        return "-"
+    return "{}.{}".format(st.st_mtime_ns, st.st_size)
+
+
+def get_git_state(git_dir):
+    """Return a string that changes whenever the git index or the tags change.
+
+This covers staging and committing (.git/index), and adding, moving or
+deleting tags (the files in refs/tags, and packed-refs).
+"""
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            common_dir = os.path.join(git_dir, f.read().strip())
+    except (IOError, OSError):
+        pass
+    parts = [_stat_key(os.path.join(git_dir, 'index')),
+             _stat_key(os.path.join(common_dir, 'packed-refs'))]
+    for root, dirs, files in os.walk(os.path.join(common_dir, 'refs', 'tags')):
+        dirs.sort()
+        parts.append(_stat_key(root))
+        parts.extend(_stat_key(os.path.join(root, name)) for name in sorted(files))
+    return hashlib.sha1(" ".join(parts).encode()).hexdigest()
+
+
+def read_cached_version(key):
+    """Return the version cached for key (see get_version()), or None.
+
+The key covers HEAD, the index and the tags, but not edits to tracked files
+that have not been staged: a cached version may lack the "dirty" label until
+the index changes (e.g. with git status or git add).
+"""
+    if not key:
+        return None
+    try:
+        with open(os.path.join(CACHE_DIR, VERSION_CACHE_FILE)) as f:
+            cached_key, version = f.read().split()
+    except (IOError, OSError, ValueError):
+        return None
+    return version if cached_key == key else None
+
+
+def write_cached_version(key, version):
+    # Best effort, and only in built checkouts (see CACHE_DIR)
+    if not key or not os.path.isdir(CACHE_DIR):
+        return
+    try:
+        with open(os.path.join(CACHE_DIR, VERSION_CACHE_FILE), 'w') as f:
+            f.write("{} {}\n".format(key, version))
+    except (IOError, OSError):
+        pass
+
+
 def pep440_format(version_info):
     release, dev, labels = version_info
 
@@ -131,11 +252,22 @@ def get_version_from_git_archive(version_info):
         return Version('unknown', dev=None, labels=["g{}".format(git_hash)])
 
 
-__version__ = get_version()
+# '__version__' and 'cmdclass' are computed on first access.
 
-# The following section defines a module global 'cmdclass',
-# which can be used from setup.py. The 'package_name' and
-# '__version__' module globals are used (but not modified).
+def __getattr__(name):
+    global __version__, cmdclass
+    if name == '__version__':
+        __version__ = get_version()
+        return __version__
+    if name == 'cmdclass':
+        cmdclass = _get_cmdclass()
+        return cmdclass
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+# The following section defines the module global 'cmdclass',
+# which can be used from setup.py. The 'package_name' module
+# global is used (but not modified).
 
 def _write_version(fname):
     # This could be a hard link, so try to delete it first.  Is there any way
@@ -146,25 +278,27 @@ def _write_version(fname):
         pass
     with open(fname, 'w') as f:
         f.write("# This file has been created by setup.py.\n"
-                "version = '{}'\n".format(__version__))
-
+                "version = '{}'\n".format(get_version(cached=False)))
 
-# The following classes subclass `object` to become new-style classes with
-# Python 2; and calling super() with arguments is another workaround in order
-# to support Python 2.
 
-class _build(build_orig, object):
-    def run(self):
-        super(_build, self).run()
-        _write_version(os.path.join(self.build_lib, package_name,
-                                    STATIC_VERSION_FILE))
+def _get_cmdclass():
+    from distutils.command.build import build as build_orig
+    from setuptools.command.sdist import sdist as sdist_orig
 
+    # The following classes subclass `object` to become new-style classes with
+    # Python 2; and calling super() with arguments is another workaround in order
+    # to support Python 2.
 
-class _sdist(sdist_orig, object):
-    def make_release_tree(self, base_dir, files):
-        super(_sdist, self).make_release_tree(base_dir, files)
-        _write_version(os.path.join(base_dir, package_name,
-                                    STATIC_VERSION_FILE))
+    class _build(build_orig, object):
+        def run(self):
+            super(_build, self).run()
+            _write_version(os.path.join(self.build_lib, package_name,
+                                        STATIC_VERSION_FILE))
 
+    class _sdist(sdist_orig, object):
+        def make_release_tree(self, base_dir, files):
+            super(_sdist, self).make_release_tree(base_dir, files)
+            _write_version(os.path.join(base_dir, package_name,
+                                        STATIC_VERSION_FILE))
 
-cmdclass = dict(sdist=_sdist, build=_build)
+    return dict(sdist=_sdist, build=_build)
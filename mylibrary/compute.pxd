@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+#
+# Cython-level declarations for mylibrary.compute, available for cimport from other Cython modules.
+#
+# These are the kernels behind compute.f(), callable without the GIL and without
+# any Python-level overhead, e.g. from within a cython.parallel.prange loop:
+#
+#     cimport mylibrary.compute as compute
+#
+#     for i in prange(n, nogil=True):
+#         y[i] = compute.sqrt_d(x[i])
+#
+# The array kernels use the SIMD instruction set selected at runtime (see
+# compute.get_simd_kernel()); x and out may be the same array, but must not
+# overlap otherwise.
+
+from __future__ import absolute_import
+
+from libc.stdint cimport uint64_t
+
+# Square root of a single element
+cdef double   sqrt_d(double x) noexcept nogil
+cdef float    sqrt_f(float x) noexcept nogil
+cdef uint64_t isqrt(uint64_t x) noexcept nogil  # exact, floor(sqrt(x))
+
+# Square roots of n contiguous elements
+cdef void sqrt_array_d(const double* x, double* out, Py_ssize_t n) noexcept nogil
+cdef void sqrt_array_f(const float* x, float* out, Py_ssize_t n) noexcept nogil
@@ -3,17 +3,538 @@
 # cython: wraparound  = False
 # cython: boundscheck = False
 # cython: cdivision   = True
+# cython: freethreading_compatible = True
 """Example Cython module for numerical computation mixing libc.math and NumPy."""
 
 from __future__ import division, print_function, absolute_import
 
 
 # import something from libm
-from libc.math cimport sqrt as c_sqrt
+from libc.math cimport sqrt as c_sqrt, sqrtf as c_sqrtf
+
+from libc.stdint cimport int8_t, int16_t, int32_t, int64_t
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t
+
+# OpenMP-parallel loops; these run serially if the module is built without OpenMP
+from cython.parallel cimport prange
+
+cimport cython
+
+import atexit
+import mmap
+import os
+import tempfile
+import threading
+import warnings
 
 # we use NumPy for memory allocation
 import numpy as np
 
+# Argument handling, blocking and asyncio, shared with the NumPy backend
+from mylibrary import _compute_common as _common
+from mylibrary._compute_common import DEFAULT_CHUNK_SIZE, set_async_workers, get_async_workers
+
+# ...and its C API to register a ufunc
+cimport numpy as cnp
+
+# Runtime counters, see mylibrary.stats()
+cimport mylibrary._stats as _stats
+
+cnp.import_array()
+cnp.import_ufunc()
+
+
+# Which implementation of mylibrary.compute this is; the pure NumPy fallback
+# (_compute_numpy.py) has "numpy", see mylibrary.backend().
+#
+BACKEND = "cython"
+
+
+# Tell at runtime whether the C compiler had OpenMP enabled (see setup.py).
+#
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    #define MYLIBRARY_HAVE_OPENMP 1
+    #else
+    #define MYLIBRARY_HAVE_OPENMP 0
+    #endif
+    """
+    bint MYLIBRARY_HAVE_OPENMP
+
+HAVE_OPENMP = bool(MYLIBRARY_HAVE_OPENMP)
+
+# Vectorized float and double kernels, selected at runtime (see _sqrt_simd.h)
+#
+cdef extern from "_sqrt_simd.h" nogil:
+    int  mylib_simd_current()
+    bint mylib_simd_supported(int level)
+    bint mylib_simd_select(int level)
+    void mylib_sqrt_d(const double *x, double *y, Py_ssize_t n)
+    void mylib_sqrt_f(const float *x, float *y, Py_ssize_t n)
+    void mylib_sqrt_d_prec(const double *x, double *y, Py_ssize_t n, int precision)
+    void mylib_sqrt_f_prec(const float *x, float *y, Py_ssize_t n, int precision)
+    Py_ssize_t mylib_count_invalid_d(const double *x, Py_ssize_t n)
+    Py_ssize_t mylib_count_invalid_f(const float *x, Py_ssize_t n)
+
+# Floating-point exception flags, which NumPy checks after running ufunc loops
+#
+cdef extern from "<fenv.h>" nogil:
+    int FE_INVALID
+    int feraiseexcept(int excepts)
+
+# C99 complex square roots (Cython's "float complex" and "double complex" are the C99 types)
+#
+cdef extern from "<complex.h>" nogil:
+    float complex  c_csqrtf "csqrtf" (float complex z)
+    double complex c_csqrt  "csqrt"  (double complex z)
+
+
+#-------------------------------------------------------------------------------
+# Kernels
+#-------------------------------------------------------------------------------
+
+ctypedef float complex  float_complex
+ctypedef double complex double_complex
+
+# All element types f() supports natively; each is computed in its own type,
+# without converting to double and back.
+#
+ctypedef fused numeric:
+    float
+    double
+    float_complex
+    double_complex
+    int8_t
+    int16_t
+    int32_t
+    int64_t
+    uint8_t
+    uint16_t
+    uint32_t
+    uint64_t
+
+# Exact integer square root, floor(sqrt(v)).
+#
+cdef inline uint64_t _isqrt(uint64_t v) noexcept nogil:
+    cdef uint64_t r = <uint64_t>c_sqrt(<double>v)
+    # Above 2**53, rounding v to double can put r off by one in either direction
+    while r > 0 and r > v // r:
+        r -= 1
+    while r + 1 <= v // (r + 1):
+        r += 1
+    return r
+
+
+cdef inline bint _negative(numeric v) noexcept nogil:
+    if numeric is int8_t or numeric is int16_t or numeric is int32_t or numeric is int64_t:
+        return v < 0
+    else:
+        return False
+
+
+# sqrt() in the type of v; negative integers (see _negative()) give 0.
+#
+cdef inline numeric _sqrt(numeric v) noexcept nogil:
+    if numeric is float:
+        return c_sqrtf(v)
+    elif numeric is double:
+        return c_sqrt(v)
+    elif numeric is float_complex:
+        return c_csqrtf(v)
+    elif numeric is double_complex:
+        return c_csqrt(v)
+    elif _negative(v):
+        return 0
+    else:
+        return <numeric>_isqrt(<uint64_t>v)
+
+
+# sqrt() of a contiguous block of n elements, vectorized for float and double;
+# precision is the index in _precisions (only used for float and double).
+#
+cdef inline void _sqrt_block(const numeric* x, numeric* res, Py_ssize_t n, int precision=0) noexcept nogil:
+    cdef Py_ssize_t j
+    if numeric is float:
+        mylib_sqrt_f_prec(x, res, n, precision)
+    elif numeric is double:
+        mylib_sqrt_d_prec(x, res, n, precision)
+    else:
+        for j in range(n):
+            res[j] = _sqrt(x[j])
+
+
+# Values of errors= for f(), by index; see f().
+#
+_error_policies = ("ignore", "raise", "clip", "nan_count")
+
+cdef enum:
+    _ERRORS_IGNORE
+    _ERRORS_RAISE
+    _ERRORS_CLIP
+    _ERRORS_NAN_COUNT
+
+# Float and double blocks are checked in tiles of this many elements, just
+# before the tile is square-rooted, so that checking reads x from the cache
+# instead of memory. (A multiple of 16, so that all tiles of a block start at
+# the same offset within a 64-byte cache line.)
+#
+cdef enum:
+    _TILE = 1024
+
+
+# Whether v is outside the domain of sqrt(): negative (but not -0.0) or NaN.
+#
+cdef inline bint _invalid(numeric v) noexcept nogil:
+    if numeric is float or numeric is double:
+        return not (v >= 0)
+    else:
+        return _negative(v)
+
+
+# sqrt() of v, with invalid v handled according to errors: clipped to 0 with
+# _ERRORS_CLIP; otherwise NaN for float and double, and for integers 0, or -1
+# with _ERRORS_RAISE (so that f() can find it in the result).
+#
+cdef inline numeric _sqrt_checked(numeric v, int errors) noexcept nogil:
+    if numeric is float or numeric is double:
+        if errors == _ERRORS_CLIP and v < 0:
+            return 0
+        return _sqrt(v)
+    elif numeric is int8_t or numeric is int16_t or numeric is int32_t or numeric is int64_t:
+        if v < 0:
+            return -1 if errors == _ERRORS_RAISE else 0
+        return _sqrt(v)
+    else:
+        return _sqrt(v)
+
+
+# _sqrt_block() under the policy errors; return the number of invalid inputs
+# (for float and double, 0 with _ERRORS_IGNORE, which skips the check).
+#
+cdef inline Py_ssize_t _sqrt_block_checked(const numeric* x, numeric* res, Py_ssize_t n, int precision,
+                                           int errors) noexcept nogil:
+    cdef Py_ssize_t j, m, tile_bad
+    cdef Py_ssize_t start = 0
+    cdef Py_ssize_t bad = 0
+    if numeric is float or numeric is double:
+        if errors == _ERRORS_IGNORE:
+            _sqrt_block(x, res, n, precision)
+            return 0
+        while start < n:
+            m = min(<Py_ssize_t>_TILE, n - start)
+            if numeric is float:
+                tile_bad = mylib_count_invalid_f(&x[start], m)
+            else:
+                tile_bad = mylib_count_invalid_d(&x[start], m)
+            if tile_bad and errors == _ERRORS_CLIP:
+                for j in range(start, start + m):
+                    res[j] = _sqrt_checked(x[j], errors)
+            else:
+                _sqrt_block(&x[start], &res[start], m, precision)
+            bad += tile_bad
+            start += m
+        return bad
+    else:
+        for j in range(n):
+            bad += _invalid(x[j])
+            res[j] = _sqrt_checked(x[j], errors)
+        return bad
+
+
+# Compute res = sqrt(x) under the policy errors; return the number of invalid
+# inputs, as _sqrt_block_checked().
+#
+# Every element is read before it is written, so res may alias x. x is const,
+# so that read-only buffers (np.memmap(mode="r"), np.frombuffer(bytes), ...)
+# are accepted without a copy.
+#
+# Indices are Py_ssize_t, so arrays may have more than 2**31 elements.
+#
+# Large arrays are split into one contiguous block per thread
+# (schedule="static"), which keeps each thread streaming through memory.
+# Block lengths are rounded up to multiples of 16 elements, so that for float
+# and double, all blocks start at the same offset within a 64-byte cache line
+# as the first (and threads share no cache lines if x and res are aligned).
+# Nothing needs to be aligned, though: the SIMD kernels use unaligned loads
+# and stores.
+#
+def _sqrt_contig( const numeric[::1] x, numeric[::1] res, int nthreads, int precision=0,
+                  int errors=_ERRORS_IGNORE ):
+    cdef Py_ssize_t n = x.shape[0]
+    cdef Py_ssize_t t, start
+    cdef Py_ssize_t chunk = ((n + nthreads - 1) // nthreads + 15) & ~15
+    cdef Py_ssize_t bad = 0
+    if n == 0:
+        return 0
+    with nogil:
+        if nthreads > 1:
+            for t in prange(nthreads, num_threads=nthreads, schedule="static"):
+                start = t * chunk
+                if start < n:
+                    bad += _sqrt_block_checked(&x[start], &res[start], min(chunk, n - start), precision, errors)
+        else:
+            bad = _sqrt_block_checked(&x[0], &res[0], n, precision, errors)
+    return bad
+
+
+# Compute sqrt() of a run of n elements with byte strides sx and sy under the
+# policy errors; return the number of invalid inputs, as _sqrt_block_checked()
+# (so with _ERRORS_IGNORE, that of negative integers only). Contiguous runs of
+# float and double go to the SIMD kernels.
+#
+cdef inline Py_ssize_t _sqrt_run(numeric* x, numeric* y, Py_ssize_t n, Py_ssize_t sx, Py_ssize_t sy,
+                                 int errors) noexcept nogil:
+    cdef Py_ssize_t j
+    cdef Py_ssize_t bad = 0
+    cdef numeric v
+    if numeric is float or numeric is double:
+        if sx == sizeof(numeric) and sy == sizeof(numeric):
+            return _sqrt_block_checked(x, y, n, 0, errors)
+        if errors == _ERRORS_IGNORE:
+            for j in range(n):
+                (<numeric*>(<char*>y + j * sy))[0] = _sqrt((<numeric*>(<char*>x + j * sx))[0])
+            return 0
+    for j in range(n):
+        v = (<numeric*>(<char*>x + j * sx))[0]
+        bad += _invalid(v)
+        (<numeric*>(<char*>y + j * sy))[0] = _sqrt_checked(v, errors)
+    return bad
+
+
+# Types by index, for _sqrt_run_typed()
+#
+_types = tuple(np.dtype(t) for t in (np.int8,    np.uint8,   np.int16,     np.uint16,
+                                     np.int32,   np.uint32,  np.int64,     np.uint64,
+                                     np.float32, np.float64, np.complex64, np.complex128))
+_type_index = {t: k for k, t in enumerate(_types)}
+
+
+# The same, for the element type _types[k] given at runtime.
+#
+cdef Py_ssize_t _sqrt_run_typed(int k, char* x, char* y, Py_ssize_t n, Py_ssize_t sx, Py_ssize_t sy,
+                                int errors=_ERRORS_IGNORE) noexcept nogil:
+    if   k == 0:  return _sqrt_run(<int8_t*>x,         <int8_t*>y,         n, sx, sy, errors)
+    elif k == 1:  return _sqrt_run(<uint8_t*>x,        <uint8_t*>y,        n, sx, sy, errors)
+    elif k == 2:  return _sqrt_run(<int16_t*>x,        <int16_t*>y,        n, sx, sy, errors)
+    elif k == 3:  return _sqrt_run(<uint16_t*>x,       <uint16_t*>y,       n, sx, sy, errors)
+    elif k == 4:  return _sqrt_run(<int32_t*>x,        <int32_t*>y,        n, sx, sy, errors)
+    elif k == 5:  return _sqrt_run(<uint32_t*>x,       <uint32_t*>y,       n, sx, sy, errors)
+    elif k == 6:  return _sqrt_run(<int64_t*>x,        <int64_t*>y,        n, sx, sy, errors)
+    elif k == 7:  return _sqrt_run(<uint64_t*>x,       <uint64_t*>y,       n, sx, sy, errors)
+    elif k == 8:  return _sqrt_run(<float*>x,          <float*>y,          n, sx, sy, errors)
+    elif k == 9:  return _sqrt_run(<double*>x,         <double*>y,         n, sx, sy, errors)
+    elif k == 10: return _sqrt_run(<float_complex*>x,  <float_complex*>y,  n, sx, sy, errors)
+    else:         return _sqrt_run(<double_complex*>x, <double_complex*>y, n, sx, sy, errors)
+
+
+# Maximum number of dimensions of a NumPy array (64 since NumPy 2, 32 before)
+#
+cdef enum:
+    _MAXDIMS = 64
+
+# Describe the elements of x and y (of the same shape) as nested loops: fill
+# shape, sx and sy (byte strides of x and y) from the outermost to the
+# innermost loop, and return the number of loops (0 if x has no elements).
+#
+# As with np.nditer(order="K"), the loops follow the memory order of x, and
+# dimensions of length 1 are dropped and adjacent ones merged where the
+# strides of both x and y allow, so e.g. a column of a 2-D array is one loop.
+#
+cdef int _loops(cnp.ndarray x, cnp.ndarray y, Py_ssize_t* shape, Py_ssize_t* sx, Py_ssize_t* sy):
+    cdef int d, i, ndim = 0
+    cdef Py_ssize_t n, a, b
+    if cnp.PyArray_SIZE(x) == 0:
+        return 0
+    for d in range(cnp.PyArray_NDIM(x)):
+        n = cnp.PyArray_DIM(x, d)
+        if n == 1:
+            continue
+        a = cnp.PyArray_STRIDE(x, d)
+        b = cnp.PyArray_STRIDE(y, d)
+        # Insertion by decreasing |stride of x|
+        i = ndim
+        while i > 0 and abs(sx[i - 1]) < abs(a):
+            shape[i], sx[i], sy[i] = shape[i - 1], sx[i - 1], sy[i - 1]
+            i -= 1
+        shape[i], sx[i], sy[i] = n, a, b
+        ndim += 1
+    if ndim == 0:
+        shape[0], sx[0], sy[0] = 1, 0, 0
+        return 1
+    # Merge each loop into the next inner one, if it continues it in both arrays
+    i = ndim - 1
+    for d in range(ndim - 2, -1, -1):
+        if sx[d] == sx[i] * shape[i] and sy[d] == sy[i] * shape[i]:
+            shape[i] *= shape[d]
+        else:
+            i -= 1
+            shape[i], sx[i], sy[i] = shape[d], sx[d], sy[d]
+    for d in range(i, ndim):
+        shape[d - i], sx[d - i], sy[d - i] = shape[d], sx[d], sy[d]
+    return ndim - i
+
+
+# Compute the nested loops from _loops() for the element type _types[k] under
+# the policy errors, on up to nthreads threads; return the number of invalid
+# inputs, as _sqrt_run().
+#
+# The innermost loop is a run for _sqrt_run_typed(); the runs are shared among
+# the threads, or, if there is only one, split into one piece per thread.
+#
+cdef Py_ssize_t _sqrt_loops(int k, char* x, char* y, int ndim, const Py_ssize_t* shape,
+                            const Py_ssize_t* sx, const Py_ssize_t* sy, int errors, int nthreads) noexcept nogil:
+    cdef Py_ssize_t r, q, i, ox, oy, start
+    cdef Py_ssize_t n = shape[ndim - 1]
+    cdef Py_ssize_t nruns = 1
+    cdef Py_ssize_t chunk = (n + nthreads - 1) // nthreads
+    cdef Py_ssize_t bad = 0
+    cdef int d
+    for d in range(ndim - 1):
+        nruns *= shape[d]
+    if nruns == 1 and nthreads > 1:
+        for r in prange(nthreads, num_threads=nthreads, schedule="static"):
+            start = r * chunk
+            if start < n:
+                bad += _sqrt_run_typed(k, x + start * sx[ndim - 1], y + start * sy[ndim - 1],
+                                       min(chunk, n - start), sx[ndim - 1], sy[ndim - 1], errors)
+    elif nthreads > 1:
+        for r in prange(nruns, num_threads=nthreads, schedule="static"):
+            # Offsets of run r, from its index in the outer loops
+            q = r
+            ox = 0
+            oy = 0
+            d = ndim - 2
+            while d >= 0:
+                i = q % shape[d]
+                q = q // shape[d]
+                ox = ox + i * sx[d]
+                oy = oy + i * sy[d]
+                d = d - 1
+            bad += _sqrt_run_typed(k, x + ox, y + oy, n, sx[ndim - 1], sy[ndim - 1], errors)
+    else:
+        for r in range(nruns):
+            q = r
+            ox = 0
+            oy = 0
+            for d in range(ndim - 2, -1, -1):
+                i = q % shape[d]
+                q = q // shape[d]
+                ox += i * sx[d]
+                oy += i * sy[d]
+            bad += _sqrt_run_typed(k, x + ox, y + oy, n, sx[ndim - 1], sy[ndim - 1], errors)
+    return bad
+
+
+#-------------------------------------------------------------------------------
+# Thread count
+#-------------------------------------------------------------------------------
+
+# Each thread gets at least this many elements; smaller inputs run serially,
+# so that tiny calls don't pay for starting up the OpenMP thread team.
+#
+cdef Py_ssize_t _min_elements_per_thread = 32768
+
+# Read once per call of f(), so that a concurrent set_num_threads() (from
+# another thread, on free-threaded Python) takes effect for the next call.
+#
+cdef int _num_threads = 1
+
+
+def set_num_threads(n=None):
+    """Set the process-wide default number of threads used by f().
+
+Parameters:
+    n : int or None
+        Number of threads (>= 1). If None, use the environment variable
+        MYLIBRARY_NUM_THREADS if set, otherwise all CPUs available to
+        this process.
+
+Has no effect (other than validation) if the module was built without OpenMP.
+"""
+    global _num_threads
+    if n is None:
+        n = os.environ.get("MYLIBRARY_NUM_THREADS") or _common.available_cpus()
+    _num_threads = _common.check_num_threads(n)
+
+
+def get_num_threads():
+    """Return the process-wide default number of threads used by f().
+
+Returns 1 if the module was built without OpenMP.
+"""
+    return _num_threads if HAVE_OPENMP else 1
+
+
+cdef int _effective_num_threads(num_threads, Py_ssize_t n) except -1:
+    cdef int nthreads = _num_threads if num_threads is None else _common.check_num_threads(num_threads)
+    if not HAVE_OPENMP:
+        return 1
+    return <int>max(1, min(nthreads, n // _min_elements_per_thread))
+
+
+set_num_threads()
+
+
+#-------------------------------------------------------------------------------
+# SIMD kernel selection
+#-------------------------------------------------------------------------------
+
+# Names of the kernel levels in _sqrt_simd.h, in increasing order
+#
+_simd_kernels = ("generic", "sse2", "avx2", "avx512")
+
+
+def supported_simd_kernels():
+    """Return the names of the SIMD kernels this CPU supports, best last.
+
+"generic" (plain C) is always supported.
+"""
+    return tuple(name for level, name in enumerate(_simd_kernels) if mylib_simd_supported(level))
+
+
+def set_simd_kernel(name=None):
+    """Select the SIMD kernel used by f() for float32 and float64 arrays.
+
+All kernels give identical results; they differ only in speed.
+
+Parameters:
+    name : str or None
+        One of "generic", "sse2", "avx2" and "avx512". If None, use the best
+        kernel the CPU supports, but not above the environment variable
+        MYLIBRARY_SIMD if that is set.
+
+Raises:
+    ValueError
+        If name is unknown, or not supported by this CPU.
+"""
+    cdef int level
+    if name is None:
+        cap = os.environ.get("MYLIBRARY_SIMD")
+        if cap is not None and cap not in _simd_kernels:
+            raise ValueError("unknown SIMD kernel {!r} in MYLIBRARY_SIMD; expected one of {}".format(cap, _simd_kernels))
+        level = len(_simd_kernels) - 1 if cap is None else _simd_kernels.index(cap)
+        while not mylib_simd_supported(level):
+            level -= 1
+    elif name in _simd_kernels:
+        level = _simd_kernels.index(name)
+    else:
+        raise ValueError("unknown SIMD kernel {!r}; expected one of {}".format(name, _simd_kernels))
+    if not mylib_simd_select(level):
+        raise ValueError("SIMD kernel {!r} is not supported on this CPU".format(name))
+
+
+def get_simd_kernel():
+    """Return the name of the SIMD kernel currently used by f()."""
+    return _simd_kernels[mylib_simd_current()]
+
+
+set_simd_kernel()
+
+
+#-------------------------------------------------------------------------------
+# Public API
+#-------------------------------------------------------------------------------
 
 # The docstring conforms to the NumPyDoc style:
 #
@@ -26,20 +547,107 @@ import numpy as np
 # We use the buffer protocol:
 #    http://cython.readthedocs.io/en/latest/src/userguide/memoryviews.html
 #
-def f( double[::1] x ):
+
+# Values of precision= for f(), in the order of MYLIB_PRECISION_* in _sqrt_simd.h
+#
+_precisions = ("exact", "fast", "approx")
+
+
+def f( x, out=None, num_threads=None, precision="exact", like_input=False, errors=None ):
     """Example math function.
 
 Take the square root, elementwise.
 
+The computation is done in the type of x: float32 and complex64 inputs use
+single-precision sqrtf() and csqrtf(), and integer inputs get the exact
+integer square root floor(sqrt(x)).
+
+Arrays of any shape and memory layout are accepted without copying, and so
+are read-only arrays (e.g. np.memmap(mode="r") or np.frombuffer(bytes)) and
+other objects exporting the buffer protocol (array.array, memoryview,
+bytearray, ...). The result has the same shape, and the same memory layout
+as x if x is contiguous. Contiguous arrays (C or Fortran order) are
+processed as one flat block; other arrays as strided 1-D runs, all in a
+single pass over the data without the GIL.
+
+Large inputs are split across threads (if the module was built with OpenMP);
+inputs too small to benefit are processed serially.
+
+With precision="fast" or "approx", contiguous float32 and float64 arrays are
+computed from the hardware reciprocal square root estimate (x86 SIMD kernels
+only, see get_simd_kernel()), trading accuracy for speed. The maximum
+relative errors are:
+
+    precision   float32   float64   method
+    "exact"     0.5 ULP   0.5 ULP   correctly rounded sqrt()
+    "fast"      4e-7      5e-16     estimate plus Newton steps (a few ULP)
+    "approx"    4e-4      4e-4      estimate only (1e-4 with "avx512")
+
+Zero, subnormal, infinite, negative and NaN inputs always get the exact
+result, and so do all other dtypes, non-contiguous arrays, and the "generic"
+kernel (e.g. on non-x86 CPUs). For float64, "fast" uses the estimate with the
+"avx512" kernel only; with the others, it is no faster than "exact".
+
+Negative inputs (but not -0.0) and NaN are invalid; errors= selects what
+happens to them, checked in the same pass over the data:
+
+    errors        result of an invalid input     and then
+    "ignore"      NaN; integers: 0               -
+    "raise"       undefined                      ValueError, with the index
+                                                 of the first one
+    "clip"        0 (NaN stays NaN)              -
+    "nan_count"   as for "ignore"                return their number, too
+
+The default is "ignore" for float and complex inputs (complex inputs are
+never invalid), and "raise" for integers. Checking float32 and float64
+inputs re-reads small tiles of x while they are in the cache, which costs
+much less than a separate pass over x (or the result) in NumPy.
+
 Parameters:
-    x : rank-1 np.array of double
-        Numbers to be square-rooted.
+    x : np.array of float32, float64, complex64, complex128 or (u)int8...64
+        Numbers to be square-rooted; or anything np.asarray() turns into
+        such an array without copying, like a buffer of doubles.
+    out : np.array or writable buffer, optional
+        Preallocated array to store the result in; must have the same shape
+        and dtype as x, but may have any memory layout. May be x itself,
+        for in-place operation.
+    num_threads : int, optional
+        Maximum number of threads to use for this call. Defaults to the
+        process-wide setting, see set_num_threads().
+    precision : str, optional
+        "exact" (default), "fast" or "approx"; see above.
+    like_input : bool, optional
+        If True (and out is None), return the result in a new object of the
+        type of x: an array.array, bytearray (also for bytes) or memoryview.
+        Default False: return an np.array.
+    errors : str, optional
+        "ignore", "raise", "clip" or "nan_count"; see above.
 
 Return value:
-    rank-1 np.array of double
-        The square roots.
+    np.array of the same shape and dtype as x
+        The square roots. If out was given, this is out.
+    (np.array, int), with errors="nan_count"
+        The square roots, and the number of invalid inputs.
+
+Raises:
+    TypeError
+        If the dtype of x is not supported.
+    ValueError
+        If out does not match x, if there are invalid inputs and errors is
+        "raise", or if precision or errors is unknown.
 """
-    cdef int n = x.shape[0]
+    if precision not in _precisions:
+        raise ValueError("unknown precision {!r}; expected one of {}".format(precision, _precisions))
+    if errors is not None and errors not in _error_policies:
+        raise ValueError("unknown errors {!r}; expected one of {}".format(errors, _error_policies))
+    obj, x = x, _common.asarray(x)
+    if x.dtype not in _type_index:
+        raise TypeError("f() not supported for dtype {}".format(x.dtype))
+    if errors is None:
+        errors = "ignore" if x.dtype.kind in "fc" else "raise"
+    cdef int policy = _error_policies.index(errors)
+    if like_input and out is None:
+        out = _common.empty_like_input(obj, x)
 
     # np.empty() is a pretty good mechanism for dynamic allocation of arrays,
     # as long as memory allocation can be done in Python parts of the code (no "nogil").
@@ -47,22 +655,678 @@ Return value:
     # If you absolutely need to dynamically allocate memory in nogil code,
     # then "from libc.stdlib cimport malloc, free", and be ready for pain.
     #
-    cdef double[::1] out = np.empty( (n,), dtype=np.float64, order="C" )
-
-    # Memoryview slices don't do  out[:] = ...  assignments, so we loop.
-    #
-    # Everything is typed, though, so the loop will run at C speed.
-    #
-    # As a bonus, we release the GIL, so any other Python threads
-    # can proceed while this one is computing.
+    # Steady-state callers can avoid the allocation altogether by passing out.
     #
-    # We could also "cimport cython.parallel" and "for j in cython.parallel.prange(n):"
-    # if we wanted (and then link this module with OpenMP in setup.py).
-    #
-    cdef int j
+    res = _common.check_out(x, out)
+
+    cdef Py_ssize_t bad = 0
+    cdef Py_ssize_t shape[_MAXDIMS]
+    cdef Py_ssize_t sx[_MAXDIMS]
+    cdef Py_ssize_t sy[_MAXDIMS]
+    cdef int ndim, k, nthreads
+    cdef double t0 = _stats.now() if _stats.enabled else 0.0
+    if ((x.flags.c_contiguous and res.flags.c_contiguous) or
+        (x.flags.f_contiguous and res.flags.f_contiguous)):
+        # Fast path: same memory order, so process both as flat 1-D arrays
+        bad = _sqrt_contig(x.ravel(order="K"), res.ravel(order="K"),
+                           _effective_num_threads(num_threads, x.size), _precisions.index(precision), policy)
+    else:
+        # All runs in a single call, without the GIL
+        ndim = _loops(x, res, shape, sx, sy)
+        k = _type_index[x.dtype]
+        nthreads = _effective_num_threads(num_threads, x.size)
+        if ndim:
+            with nogil:
+                bad = _sqrt_loops(k, <char*>cnp.PyArray_DATA(<cnp.ndarray>x), <char*>cnp.PyArray_DATA(<cnp.ndarray>res),
+                                  ndim, shape, sx, sy, policy, nthreads)
+    if t0 != 0.0:
+        _stats.record(_stats.COMPUTE_F, x.size, x.nbytes, res.nbytes, _stats.now() - t0)
+
+    if bad and policy == _ERRORS_RAISE:
+        raise ValueError("f() of {} at index {}".format("negative integer" if x.dtype.kind in "iu" else "negative number or NaN",
+                                                        _common.first_invalid(res)))
+
+    if out is None:
+        out = res
+    if policy == _ERRORS_NAN_COUNT:
+        return out, bad
+    return out
+
+
+#-------------------------------------------------------------------------------
+# NumPy ufunc
+#-------------------------------------------------------------------------------
+
+# The single loop function registered for all types; data holds the index
+# of the type in _ufunc_types (and _types).
+#
+# A negative integer gives 0, and raises the floating-point "invalid" flag,
+# which NumPy reports according to np.errstate() (like for np.sqrt(-1.0)).
+#
+cdef void _ufunc_loop(char** args, cnp.npy_intp* dims, cnp.npy_intp* steps, void* data) noexcept nogil:
+    if _sqrt_run_typed(<int><Py_ssize_t>data, args[0], args[1], dims[0], steps[0], steps[1]):
+        feraiseexcept(FE_INVALID)
+
+
+# One loop per type in _types; NumPy uses the first one the input can be cast
+# to safely, so _types is sorted from small to large types.
+#
+cdef enum:
+    _NTYPES = 12
+
+cdef char _ufunc_types[2 * _NTYPES]
+cdef cnp.PyUFuncGenericFunction _ufunc_loops[_NTYPES]
+cdef void* _ufunc_data[_NTYPES]
+
+cdef int _k
+for _k, _t in enumerate(_types):
+    _ufunc_types[2 * _k] = _ufunc_types[2 * _k + 1] = _t.num
+    _ufunc_loops[_k] = <cnp.PyUFuncGenericFunction>_ufunc_loop  # NumPy 2 declares dims and steps const
+    _ufunc_data[_k] = <void*><Py_ssize_t>_k
+
+sqrt = cnp.PyUFunc_FromFuncAndData(_ufunc_loops, _ufunc_data, _ufunc_types, _NTYPES, 1, 1,
+                                   cnp.PyUFunc_None, b"sqrt", b"""sqrt(x, /, out=None, *, where=True, ...)
+
+Square root, elementwise, as a NumPy ufunc.
+
+Computes the same as f(), in the dtype of x (integers get the exact integer
+square root), but with all the machinery of NumPy ufuncs: broadcasting, out=,
+where=, casting=, dtype=, and dispatch to __array_ufunc__ of array-likes.
+Runs on a single thread; see f() for the multithreaded version.
+
+A negative integer input gives 0, and is reported like invalid floating-point
+operations (see np.errstate()).
+""", 0)
+
+
+#-------------------------------------------------------------------------------
+# Streaming
+#-------------------------------------------------------------------------------
+
+def f_chunked( x, out=None, chunk_size=None, num_threads=None ):
+    """Square root of a large array, one block at a time.
+
+Like f(), but x is read and out written in blocks of about chunk_size
+elements along the first axis. With x and out memory-mapped (np.memmap),
+this processes data larger than RAM; no temporary arrays are allocated.
+
+Parameters:
+    x : np.array
+        Numbers to be square-rooted; see f() for the supported dtypes.
+    out : np.array, optional
+        Array to store the result in, e.g. an np.memmap opened with mode
+        "w+" or "r+". If None, a new in-memory array is allocated.
+    chunk_size : int, optional
+        Approximate number of elements per block; defaults to DEFAULT_CHUNK_SIZE.
+    num_threads : int, optional
+        See f().
+
+Return value:
+    np.array
+        out, or the newly allocated result array.
+"""
+    return _common.chunked(f, x, out, chunk_size, num_threads)
+
+
+def f_stream( blocks, num_threads=None ):
+    """Square root of a stream of blocks.
+
+Parameters:
+    blocks : iterable of np.array
+        Input blocks, e.g. read from a file or socket; see f() for the
+        supported dtypes. Blocks are consumed lazily, one at a time.
+    num_threads : int, optional
+        See f().
+
+Yields:
+    np.array
+        The square roots of each block, in order.
+
+Only one input and one output block need to be held in memory at a time.
+"""
+    return _common.stream(f, blocks, num_threads)
+
+
+def f_file( in_path, out_path, dtype=np.float64, chunk_size=None, num_threads=None ):
+    """Square root of a raw binary file, written to another file.
+
+Out-of-core version of f() for files of any size: in_path is read in blocks
+of chunk_size elements by a background thread, each block is computed while
+the next one is read, and written by another background thread while the
+next one is computed. At most three blocks are held in memory.
+
+Parameters:
+    in_path : str or path-like
+        File of numbers of type dtype, in native byte order and without a
+        header (e.g. written by np.ndarray.tofile()).
+    out_path : str or path-like
+        File to write the result to, in the same format; it is overwritten.
+        May be in_path itself, for in-place operation.
+    dtype : dtype, optional
+        Type of the numbers; see f() for the supported dtypes. Default float64.
+    chunk_size : int, optional
+        Number of elements per block; defaults to DEFAULT_CHUNK_SIZE. Blocks
+        of 8 to 64 MB are usually enough to saturate a disk.
+    num_threads : int, optional
+        See f().
+
+Return value:
+    dict
+        elements         number of elements processed
+        bytes            size of the input (and output) in bytes
+        seconds          elapsed time
+        throughput       bytes / seconds
+        read_seconds     time spent reading, in the background
+        compute_seconds  time spent in f()
+        write_seconds    time spent writing, in the background
+
+Raises:
+    TypeError
+        If dtype is not supported.
+    ValueError
+        If the size of in_path is not a multiple of the size of dtype, or an
+        integer input is negative (the output is then incomplete).
+    OSError
+        If a file cannot be read or written.
+"""
+    from mylibrary import _file_pipeline
+    dtype = np.dtype(dtype)
+    if dtype not in _type_index:
+        raise TypeError("f_file() not supported for dtype {}".format(dtype))
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    return _file_pipeline.run(f, in_path, out_path, dtype, chunk_size, num_threads)
+
+
+#-------------------------------------------------------------------------------
+# asyncio
+#-------------------------------------------------------------------------------
+
+async def f_async( x, out=None, num_threads=1, chunk_size=None ):
+    """Square root for asyncio code, computed on a thread pool.
+
+The kernel runs on worker threads without the GIL, so the event loop stays
+responsive. Large arrays are split into blocks of about chunk_size elements
+along the first axis, which run concurrently on the pool; other calls sharing
+the pool can interleave between blocks.
+
+If the calling task is cancelled, blocks that have not started yet are
+dropped (blocks already running finish, as the kernel cannot be
+interrupted); out is then partially filled.
+
+Parameters:
+    x : np.array
+        Numbers to be square-rooted; see f() for the supported dtypes.
+    out : np.array, optional
+        See f().
+    num_threads : int, optional
+        Threads per block (see f()); the default of 1 leaves the
+        parallelism to the pool, see set_async_workers().
+    chunk_size : int, optional
+        Approximate number of elements per block; defaults to DEFAULT_CHUNK_SIZE.
+
+Return value:
+    np.array
+        out, or the newly allocated result array.
+"""
+    return await _common.sqrt_async(f, x, out, num_threads, chunk_size)
+
+
+async def f_async_batch( xs, outs=None, num_threads=1, chunk_size=None ):
+    """Square roots of several arrays for asyncio code, see f_async().
+
+Parameters:
+    xs : sequence of np.array
+        Arrays to be square-rooted.
+    outs : sequence of np.array, optional
+        Output arrays, one per input (or None entries).
+    num_threads, chunk_size :
+        See f_async().
+
+Return value:
+    list of np.array
+        The results, in the order of xs.
+"""
+    return await _common.sqrt_async_batch(f, xs, outs, num_threads, chunk_size)
+
+
+#-------------------------------------------------------------------------------
+# Batches
+#-------------------------------------------------------------------------------
+
+# Compute all runs (rows of: type index, x address, out address, length, x stride, out stride)
+# on up to nthreads threads; return the number of negative integer inputs.
+#
+cdef Py_ssize_t _sqrt_batch(const Py_ssize_t[:, ::1] runs, int nthreads) noexcept nogil:
+    cdef Py_ssize_t i
+    cdef Py_ssize_t bad = 0
+    if nthreads > 1:
+        for i in prange(runs.shape[0], num_threads=nthreads, schedule="dynamic"):
+            bad += _sqrt_run_typed(<int>runs[i, 0], <char*>runs[i, 1], <char*>runs[i, 2],
+                                   runs[i, 3], runs[i, 4], runs[i, 5])
+    else:
+        for i in range(runs.shape[0]):
+            bad += _sqrt_run_typed(<int>runs[i, 0], <char*>runs[i, 1], <char*>runs[i, 2],
+                                   runs[i, 3], runs[i, 4], runs[i, 5])
+    return bad
+
+
+# A new contiguous array with the shape and dtype of x on the memory of buf,
+# from the byte offset on; in the order of x if keep_order and x is contiguous,
+# else in C order.
+#
+cdef cnp.ndarray _view_like(cnp.ndarray buf, Py_ssize_t offset, cnp.ndarray x, bint keep_order):
+    cdef int flags = cnp.NPY_ARRAY_CARRAY
+    if keep_order and cnp.PyArray_IS_F_CONTIGUOUS(x) and not cnp.PyArray_IS_C_CONTIGUOUS(x):
+        flags = cnp.NPY_ARRAY_FARRAY
+    cdef cnp.ndarray view = cnp.PyArray_New(np.ndarray, cnp.PyArray_NDIM(x), cnp.PyArray_DIMS(x), cnp.PyArray_TYPE(x),
+                                            NULL, <char*>cnp.PyArray_DATA(buf) + offset, 0, flags, None)
+    cnp.set_array_base(view, buf)
+    return view
+
+
+def map( xs, out=None, workers=None ):
+    """Square roots of many arrays at once.
+
+The whole batch is computed in a single call into C, with the GIL released
+throughout: the arrays, split into blocks of at most DEFAULT_CHUNK_SIZE
+elements, are handed out dynamically to the threads of the persistent
+OpenMP thread pool. (Arrays that are neither contiguous nor 1-D are
+processed by f() beforehand, and counted there by mylibrary.stats().)
+
+Parameters:
+    xs : sequence of np.array
+        Arrays to be square-rooted; see f() for the supported dtypes.
+        The arrays may have different shapes and dtypes.
+    out : sequence of np.array, or np.array, optional
+        Either one output array per input (see f()), or a single 1-D
+        array holding all results back to back (a "ragged" buffer of
+        the total size, which requires all inputs to have its dtype).
+    workers : int, optional
+        Maximum number of threads; defaults to the process-wide setting,
+        see set_num_threads().
+
+Return value:
+    list of np.array
+        The results, in the order of xs; for a ragged buffer, these are
+        views into it with the shapes of the inputs. Without out, they are
+        views into one newly allocated buffer.
+
+Raises:
+    TypeError, ValueError
+        See f().
+"""
+    xs = [np.asarray(a) for a in xs]
+    cdef Py_ssize_t count = len(xs)
+    cdef Py_ssize_t i, n, start, size, offset = 0, row = 0, total_elements = 0, total_bytes = 0
+    cdef Py_ssize_t sx, sr, lo, hi, chunk = DEFAULT_CHUNK_SIZE
+    cdef int k
+    cdef bint behaved
+    cdef cnp.ndarray x, res
+    cdef char* px
+    cdef char* pr
+    kinds = [None] * count
+    for i in range(count):
+        x = xs[i]
+        kind = _type_index.get(x.dtype)
+        if kind is None:
+            raise TypeError("map() not supported for dtype {}".format(x.dtype))
+        kinds[i] = kind
+        size = cnp.PyArray_SIZE(x)
+        total_elements += size
+        total_bytes += size * cnp.PyArray_ITEMSIZE(x)
+        offset += (size * cnp.PyArray_ITEMSIZE(x) + 63) & ~63
+
+    outs = [None] * count
+    if out is None:
+        # One buffer for all results, each padded to a multiple of 64 bytes; it
+        # cannot overlap with the inputs, so there is nothing to check
+        buf = np.empty(offset, dtype=np.uint8)
+        offset = 0
+        for i in range(count):
+            x = xs[i]
+            outs[i] = _view_like(buf, offset, x, True)
+            offset += (cnp.PyArray_NBYTES(x) + 63) & ~63
+    elif isinstance(out, np.ndarray):
+        if out.ndim != 1 or out.shape[0] != total_elements:
+            raise ValueError("out has shape {}, expected ({},)".format(out.shape, total_elements))
+        res = out
+        behaved = cnp.PyArray_ISCARRAY(res) and cnp.PyArray_ISNOTSWAPPED(res)
+        lo = <Py_ssize_t>cnp.PyArray_DATA(res)
+        hi = lo + cnp.PyArray_NBYTES(res)
+        start = 0
+        for i in range(count):
+            x = xs[i]
+            size = cnp.PyArray_SIZE(x)
+            px = <char*>cnp.PyArray_DATA(x)
+            if (behaved and cnp.PyArray_TYPE(x) == cnp.PyArray_TYPE(res) and cnp.PyArray_IS_C_CONTIGUOUS(x) and
+                (<Py_ssize_t>px >= hi or <Py_ssize_t>px + cnp.PyArray_NBYTES(x) <= lo)):
+                # Matching and disjoint from x, so the checks of _common.check_out() would pass
+                outs[i] = _view_like(res, start * cnp.PyArray_ITEMSIZE(res), x, False)
+            else:
+                outs[i] = _common.check_out(x, out[start:start + size].reshape((<object>x).shape))
+            start += size
+    else:
+        outs = list(out)
+        if len(outs) != count:
+            raise ValueError("got {} output arrays for {} inputs".format(len(outs), count))
+        outs = [_common.check_out(a, b) for a, b in zip(xs, outs)]
+
+    # Fill the table of runs, at most one per DEFAULT_CHUNK_SIZE elements
+    cdef Py_ssize_t[:, ::1] runs = np.empty((count + total_elements // chunk, 6), dtype=np.intp)
+    for i in range(count):
+        x = xs[i]
+        res = outs[i]
+        k = kinds[i]
+        n = cnp.PyArray_SIZE(x)
+        if ((cnp.PyArray_IS_C_CONTIGUOUS(x) and cnp.PyArray_IS_C_CONTIGUOUS(res)) or
+            (cnp.PyArray_IS_F_CONTIGUOUS(x) and cnp.PyArray_IS_F_CONTIGUOUS(res))):
+            sx = sr = cnp.PyArray_ITEMSIZE(x)
+        elif cnp.PyArray_NDIM(x) == 1:
+            sx, sr = cnp.PyArray_STRIDE(x, 0), cnp.PyArray_STRIDE(res, 0)
+        else:
+            f(x, out=res, num_threads=workers)
+            total_elements -= n
+            total_bytes -= cnp.PyArray_NBYTES(x)
+            continue
+        px = <char*>cnp.PyArray_DATA(x)
+        pr = <char*>cnp.PyArray_DATA(res)
+        start = 0
+        while start < n:
+            runs[row, 0] = k
+            runs[row, 1] = <Py_ssize_t>(px + start * sx)
+            runs[row, 2] = <Py_ssize_t>(pr + start * sr)
+            runs[row, 3] = min(chunk, n - start)
+            runs[row, 4] = sx
+            runs[row, 5] = sr
+            row += 1
+            start += chunk
+
+    cdef const Py_ssize_t[:, ::1] runs_view = runs[:row]
+    cdef int nthreads = _effective_num_threads(workers, total_elements)
+    cdef Py_ssize_t bad
+    cdef double t0 = _stats.now() if _stats.enabled else 0.0
     with nogil:
-        for j in range(n):
-            out[j] = c_sqrt(x[j])
+        bad = _sqrt_batch(runs_view, nthreads)
+    if t0 != 0.0:
+        _stats.record(_stats.COMPUTE_MAP, total_elements, total_bytes, total_bytes, _stats.now() - t0)
+    if bad:
+        raise ValueError("map() of negative integer")
+    return outs
+
+
+#-------------------------------------------------------------------------------
+# Processes
+#-------------------------------------------------------------------------------
+
+# Pool of worker processes for f_processes(); created on first use, and reused
+# until the number of workers changes or it is shut down.
+#
+_process_pool = None
+_process_workers = None
+_process_lock = threading.Lock()
+
+
+def set_process_workers(n=None):
+    """Set the number of worker processes used by f_processes().
+
+Parameters:
+    n : int or None
+        Number of worker processes (>= 1). If None, use the environment
+        variable MYLIBRARY_PROCESS_WORKERS if set, otherwise all CPUs
+        available to this process.
+
+Calls already running finish on the previous pool; its workers exit afterwards.
+"""
+    global _process_pool, _process_workers
+    if n is None:
+        n = os.environ.get("MYLIBRARY_PROCESS_WORKERS") or _common.available_cpus()
+    n = _common.check_num_threads(n)
+    with _process_lock:
+        old, _process_pool, _process_workers = _process_pool, None, n
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+def get_process_workers():
+    """Return the number of worker processes used by f_processes()."""
+    return _process_workers
+
+
+def shutdown_processes():
+    """Stop the worker processes of f_processes(), waiting for running calls.
+
+The next call of f_processes() starts a new pool. This is done automatically
+at interpreter exit.
+"""
+    global _process_pool
+    with _process_lock:
+        old, _process_pool = _process_pool, None
+    if old is not None:
+        old.shutdown(wait=True)
+
+
+def _get_process_pool():
+    global _process_pool
+    with _process_lock:
+        if _process_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # "spawn", as forked children would inherit the state of the
+            # OpenMP runtime, which is not fork-safe.
+            _process_pool = ProcessPoolExecutor(max_workers=_process_workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return _process_pool
+
+
+set_process_workers()
+atexit.register(shutdown_processes)
+
+
+class _SharedArray(object):
+    """Flat array that other processes can attach to, without copying.
+
+segment describes the memory, and is all that is sent to a worker:
+("shm", name) for a multiprocessing.shared_memory block, or ("file", path,
+offset) for a memory-mapped file. Where shared memory is not available,
+new arrays are created in temporary files instead.
+
+close() releases the memory; the process that created it also removes it.
+"""
+
+    def __init__(self, segment, array, shm=None, owner=False):
+        self.segment = segment
+        self.array = array
+        self._shm = shm
+        self._owner = owner
+
+    @classmethod
+    def create(cls, dtype, size):
+        try:
+            from multiprocessing import shared_memory
+            shm = shared_memory.SharedMemory(create=True, size=size * dtype.itemsize)
+        except (ImportError, OSError):
+            fd, path = tempfile.mkstemp(prefix="mylibrary-", suffix=".bin")
+            os.close(fd)
+            try:
+                array = np.memmap(path, dtype=dtype, mode="w+", shape=(size,))
+            except BaseException:
+                os.remove(path)
+                raise
+            return cls(("file", path, 0), array, owner=True)
+        return cls(("shm", shm.name), np.ndarray((size,), dtype=dtype, buffer=shm.buf), shm, owner=True)
+
+    @classmethod
+    def wrap(cls, a):
+        # a itself, if it is an np.memmap of a whole file region that other processes
+        # see changes of (not mode "c"); otherwise None.
+        if (isinstance(a, np.memmap) and isinstance(a.base, mmap.mmap) and a.filename
+            and a.mode != "c" and a.flags.c_contiguous):
+            return cls(("file", a.filename, a.offset), a.reshape(-1))
+        return None
+
+    @classmethod
+    def attach(cls, segment, dtype, size, writeable):
+        if segment[0] == "shm":
+            from multiprocessing import shared_memory
+            shm = shared_memory.SharedMemory(name=segment[1])
+            return cls(segment, np.ndarray((size,), dtype=dtype, buffer=shm.buf), shm)
+        return cls(segment, np.memmap(segment[1], dtype=dtype, mode="r+" if writeable else "r",
+                                      offset=segment[2], shape=(size,)))
+
+    def close(self):
+        # The array must be gone before the shared memory can be closed
+        self.array = None
+        if self._shm is not None:
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+        elif self._owner:
+            os.remove(self.segment[1])
+
+
+# Compute out[start:stop] = sqrt(x[start:stop]) for flat arrays x and out of
+# type _types[k]; return the number of negative integer inputs.
+#
+cdef Py_ssize_t _sqrt_slice(cnp.ndarray x, cnp.ndarray out, int k, Py_ssize_t start, Py_ssize_t stop):
+    cdef Py_ssize_t itemsize = x.dtype.itemsize
+    cdef char* px = <char*>cnp.PyArray_DATA(x) + start * itemsize
+    cdef char* pr = <char*>cnp.PyArray_DATA(out) + start * itemsize
+    cdef Py_ssize_t bad
+    with nogil:
+        bad = _sqrt_run_typed(k, px, pr, stop - start, itemsize, itemsize)
+    return bad
+
+
+def _process_block(x_segment, out_segment, dtype, Py_ssize_t size, Py_ssize_t start, Py_ssize_t stop):
+    # Runs in a worker process: one block of f_processes(), on a single thread
+    x = _SharedArray.attach(x_segment, dtype, size, False)
+    try:
+        out = _SharedArray.attach(out_segment, dtype, size, True)
+        try:
+            return _sqrt_slice(x.array, out.array, _type_index[dtype], start, stop)
+        finally:
+            out.close()
+    finally:
+        x.close()
+
+
+def f_processes( x, out=None, chunk_size=None ):
+    """Square root of a large array, computed by a pool of worker processes.
+
+For very large jobs where threads within this process are not an option,
+e.g. when an embedding application holds the GIL. x is placed in shared
+memory (np.memmap arrays of a whole file are shared through their file
+directly, without copying), and the workers compute disjoint blocks of
+about chunk_size elements into a shared output; no array data is pickled.
+
+The workers are started on first use and reused (see set_process_workers()
+and shutdown_processes()); shared memory is released when the call returns.
+Without shared memory, temporary files are used; where no worker processes
+can be started, f() computes the result in this process instead (with a
+RuntimeWarning).
+
+Parameters:
+    x : np.array
+        Numbers to be square-rooted; see f() for the supported dtypes.
+    out : np.array, optional
+        See f(); an np.memmap opened with mode "w+" or "r+" is written to
+        directly by the workers.
+    chunk_size : int, optional
+        Number of elements per block; defaults to DEFAULT_CHUNK_SIZE.
+
+Return value:
+    np.array
+        out, or the newly allocated result array.
+
+Raises:
+    TypeError, ValueError
+        See f().
+"""
+    global _process_pool
+    xa = np.asarray(x)
+    if xa.dtype not in _type_index:
+        raise TypeError("f_processes() not supported for dtype {}".format(xa.dtype))
+    res = _common.check_out(xa, out)
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1, got {}".format(chunk_size))
+    if xa.size == 0:
+        return f(xa, out=res)
+
+    try:
+        pool = _get_process_pool()
+    except (ImportError, NotImplementedError, OSError) as e:
+        warnings.warn("f_processes(): cannot start worker processes ({}), "
+                      "computing in this process".format(e), RuntimeWarning, stacklevel=2)
+        return f(xa, out=res)
+
+    cdef Py_ssize_t n = xa.size, start
+    segments = []
+    try:
+        xs = _SharedArray.wrap(x)
+        if xs is None:
+            xs = _SharedArray.create(xa.dtype, n)
+            segments.append(xs)
+            xs.array.reshape(xa.shape)[...] = xa
+        if np.may_share_memory(xa, res):
+            rs = xs  # in place; _common.check_out() ensures res is x
+        else:
+            rs = _SharedArray.wrap(out)
+            if rs is None:
+                rs = _SharedArray.create(xa.dtype, n)
+                segments.append(rs)
+
+        blocks = [pool.submit(_process_block, xs.segment, rs.segment, xa.dtype, n, start, min(start + chunk_size, n))
+                  for start in range(0, n, chunk_size)]
+        bad = 0
+        try:
+            for block in blocks:
+                bad += block.result()
+        except BaseException as e:
+            for block in blocks:
+                block.cancel()
+            from concurrent.futures.process import BrokenProcessPool
+            if isinstance(e, BrokenProcessPool):
+                # A worker died; start over with a new pool next time
+                with _process_lock:
+                    if _process_pool is pool:
+                        _process_pool = None
+            raise
+
+        if rs in segments:
+            res[...] = rs.array.reshape(xa.shape)
+    finally:
+        for segment in segments:
+            segment.close()
+
+    if bad:
+        raise ValueError("f_processes() of negative integer")
+    if out is not None:
+        return out
+    return res
+
+
+#-------------------------------------------------------------------------------
+# C API (declared in compute.pxd, for cimport from other Cython modules)
+#-------------------------------------------------------------------------------
+
+cdef double sqrt_d(double x) noexcept nogil:
+    return c_sqrt(x)
+
+
+cdef float sqrt_f(float x) noexcept nogil:
+    return c_sqrtf(x)
+
+
+cdef uint64_t isqrt(uint64_t x) noexcept nogil:
+    return _isqrt(x)
+
+
+cdef void sqrt_array_d(const double* x, double* out, Py_ssize_t n) noexcept nogil:
+    mylib_sqrt_d(x, out, n)
 
-    return np.asanyarray(out)  # return proper np.ndarray, not memoryview slice
 
+cdef void sqrt_array_f(const float* x, float* out, Py_ssize_t n) noexcept nogil:
+    mylib_sqrt_f(x, out, n)
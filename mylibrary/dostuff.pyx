@@ -3,15 +3,22 @@
 # cython: wraparound  = False
 # cython: boundscheck = False
 # cython: cdivision   = True
+# cython: freethreading_compatible = True
 """Example Cython module that calls a function from a subpackage of mylibrary."""
 
 from __future__ import division, print_function, absolute_import
 
+import io
+import itertools
+import sys
 
 # Use absolute module names, even from this library itself.
 #
 cimport mylibrary.subpackage.helloworld as helloworld
 
+# Runtime counters, see mylibrary.stats()
+cimport mylibrary._stats as _stats
+
 
 def hello(s):
     """Python interface to mylibrary.subpackage.helloworld.
@@ -22,5 +29,66 @@ Parameters:
     s : str
         The string to echo.
 """
+    cdef double t0 = _stats.now() if _stats.enabled else 0.0
     helloworld.hello(s)
+    if t0 != 0.0:
+        _stats.record(_stats.DOSTUFF_HELLO, 1, len(s), len(s) + 1, _stats.now() - t0)
+
+
+def hello_many(lines, fd=None, flush_size=65536):
+    """Echo many strings, one per line, with few large writes.
 
+The output is collected in a C-level buffer, and written directly to the file
+descriptor when the buffer is full (without the GIL), instead of going
+through print() and the Python I/O stack once per line.
+
+Parameters:
+    lines : iterable of str
+        The strings to echo.
+    fd : int, optional
+        File descriptor to write to, UTF-8 encoded. Defaults to that of
+        sys.stdout (which is flushed first, to keep the output in order).
+        If sys.stdout has no file descriptor (e.g. an io.StringIO), the
+        lines are written to it in batches instead.
+    flush_size : int, optional
+        Buffer size in bytes.
+"""
+    cdef double t0 = _stats.now() if _stats.enabled else 0.0
+    cdef helloworld.LineWriter writer
+    if fd is None:
+        sys.stdout.flush()
+        try:
+            fd = sys.stdout.fileno()
+        except (AttributeError, ValueError, io.UnsupportedOperation):
+            count, written = _hello_many_to_stream(lines, sys.stdout, flush_size)
+            if t0 != 0.0:
+                _stats.record(_stats.DOSTUFF_HELLO_MANY, count, written, written, _stats.now() - t0)
+            return
+    writer = helloworld.LineWriter(fd, flush_size)
+    count = helloworld.hello_many(lines, writer)
+    if t0 != 0.0:
+        _stats.record(_stats.DOSTUFF_HELLO_MANY, count, writer.written, writer.written, _stats.now() - t0)
+
+
+# Return the number of lines and characters written.
+#
+def _hello_many_to_stream(lines, stream, flush_size):
+    lines = iter(lines)
+    batch_size = max(1, flush_size // 64)  # lines, assuming they are short
+    count = written = 0
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        if not batch:
+            break
+        try:
+            text = "\n".join(batch) + "\n"
+        except TypeError:
+            # Like the file descriptor path, write the lines before the bad one
+            good = list(itertools.takewhile(lambda line: isinstance(line, str), batch))
+            if good:
+                stream.write("\n".join(good) + "\n")
+            raise
+        stream.write(text)
+        count += len(batch)
+        written += len(text)
+    return count, written
@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+#
+# cython: wraparound  = False
+# cython: boundscheck = False
+# cython: cdivision   = True
+# cython: freethreading_compatible = True
+"""Fused elementwise expressions around the square root kernel of compute.
+
+Instead of
+
+    scale * compute.f(a * a + b * b)
+
+which allocates (and passes over) a full temporary array for every step, write
+
+    import mylibrary.expr as expr
+
+    x, y = expr.var("x"), expr.var("y")
+    e = scale * expr.sqrt(x * x + y * y)
+    r = e.evaluate(x=a, y=b)     # or expr.evaluate(e, x=a, y=b)
+
+or, with the arrays bound right away,
+
+    r = expr.evaluate(scale * expr.sqrt(expr.asexpr(a) ** 2 + expr.asexpr(b) ** 2))
+
+Expressions are compiled to a small stack program, which is run in a single
+pass over blocks of BLOCK_SIZE elements; intermediate results only ever exist
+for one block, in cache. Compiled programs are cached by the structure of the
+expression, so building the same expression again (even with other constants
+or other arrays) does not recompile it.
+
+All computations are done in float64.
+"""
+
+from __future__ import division, print_function, absolute_import
+
+from libc.math cimport fabs
+from libc.stdint cimport int8_t, int16_t, int32_t, int64_t
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t
+from libc.string cimport memcpy
+
+from cython.parallel cimport prange, threadid
+
+import functools
+
+import numpy as np
+cimport numpy as cnp
+
+from mylibrary import compute
+from mylibrary import _compute_common as _common
+from mylibrary.compute cimport sqrt_array_d
+
+cnp.import_array()
+
+
+#-------------------------------------------------------------------------------
+# Expressions
+#-------------------------------------------------------------------------------
+
+class Expr(object):
+    """Node of an elementwise expression.
+
+Build expressions from var(), asexpr() and sqrt() with the arithmetic
+operators +, -, *, /, unary - and abs(), and ** with exponents 2 and 0.5;
+Python scalars are taken as constants. Evaluate them with evaluate().
+"""
+    __slots__ = ("op", "args")
+
+    # Make NumPy hand e.g. array * expr over to Expr.__rmul__
+    __array_ufunc__ = None
+
+    def __init__(self, op, args):
+        self.op = op
+        self.args = args
+
+    def __add__(self, other):      return _binary("add", self, other)
+    def __radd__(self, other):     return _binary("add", other, self)
+    def __sub__(self, other):      return _binary("sub", self, other)
+    def __rsub__(self, other):     return _binary("sub", other, self)
+    def __mul__(self, other):      return _binary("mul", self, other)
+    def __rmul__(self, other):     return _binary("mul", other, self)
+    def __truediv__(self, other):  return _binary("div", self, other)
+    def __rtruediv__(self, other): return _binary("div", other, self)
+    def __neg__(self):             return Expr("neg", (self,))
+    def __pos__(self):             return self
+    def __abs__(self):             return Expr("abs", (self,))
+
+    def __pow__(self, exponent):
+        if exponent == 2:
+            return _binary("mul", self, self)
+        if exponent == 0.5:
+            return sqrt(self)
+        return NotImplemented
+
+    def __repr__(self):
+        if self.op == "input":
+            name, array = self.args
+            return name if array is None else "array{}".format(array.shape)
+        if self.op == "const":
+            return repr(self.args[0])
+        if self.op in _symbols:
+            return "({} {} {})".format(self.args[0], _symbols[self.op], self.args[1])
+        return "{}({})".format(self.op, self.args[0])
+
+    def evaluate(self, out=None, num_threads=None, **values):
+        """Evaluate the expression; see evaluate()."""
+        return evaluate(self, out=out, num_threads=num_threads, **values)
+
+
+_symbols = {"add": "+", "sub": "-", "mul": "*", "div": "/"}
+
+
+def var(name):
+    """Return a named variable, whose value is given to evaluate()."""
+    return Expr("input", (str(name), None))
+
+
+def asexpr(x):
+    """Return x as an expression: Expr objects as they are, numbers as
+constants, and arrays (or anything np.asarray() accepts) as inputs."""
+    if isinstance(x, Expr):
+        return x
+    if isinstance(x, (int, float, np.integer, np.floating)):
+        return Expr("const", (float(x),))
+    return Expr("input", (None, np.asarray(x)))
+
+
+def sqrt(x):
+    """Square root, with the kernel of compute.f()."""
+    return Expr("sqrt", (asexpr(x),))
+
+
+def _binary(op, a, b):
+    return Expr(op, (asexpr(a), asexpr(b)))
+
+
+#-------------------------------------------------------------------------------
+# Compilation
+#-------------------------------------------------------------------------------
+
+# Opcodes of the stack machine; all but _LOAD and _CONST replace the top of the
+# stack (one or two operands) with their result. The "_C" variants take their
+# right operand from the constants (reversed for _RSUB_C and _RDIV_C) instead.
+#
+cdef enum:
+    _LOAD, _CONST
+    _ADD, _SUB, _MUL, _DIV
+    _ADD_C, _SUB_C, _MUL_C, _DIV_C, _RSUB_C, _RDIV_C
+    _NEG, _ABS, _SQRT
+
+_opcodes = {"load": _LOAD, "const": _CONST,
+            "add": _ADD, "sub": _SUB, "mul": _MUL, "div": _DIV,
+            "add_c": _ADD_C, "sub_c": _SUB_C, "mul_c": _MUL_C, "div_c": _DIV_C,
+            "rsub_c": _RSUB_C, "rdiv_c": _RDIV_C,
+            "neg": _NEG, "abs": _ABS, "sqrt": _SQRT}
+
+
+# Flatten e into its postfix program: append (op, argument) pairs to code,
+# where the argument is an index into inputs (a list of input nodes) for
+# "load", and into consts for the constant operations. The program depends
+# only on the structure of e, so that it can serve as the key of the cache.
+#
+def _flatten(e, code, inputs, slots, consts):
+    if e.op == "input":
+        name, array = e.args
+        ident = name if array is None else id(e)
+        if ident not in slots:
+            slots[ident] = len(inputs)
+            inputs.append(e)
+        code.append(("load", slots[ident]))
+    elif e.op == "const":
+        consts.append(e.args[0])
+        code.append(("const", len(consts) - 1))
+    elif e.op in _symbols:
+        a, b = e.args
+        if b.op == "const":
+            _flatten(a, code, inputs, slots, consts)
+            consts.append(b.args[0])
+            code.append((e.op + "_c", len(consts) - 1))
+        elif a.op == "const":
+            _flatten(b, code, inputs, slots, consts)
+            consts.append(a.args[0])
+            code.append((e.op + "_c" if e.op in ("add", "mul") else "r" + e.op + "_c", len(consts) - 1))
+        else:
+            _flatten(a, code, inputs, slots, consts)
+            _flatten(b, code, inputs, slots, consts)
+            code.append((e.op, 0))
+    else:
+        _flatten(e.args[0], code, inputs, slots, consts)
+        code.append((e.op, 0))
+
+
+cdef class _Program:
+    # A compiled expression: opcodes, their arguments, and the maximum stack depth
+    cdef readonly object code, args
+    cdef readonly Py_ssize_t depth
+
+    def __init__(self, key):
+        self.code = np.array([_opcodes[op] for op, arg in key], dtype=np.intc)
+        self.args = np.array([arg for op, arg in key], dtype=np.intp)
+        cdef Py_ssize_t d = 0
+        self.depth = 0
+        for op, arg in key:
+            if op in ("load", "const"):
+                d += 1
+            elif op in _symbols:
+                d -= 1
+            self.depth = max(self.depth, d)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(key):
+    return _Program(key)
+
+
+#-------------------------------------------------------------------------------
+# Evaluation
+#-------------------------------------------------------------------------------
+
+# Elements per block; a few blocks of float64 (one per stack level) stay in L1/L2.
+#
+cdef enum:
+    _BLOCK = 1024
+
+BLOCK_SIZE = _BLOCK
+
+# Each thread gets at least this many elements (as in compute).
+#
+cdef Py_ssize_t _min_elements_per_thread = 32768
+
+
+# How _run_block() reads an input: a contiguous float64 array of the full
+# shape used in place, a single value, or elements gathered (and converted to
+# float64) from a strided or broadcast array of any of the types below.
+#
+cdef enum:
+    _DIRECT, _SCALAR, _GATHER
+
+cdef enum:
+    _F64, _F32, _I8, _I16, _I32, _I64, _U8, _U16, _U32, _U64
+
+_gather_types = {("f", 8): _F64, ("f", 4): _F32,
+                 ("i", 1): _I8, ("i", 2): _I16, ("i", 4): _I32, ("i", 8): _I64,
+                 ("u", 1): _U8, ("u", 2): _U16, ("u", 4): _U32, ("u", 8): _U64,
+                 ("b", 1): _U8}
+
+cdef enum:
+    _MAXDIMS = 64
+
+
+# Convert the m elements of type t at p, step bytes apart, to float64 at dst.
+#
+cdef void _convert(const char* p, Py_ssize_t step, int t, Py_ssize_t m, double* dst) noexcept nogil:
+    cdef Py_ssize_t j
+    if t == _F64:
+        for j in range(m):
+            dst[j] = (<const double*>(p + j * step))[0]
+    elif t == _F32:
+        for j in range(m):
+            dst[j] = (<const float*>(p + j * step))[0]
+    elif t == _I8:
+        for j in range(m):
+            dst[j] = (<const int8_t*>(p + j * step))[0]
+    elif t == _I16:
+        for j in range(m):
+            dst[j] = (<const int16_t*>(p + j * step))[0]
+    elif t == _I32:
+        for j in range(m):
+            dst[j] = (<const int32_t*>(p + j * step))[0]
+    elif t == _I64:
+        for j in range(m):
+            dst[j] = <double>(<const int64_t*>(p + j * step))[0]
+    elif t == _U8:
+        for j in range(m):
+            dst[j] = (<const uint8_t*>(p + j * step))[0]
+    elif t == _U16:
+        for j in range(m):
+            dst[j] = (<const uint16_t*>(p + j * step))[0]
+    elif t == _U32:
+        for j in range(m):
+            dst[j] = (<const uint32_t*>(p + j * step))[0]
+    else:
+        for j in range(m):
+            dst[j] = <double>(<const uint64_t*>(p + j * step))[0]
+
+
+# Gather the n elements from start (in C order of shape) of the array of type
+# t at data with the given strides (0 along broadcast axes) into dst.
+#
+cdef void _gather(const char* data, int t, const Py_ssize_t* shape, const Py_ssize_t* strides,
+                  Py_ssize_t ndim, Py_ssize_t start, Py_ssize_t n, double* dst) noexcept nogil:
+    cdef Py_ssize_t idx[_MAXDIMS]
+    cdef Py_ssize_t k, m, j = 0
+    cdef Py_ssize_t last = ndim - 1
+    cdef const char* p = data
+    for k in range(last, -1, -1):
+        idx[k] = start % shape[k]
+        start = start // shape[k]
+        p += idx[k] * strides[k]
+    while True:
+        # The rest of the current row, then carry into the outer axes
+        m = min(n - j, shape[last] - idx[last])
+        _convert(p, strides[last], t, m, dst + j)
+        j += m
+        if j == n:
+            return
+        p -= idx[last] * strides[last]
+        idx[last] = 0
+        k = last - 1
+        while k >= 0:
+            idx[k] += 1
+            p += strides[k]
+            if idx[k] < shape[k]:
+                break
+            p -= shape[k] * strides[k]
+            idx[k] = 0
+            k -= 1
+
+
+# Run the program on the n <= _BLOCK elements of the block at start, writing
+# the result to out. Input k is read as given by mode[k] (see above); the
+# strides of gathered inputs are in row k of strides, for the result shape
+# of ndim axes. scratch holds _BLOCK elements per stack level, stack the
+# pointers to the current operands.
+#
+# The last operation writes to out directly, after all inputs of the block
+# have been read; as all operations are elementwise, out may also be one of
+# the inputs (element for element, see evaluate()).
+#
+cdef void _run_block(const int* code, const Py_ssize_t* args, Py_ssize_t ncode,
+                     double** inputs, const unsigned char* mode, const int* types,
+                     const Py_ssize_t* shape, const Py_ssize_t* strides, Py_ssize_t ndim,
+                     const double* consts, double* scratch, double** stack,
+                     Py_ssize_t start, Py_ssize_t n, double* out) noexcept nogil:
+    cdef Py_ssize_t pc, j, k
+    cdef Py_ssize_t d = 0
+    cdef int op
+    cdef double c
+    cdef double* a
+    cdef double* b
+    cdef double* dst
+    for pc in range(ncode):
+        op = code[pc]
+        if op == _LOAD or op == _CONST:
+            k = args[pc]
+            dst = scratch + d * _BLOCK
+            if op == _LOAD and mode[k] == _DIRECT:
+                stack[d] = inputs[k] + start
+            elif op == _LOAD and mode[k] == _GATHER:
+                _gather(<const char*>inputs[k], types[k], shape, strides + k * ndim, ndim, start, n, dst)
+                stack[d] = dst
+            else:
+                c = inputs[k][0] if op == _LOAD else consts[k]
+                for j in range(n):
+                    dst[j] = c
+                stack[d] = dst
+            d += 1
+            continue
+        if op == _ADD or op == _SUB or op == _MUL or op == _DIV:
+            d -= 1
+        a = stack[d - 1]
+        b = stack[d]
+        c = consts[args[pc]]
+        dst = out if pc == ncode - 1 else scratch + (d - 1) * _BLOCK
+        if op == _ADD:
+            for j in range(n):
+                dst[j] = a[j] + b[j]
+        elif op == _SUB:
+            for j in range(n):
+                dst[j] = a[j] - b[j]
+        elif op == _MUL:
+            for j in range(n):
+                dst[j] = a[j] * b[j]
+        elif op == _DIV:
+            for j in range(n):
+                dst[j] = a[j] / b[j]
+        elif op == _ADD_C:
+            for j in range(n):
+                dst[j] = a[j] + c
+        elif op == _SUB_C:
+            for j in range(n):
+                dst[j] = a[j] - c
+        elif op == _MUL_C:
+            for j in range(n):
+                dst[j] = a[j] * c
+        elif op == _DIV_C:
+            for j in range(n):
+                dst[j] = a[j] / c
+        elif op == _RSUB_C:
+            for j in range(n):
+                dst[j] = c - a[j]
+        elif op == _RDIV_C:
+            for j in range(n):
+                dst[j] = c / a[j]
+        elif op == _NEG:
+            for j in range(n):
+                dst[j] = -a[j]
+        elif op == _ABS:
+            for j in range(n):
+                dst[j] = fabs(a[j])
+        else:
+            sqrt_array_d(a, dst, n)
+        stack[d - 1] = dst
+
+    if stack[0] != out:
+        memcpy(out, stack[0], n * sizeof(double))
+
+
+# True if a and b are float64 arrays of the same shape at the same address,
+# with the same strides: the same elements, read and written in the same order.
+#
+def _same_elements(a, b):
+    return (a.shape == b.shape and a.dtype == b.dtype == np.float64 and a.strides == b.strides and
+            a.__array_interface__["data"][0] == b.__array_interface__["data"][0])
+
+
+def evaluate( e, out=None, num_threads=None, **values ):
+    """Evaluate an expression in a single pass, without temporary arrays.
+
+Parameters:
+    e : Expr
+        The expression (or anything asexpr() accepts).
+    out : np.array, optional
+        Array to store the result in; must have the shape of the result.
+        May be one of the inputs, for in-place operation; if it overlaps
+        with an input in any other way, the result is computed into a
+        temporary array first.
+    num_threads : int, optional
+        Maximum number of threads; defaults to compute.get_num_threads().
+    **values : np.array or number
+        Values of the variables in e, by name.
+
+Inputs are broadcast against each other. Contiguous float64 arrays of the
+full shape and single values are used as they are; other inputs of real
+number types (other dtypes, memory layouts or broadcast shapes) are read one
+block at a time, converted to float64. Only inputs of other types (e.g.
+float16 or non-native byte order) are first converted to float64 arrays.
+
+Return value:
+    np.array of float64
+        The result; if out was given, this is out.
+
+Raises:
+    ValueError
+        If a variable has no value, or the shapes of the inputs don't match.
+"""
+    e = asexpr(e)
+    key, inputs, consts = [], [], []
+    _flatten(e, key, inputs, {}, consts)
+    cdef _Program program = _compile(tuple(key))
+
+    arrays = []
+    for leaf in inputs:
+        name, array = leaf.args
+        if array is None:
+            if name not in values:
+                raise ValueError("no value given for variable {!r}".format(name))
+            array = np.asarray(values[name])
+        arrays.append(array)
+    shape = np.broadcast_shapes(*(a.shape for a in arrays)) if arrays else ()
+    cdef Py_ssize_t n = int(np.prod(shape))
+
+    cdef Py_ssize_t ndim = len(shape)
+    cdef Py_ssize_t ninputs = max(1, len(arrays))
+    cdef cnp.ndarray ptrs = np.empty(ninputs, dtype=np.intp)
+    cdef cnp.ndarray modes = np.full(ninputs, _DIRECT, dtype=np.uint8)
+    cdef cnp.ndarray types = np.zeros(ninputs, dtype=np.intc)
+    cdef cnp.ndarray strides = np.zeros((ninputs, max(1, ndim)), dtype=np.intp)
+    cdef cnp.ndarray shape_array = np.array(shape + (1,), dtype=np.intp)
+    keep = []
+    for k, a in enumerate(arrays):
+        if a.size == 1:
+            a = np.array(a, dtype=np.float64).reshape(1)  # a copy, as out may overlap
+            modes[k] = _SCALAR
+        elif a.shape != shape or a.dtype != np.float64 or not a.flags.c_contiguous:
+            typecode = _gather_types.get((a.dtype.kind, a.dtype.itemsize)) if a.dtype.isnative else None
+            if typecode is None:
+                a, typecode = a.astype(np.float64), _F64
+            a = np.broadcast_to(a, shape)
+            modes[k], types[k] = _GATHER, typecode
+            strides[k, :ndim] = a.strides
+        keep.append(a)
+        ptrs[k] = <Py_ssize_t>cnp.PyArray_DATA(a)
+
+    # out is written block by block, so it may only overlap with inputs that
+    # are read from the same place
+    cdef cnp.ndarray res
+    if out is None:
+        res = np.empty(shape, dtype=np.float64)
+    else:
+        if out.shape != shape:
+            raise ValueError("out has shape {}, expected {}".format(out.shape, shape))
+        if (out.dtype == np.float64 and out.flags.c_contiguous and
+            not any(np.may_share_memory(a, out) and not _same_elements(a, out) for a in arrays)):
+            res = out
+        else:
+            res = np.empty(shape, dtype=np.float64)
+
+    cdef int nthreads = compute.get_num_threads() if num_threads is None else _common.check_num_threads(num_threads)
+    nthreads = <int>max(1, min(nthreads, n // _min_elements_per_thread))
+
+    cdef cnp.ndarray consts_array = np.array(consts + [0.0], dtype=np.float64)
+    cdef cnp.ndarray scratch = np.empty((nthreads, max(1, program.depth), _BLOCK), dtype=np.float64)
+    cdef cnp.ndarray stacks = np.empty((nthreads, max(1, program.depth)), dtype=np.intp)
+
+    cdef const int* code = <const int*>cnp.PyArray_DATA(program.code)
+    cdef const Py_ssize_t* args = <const Py_ssize_t*>cnp.PyArray_DATA(program.args)
+    cdef Py_ssize_t ncode = program.code.shape[0]
+    cdef Py_ssize_t depth = max(1, program.depth)
+    cdef double** pinputs = <double**>cnp.PyArray_DATA(ptrs)
+    cdef const unsigned char* pmodes = <const unsigned char*>cnp.PyArray_DATA(modes)
+    cdef const int* ptypes = <const int*>cnp.PyArray_DATA(types)
+    cdef const Py_ssize_t* pshape = <const Py_ssize_t*>cnp.PyArray_DATA(shape_array)
+    cdef const Py_ssize_t* pstrides = <const Py_ssize_t*>cnp.PyArray_DATA(strides)
+    cdef Py_ssize_t sdim = max(1, ndim)
+    cdef const double* pconsts = <const double*>cnp.PyArray_DATA(consts_array)
+    cdef double* pscratch = <double*>cnp.PyArray_DATA(scratch)
+    cdef double** pstacks = <double**>cnp.PyArray_DATA(stacks)
+    cdef double* pout = <double*>cnp.PyArray_DATA(res)
+    cdef Py_ssize_t nblocks = (n + _BLOCK - 1) // _BLOCK
+    cdef Py_ssize_t blk, start
+    cdef int t
+
+    with nogil:
+        if nthreads > 1:
+            for blk in prange(nblocks, num_threads=nthreads, schedule="static"):
+                t = threadid()
+                start = blk * _BLOCK
+                _run_block(code, args, ncode, pinputs, pmodes, ptypes, pshape, pstrides, sdim, pconsts,
+                           pscratch + t * depth * _BLOCK, pstacks + t * depth,
+                           start, min(<Py_ssize_t>_BLOCK, n - start), pout + start)
+        else:
+            for blk in range(nblocks):
+                start = blk * _BLOCK
+                _run_block(code, args, ncode, pinputs, pmodes, ptypes, pshape, pstrides, sdim, pconsts,
+                           pscratch, pstacks, start, min(<Py_ssize_t>_BLOCK, n - start), pout + start)
+
+    if out is None:
+        return res
+    if res is not out:
+        out[...] = res
+    return out
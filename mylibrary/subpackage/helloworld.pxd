@@ -4,5 +4,31 @@
 
 from __future__ import absolute_import
 
+cimport cython
+
 cdef void hello(str s)
 
+# Buffered writer to a file descriptor; collects small writes in a buffer of
+# flush_size bytes, and writes it out in one system call when full.
+#
+# A writer may be shared between threads: write(), write_line() and flush()
+# lock it, and each line of write_line() shorter than flush_size is written
+# to fd as a whole.
+#
+cdef class LineWriter:
+    cdef int fd
+    cdef char* buf
+    cdef Py_ssize_t flush_size
+    cdef Py_ssize_t used
+    cdef Py_ssize_t written  # total bytes passed to write()
+    cdef cython.pymutex lock
+
+    cdef int write(self, const char* data, Py_ssize_t n) except -1
+    cdef int write_line(self, const char* data, Py_ssize_t n) except -1  # data, then a newline
+    cdef int flush(self) except -1
+
+    # The same, with the lock held
+    cdef int _write(self, const char* data, Py_ssize_t n) except -1
+    cdef int _flush(self) except -1
+
+cdef Py_ssize_t hello_many(lines, LineWriter writer) except -1  # returns the number of lines
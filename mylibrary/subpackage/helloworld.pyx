@@ -3,16 +3,120 @@
 # cython: wraparound  = False
 # cython: boundscheck = False
 # cython: cdivision   = True
+# cython: freethreading_compatible = True
 """Example Cython module."""  # this is the Python-level docstring
 
-# Note that this is a pure Cython-level module; it has no "def" functions or Python-accessible objects.
+# Note that this is a pure Cython-level module; it has no "def" functions.
 #
-# If this is imported to Python, the user will just see the module docstring.
+# If this is imported to Python, the user will just see the module docstring
+# (and the LineWriter type, which is created from other Cython modules).
 
 from __future__ import division, print_function, absolute_import
 
+from libc.errno  cimport errno, EINTR
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+from posix.unistd cimport write
+
+from cpython.exc     cimport PyErr_SetFromErrno
+from cpython.unicode cimport PyUnicode_AsUTF8AndSize
+
 # Echo the string s.
 #
 cdef void hello(str s):
     print(s)  # this is really, really silly (providing a Cython-level cdef function that just calls Python print())
 
+
+# Write all of data to fd, retrying after partial writes and signals.
+#
+cdef int _write_all(int fd, const char* data, Py_ssize_t n) except -1 nogil:
+    cdef Py_ssize_t k
+    while n > 0:
+        k = write(fd, data, n)
+        if k < 0:
+            if errno == EINTR:
+                continue
+            with gil:
+                PyErr_SetFromErrno(OSError)
+            return -1
+        data += k
+        n -= k
+    return 0
+
+
+cdef class LineWriter:
+    """Buffered writer to the file descriptor fd, using a buffer of flush_size bytes."""
+
+    def __cinit__(self, int fd, Py_ssize_t flush_size=65536):
+        if flush_size < 1:
+            raise ValueError("flush_size must be at least 1, got {}".format(flush_size))
+        self.buf = <char*>malloc(flush_size)
+        if self.buf == NULL:
+            raise MemoryError()
+        self.fd = fd
+        self.flush_size = flush_size
+        self.used = 0
+        self.written = 0
+
+    def __dealloc__(self):
+        free(self.buf)  # unflushed data is discarded
+
+    cdef int write(self, const char* data, Py_ssize_t n) except -1:
+        with self.lock:
+            return self._write(data, n)
+
+    cdef int write_line(self, const char* data, Py_ssize_t n) except -1:
+        with self.lock:
+            # Keep the line and its newline in the same write() to fd
+            if self.used + n + 1 > self.flush_size:
+                self._flush()
+            self._write(data, n)
+            return self._write(b"\n", 1)
+
+    cdef int flush(self) except -1:
+        with self.lock:
+            return self._flush()
+
+    # Append n bytes to the buffer, flushing it first if they don't fit.
+    # Data larger than the buffer is written directly.
+    #
+    cdef int _write(self, const char* data, Py_ssize_t n) except -1:
+        self.written += n
+        if self.used + n > self.flush_size:
+            self._flush()
+            if n >= self.flush_size:
+                with nogil:
+                    _write_all(self.fd, data, n)
+                return 0
+        memcpy(self.buf + self.used, data, n)
+        self.used += n
+        return 0
+
+    # Write out the buffer; the GIL is released during the system call (the
+    # lock is not, so that nobody refills the buffer meanwhile).
+    #
+    cdef int _flush(self) except -1:
+        cdef Py_ssize_t n = self.used
+        self.used = 0
+        with nogil:
+            _write_all(self.fd, self.buf, n)
+        return 0
+
+
+# Echo each string of lines, like hello(), through writer (UTF-8 encoded);
+# return the number of lines.
+#
+# The writer is flushed at the end, also if a line is not a str.
+#
+cdef Py_ssize_t hello_many(lines, LineWriter writer) except -1:
+    cdef const char* data
+    cdef Py_ssize_t n
+    cdef Py_ssize_t count = 0
+    try:
+        for s in lines:
+            data = PyUnicode_AsUTF8AndSize(<str?>s, &n)  # no copy for ASCII strings
+            writer.write_line(data, n)
+            count += 1
+    finally:
+        writer.flush()
+    return count
@@ -4,7 +4,7 @@
 
 Pruned-down version of the Cython template, for pure Python projects (no Cython).
 
-Supports Python 2.7 and 3.4.
+Supports Python 3.8 and higher.
 
 Usage as usual with setuptools:
     python setup.py build
@@ -22,14 +22,7 @@ or
 
 from __future__ import division, print_function, absolute_import
 
-try:
-    # Python 3
-    MyFileNotFoundError = FileNotFoundError
-except:  # FileNotFoundError does not exist in Python 2.7
-    # Python 2.7
-    # - open() raises IOError
-    # - remove() (not currently used here) raises OSError
-    MyFileNotFoundError = (IOError, OSError)
+MyFileNotFoundError = FileNotFoundError
 
 #########################################################
 # General config
@@ -51,7 +44,7 @@ DESC="""yet another setuptools-based package template for Python projects.
 
 This is a pruned-down version of the Cython template, for pure Python projects (no Cython).
 
-Supports Python 2.7 and 3.4.
+Supports Python 3.8 and higher.
 """
 
 # Set up data files for packaging.
@@ -72,11 +65,11 @@ standard_doc_exts = [".md", ".rst", ".txt", ""]  # commonly .md for GitHub proje
 # Init
 #########################################################
 
-# check for Python 2.7 or later
+# check for Python 3.8 or later
 # http://stackoverflow.com/questions/19534896/enforcing-python-version-in-setup-py
 import sys
-if sys.version_info < (2,7):
-    sys.exit('Sorry, Python < 2.7 is not supported')
+if sys.version_info < (3,8):
+    sys.exit('Sorry, Python < 3.8 is not supported')
 
 import os
 
@@ -127,17 +120,12 @@ datafiles.append( ('.', detected_docs) )
 # Automatic versioning based on https://github.com/jbweston/miniver:
 #
 def get_version_and_cmdclass(package_name):
-    try: # Python 3
-        from importlib.util import module_from_spec, spec_from_file_location
-        spec = spec_from_file_location('version',
-                                       os.path.join(package_name, "_version.py"))
-        module = module_from_spec(spec)
-        spec.loader.exec_module(module)
-        return module.__version__, module.cmdclass
-    except: # Python 2
-        import imp
-        module = imp.load_source(package_name.split('.')[-1], os.path.join(package_name, "_version.py"))
-        return module.__version__, module.cmdclass
+    from importlib.util import module_from_spec, spec_from_file_location
+    spec = spec_from_file_location('version',
+                                   os.path.join(package_name, "_version.py"))
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.__version__, module.cmdclass
 
 version, ver_cmdclass = get_version_and_cmdclass('mylibrary')
 
@@ -184,6 +172,13 @@ setup(
                     "Operating System :: POSIX :: Linux",
                     "Operating System :: MacOS :: MacOS X",
                     "Programming Language :: Python",
+                    "Programming Language :: Python :: 3",
+                    "Programming Language :: Python :: 3 :: Only",
+                    "Programming Language :: Python :: 3.8",
+                    "Programming Language :: Python :: 3.9",
+                    "Programming Language :: Python :: 3.10",
+                    "Programming Language :: Python :: 3.11",
+                    "Programming Language :: Python :: 3.12",
                     "Topic :: Scientific/Engineering",
                     "Topic :: Scientific/Engineering :: Mathematics",
                     "Topic :: Software Development :: Libraries",
@@ -193,6 +188,7 @@ setup(
     # See
     #    http://setuptools.readthedocs.io/en/latest/setuptools.html
     #
+    python_requires  = ">=3.8",
     setup_requires   = ["numpy"],
     install_requires = ["numpy"],
 
@@ -202,11 +198,11 @@ setup(
     #
     packages = ["mylibrary"],
 
-    zip_safe = True,  # no Cython extensions
+    zip_safe = False,  # mylibrary/__init__.py loads _compute_numpy.py by its file name
 
     # Custom data files not inside a Python package
     data_files = datafiles,
 
     # Additional / improved commands
-    cmdclass = cmdclass
+    cmdclass = ver_cmdclass
 )
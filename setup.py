@@ -4,7 +4,7 @@
 
 Main setup for the library.
 
-Supports Python 2.7 as well as 3.4 and higher.
+Supports Python 3.8 and higher.
 
 Usage as usual with setuptools:
     python setup.py build_ext
@@ -14,6 +14,7 @@ Usage as usual with setuptools:
 
 and also
     python setup.py cython
+    python setup.py build_ext --pgo [--lto]  # profile-guided optimization, see below
 
 For details, see
     http://setuptools.readthedocs.io/en/latest/setuptools.html#command-reference
@@ -28,6 +29,19 @@ honored:
     CFLAGS
     LDFLAGS
     LIBS
+    MYLIBRARY_OPENMP  (0 or 1, build with OpenMP; default 1 except on Mac OS X)
+    MYLIBRARY_PGO     (0 or 1, profile-guided optimization; default 0)
+    MYLIBRARY_LTO     (0 or 1, link-time optimization; default 0)
+
+Profile-guided optimization (PGO) builds the extensions twice: first with
+instrumentation, which records how the training workload mylibrary/_pgo_training.py
+exercises them, then optimized for that profile. This needs GCC, or clang with
+llvm-profdata (set LLVM_PROFDATA if it is not on the PATH). To build a wheel:
+
+    MYLIBRARY_PGO=1 MYLIBRARY_LTO=1 pip wheel .
+
+and to measure the speedup against a plain build, run bench/bench_mylibrary.py
+with each of them, and compare the results.
 
 Corresponding variables in setup.cfg are read during configuration and overwrite
 environment variables.
@@ -40,15 +54,21 @@ environment variables.
 
 from __future__ import division, print_function, absolute_import
 
+import glob
 import os
+import re
+import shutil
+import subprocess
 import sys
+import sysconfig
 
 from setuptools           import setup
 from setuptools           import Command
 from setuptools.extension import Extension
+from setuptools.command.build_ext import build_ext as build_ext_orig
 
-if sys.version_info < (2,7):
-    sys.exit('Sorry, Python < 2.7 is not supported')
+if sys.version_info < (3,8):
+    sys.exit('Sorry, Python < 3.8 is not supported')
 
 
 #-------------------------------------------------------------------------------
@@ -73,7 +93,7 @@ bring a large speedup.
 
 For completeness, a minimal Cython module is included.
 
-Supports Python 2.7 and 3.4.
+Supports Python 3.8 and higher.
 
 """
 
@@ -90,11 +110,43 @@ Supports Python 2.7 and 3.4.
 include_dirs = ["."]
 #include_dirs = [".", np.get_include()]
 
+# The extensions use cython.pymutex and the freethreading_compatible directive,
+# both new in Cython 3.1. Without Cython, the shipped C sources are compiled.
+
+MIN_CYTHON_VERSION = (3, 1)
+
+try:
+    import Cython
+except ImportError:
+    pass
+else:
+    if tuple(int(v) for v in re.match(r"(\d+)\.(\d+)", Cython.__version__).groups()) < MIN_CYTHON_VERSION:
+        sys.exit("Cython >= {} is required, found {}".format(".".join(map(str, MIN_CYTHON_VERSION)), Cython.__version__))
+
+# Extensions that "cimport numpy" additionally need NumPy's C headers; they
+# are added by build_ext (see BuildExtCommand.finalize_options()), so that
+# NumPy is only imported once it has been installed as a build requirement.
+
+numpy_macros       = [("NPY_NO_DEPRECATED_API", "NPY_1_7_API_VERSION")]
+
 # Additional compiler and linker flags
 
 cflags  = []
 ldflags = []
 
+# OpenMP compiler and linker flags, for extensions using cython.parallel.prange.
+#
+# Apple's clang does not ship with OpenMP, so it is not used on Mac OS X by default.
+# Set the environment variable MYLIBRARY_OPENMP to 0 or 1 to disable or force it;
+# without OpenMP, the parallel loops simply run serially.
+
+if os.environ.get("MYLIBRARY_OPENMP", "0" if sys.platform == "darwin" else "1") == "1":
+    openmp_cflags  = ["-fopenmp"]
+    openmp_ldflags = ["-fopenmp"]
+else:
+    openmp_cflags  = []
+    openmp_ldflags = []
+
 # Additional libraries; always include libmath
 
 libraries = ["m"]
@@ -107,17 +159,12 @@ libraries = ["m"]
 # Automatic versioning based on https://github.com/cmarquardt/miniver2:
 
 def get_version_and_cmdclass(package_name):
-    try: # Python 3
-        from importlib.util import module_from_spec, spec_from_file_location
-        spec = spec_from_file_location('version',
-                                       os.path.join(package_name, "_version.py"))
-        module = module_from_spec(spec)
-        spec.loader.exec_module(module)
-        return module.__version__, module.cmdclass
-    except: # Python 2
-        import imp
-        module = imp.load_source(package_name.split('.')[-1], os.path.join(package_name, "_version.py"))
-        return module.__version__, module.cmdclass
+    from importlib.util import module_from_spec, spec_from_file_location
+    spec = spec_from_file_location('version',
+                                   os.path.join(package_name, "_version.py"))
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.__version__, module.cmdclass
 
 version, ver_cmdclass = get_version_and_cmdclass('mylibrary')
 
@@ -153,7 +200,117 @@ class CythonizeCommand(Command):
         else:
             print("WARNING: Nothing found to cythonize...")
 
+# Build command with optional profile-guided and link-time optimization
+
+class BuildExtCommand(build_ext_orig, object):
+    user_options = build_ext_orig.user_options + [
+        ("pgo", None, "profile-guided optimization, trained with mylibrary/_pgo_training.py [env: MYLIBRARY_PGO]"),
+        ("lto", None, "link-time optimization [env: MYLIBRARY_LTO]"),
+        ("pgo-dir=", None, "directory for the profile data [default: <build-temp>/pgo]"),
+    ]
+    boolean_options = build_ext_orig.boolean_options + ["pgo", "lto"]
+
+    def initialize_options(self):
+        super(BuildExtCommand, self).initialize_options()
+        self.pgo = None
+        self.lto = None
+        self.pgo_dir = None
+
+    def finalize_options(self):
+        super(BuildExtCommand, self).finalize_options()
+        if self.pgo is None:
+            self.pgo = os.environ.get("MYLIBRARY_PGO", "0") == "1"
+        if self.lto is None:
+            self.lto = os.environ.get("MYLIBRARY_LTO", "0") == "1"
+        if self.pgo_dir is None:
+            self.pgo_dir = os.path.join(self.build_temp, "pgo")
+        self.pgo_dir = os.path.abspath(self.pgo_dir)
+
+        import numpy as np
+        for ext in self.extensions:
+            if numpy_macros[0] in (ext.define_macros or []) and np.get_include() not in ext.include_dirs:
+                ext.include_dirs.append(np.get_include())
+
+    def run(self):
+        if not (self.pgo or self.lto):
+            super(BuildExtCommand, self).run()
+            return
+        clang = self.compiler_is_clang()
+        lto = [] if not self.lto else ["-flto"] if clang else ["-flto=auto"]
+        if not self.pgo:
+            self.build_with_flags(lto)
+            return
+
+        shutil.rmtree(self.pgo_dir, ignore_errors=True)
+        os.makedirs(self.pgo_dir)
+        self.force = True
+
+        print("PGO: building instrumented extensions")
+        self.build_with_flags(["-fprofile-generate=" + self.pgo_dir])
+
+        print("PGO: running the training workload")
+        self.train()
+
+        print("PGO: building optimized extensions")
+        if clang:
+            profile = os.path.join(self.pgo_dir, "merged.profdata")
+            subprocess.check_call(self.llvm_profdata() + ["merge", "-output=" + profile] +
+                                  glob.glob(os.path.join(self.pgo_dir, "*.profraw")))
+            use = ["-fprofile-use=" + profile, "-Wno-profile-instr-unprofiled"]
+        else:
+            use = ["-fprofile-use=" + self.pgo_dir, "-fprofile-correction", "-Wno-missing-profile"]
+        self.build_with_flags(use + lto)
+
+    # Build all extensions, with flags added to their compiler and linker flags.
+    def build_with_flags(self, flags):
+        saved = [(ext.extra_compile_args, ext.extra_link_args) for ext in self.extensions]
+        compiler = self.compiler  # build_ext.run() replaces the name by a compiler object
+        try:
+            for ext in self.extensions:
+                ext.extra_compile_args = list(ext.extra_compile_args or []) + flags
+                ext.extra_link_args = list(ext.extra_link_args or []) + flags
+            super(BuildExtCommand, self).run()
+        finally:
+            for ext, (cflags_, ldflags_) in zip(self.extensions, saved):
+                ext.extra_compile_args, ext.extra_link_args = cflags_, ldflags_
+            self.compiler = compiler
+
+    # Run the training workload on the instrumented extensions, with a fixed
+    # configuration, so that the profile is reproducible.
+    def train(self):
+        if self.inplace:
+            path = os.getcwd()
+        else:
+            self.run_command("build_py")
+            path = os.path.abspath(self.build_lib)
+        env = dict(os.environ, PYTHONPATH=path, PYTHONHASHSEED="0",
+                   MYLIBRARY_NUM_THREADS="2", MYLIBRARY_ASYNC_WORKERS="1")
+        for name in ("MYLIBRARY_SIMD", "MYLIBRARY_STATS"):
+            env.pop(name, None)
+        # Outside the source tree, so that "import mylibrary" finds the build
+        subprocess.check_call([sys.executable, "-m", "mylibrary._pgo_training"], env=env, cwd=self.pgo_dir)
+
+    def compiler_is_clang(self):
+        if self.compiler == "msvc" or (self.compiler is None and sys.platform == "win32"):
+            sys.exit("PGO and LTO builds need GCC or clang")
+        cc = (os.environ.get("CC") or sysconfig.get_config_var("CC") or "cc").split()
+        try:
+            version = subprocess.check_output(cc + ["--version"], universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError):
+            sys.exit("PGO and LTO builds need GCC or clang; cannot run {}".format(cc[0]))
+        return "clang" in version
+
+    def llvm_profdata(self):
+        if os.environ.get("LLVM_PROFDATA"):
+            return [os.environ["LLVM_PROFDATA"]]
+        if shutil.which("llvm-profdata"):
+            return ["llvm-profdata"]
+        if sys.platform == "darwin":
+            return ["xcrun", "llvm-profdata"]
+        sys.exit("PGO builds with clang need llvm-profdata; set LLVM_PROFDATA to its path")
+
 cmdclass = {"clean": CleanCommand,
+            "build_ext": BuildExtCommand,
             "cython": CythonizeCommand,
             "cythonise": CythonizeCommand,
             "cythonize": CythonizeCommand
@@ -172,7 +329,7 @@ cmdclass.update(ver_cmdclass)
 #
 # Directories (relative to the top-level directory where setup.py resides) in which to look for data files.
 
-datadirs  = ("test",)
+datadirs  = ("test", "bench")
 
 # File extensions to be considered as data files. (Literal, no wildcards.)
 
@@ -212,6 +369,14 @@ datafiles.append( ('.', detected_docs) )
 # Declare Cython extension modules
 
 ext_modules = []
+ext_modules.append(Extension("mylibrary._stats",
+                             ["mylibrary/_stats.pyx"],
+                             extra_compile_args = cflags,
+                             extra_link_args    = ldflags,
+                             include_dirs       = include_dirs,
+                             libraries          = libraries)
+                   )
+
 ext_modules.append(Extension("mylibrary.dostuff",
                              ["mylibrary/dostuff.pyx"],
                              extra_compile_args = cflags,
@@ -222,9 +387,21 @@ ext_modules.append(Extension("mylibrary.dostuff",
 
 ext_modules.append(Extension("mylibrary.compute",
                              ["mylibrary/compute.pyx"],
-                             extra_compile_args = cflags,
-                             extra_link_args    = ldflags,
-                             include_dirs       = include_dirs,
+                             depends            = ["mylibrary/_sqrt_simd.h"],
+                             extra_compile_args = cflags + openmp_cflags,
+                             extra_link_args    = ldflags + openmp_ldflags,
+                             define_macros      = numpy_macros,
+                             include_dirs       = list(include_dirs),
+                             libraries          = libraries)
+                   )
+
+ext_modules.append(Extension("mylibrary.expr",
+                             ["mylibrary/expr.pyx"],
+                             depends            = ["mylibrary/compute.pxd"],
+                             extra_compile_args = cflags + openmp_cflags,
+                             extra_link_args    = ldflags + openmp_ldflags,
+                             define_macros      = numpy_macros,
+                             include_dirs       = list(include_dirs),
                              libraries          = libraries)
                    )
 
@@ -278,6 +455,13 @@ setup(
                     "Operating System :: MacOS :: MacOS X",
                     "Programming Language :: Cython",
                     "Programming Language :: Python",
+                    "Programming Language :: Python :: 3",
+                    "Programming Language :: Python :: 3 :: Only",
+                    "Programming Language :: Python :: 3.8",
+                    "Programming Language :: Python :: 3.9",
+                    "Programming Language :: Python :: 3.10",
+                    "Programming Language :: Python :: 3.11",
+                    "Programming Language :: Python :: 3.12",
                     "Topic :: Scientific/Engineering",
                     "Topic :: Scientific/Engineering :: Mathematics",
                     "Topic :: Software Development :: Libraries",
@@ -286,6 +470,7 @@ setup(
 
     # See http://setuptools.readthedocs.io/en/latest/setuptools.html
 
+    python_requires  = ">=3.8",  # os.cpu_count(), asyncio.get_running_loop(), multiprocessing.shared_memory
     setup_requires   = ["setuptools>=18.0", "numpy", "pytest-runner"],
     install_requires = ["numpy"],
 
@@ -3,12 +3,31 @@
 # cython: wraparound  = False
 # cython: boundscheck = False
 # cython: cdivision   = True
+# cython: freethreading_compatible = True
 """Example Cython module."""  # this is the Python-level docstring
 
 from __future__ import division, print_function, absolute_import
 
+# The C-level API of mylibrary.compute (see mylibrary/compute.pxd), used from
+# another extension module by norm() and sqrt_inplace().
+#
+cimport mylibrary.compute as compute
+
 # Silly example: check if input is 42, return True or False.
 #
 def g(int x):
     return (x == 42)
 
+
+def norm(double[::1] x):
+    cdef double s = 0.0
+    cdef Py_ssize_t i
+    with nogil:
+        for i in range(x.shape[0]):
+            s += x[i] * x[i]
+    return compute.sqrt_d(s)
+
+def sqrt_inplace(double[::1] x):
+    if x.shape[0]:
+        with nogil:
+            compute.sqrt_array_d(&x[0], &x[0], x.shape[0])
@@ -3,15 +3,24 @@
 
 from __future__ import division, print_function, absolute_import
 
+import asyncio
+import io
+import os
+import subprocess
 import sys
+import threading
+from contextlib import redirect_stdout
 
 import numpy as np
+import pytest
 
 # This requires mylibrary to be compiled and installed first (using the top-level setup.py).
 #
 try:
+    import mylibrary
     import mylibrary.dostuff as dostuff
     import mylibrary.compute as compute
+    import mylibrary.expr as expr
 except ImportError:
     print( "ERROR: mylibrary not found; is it installed (in this Python)?", file = sys.stderr )
     raise
@@ -51,5 +60,788 @@ def test():
         print("**FAIL** cython_module.g()")
 
 
+def test_hello_many(tmp_path):
+    lines = ["line {}".format(i) for i in range(1000)] + ["", u"\u00e4\u00f6\u00fc", "x" * 300]
+    expected = ("\n".join(lines) + "\n").encode("utf-8")
+
+    # Buffer sizes smaller than, similar to, and larger than the lines
+    for flush_size in (1, 7, 256, 65536):
+        with open(str(tmp_path / "out.txt"), "wb") as f:
+            dostuff.hello_many(iter(lines), fd=f.fileno(), flush_size=flush_size)
+        with open(str(tmp_path / "out.txt"), "rb") as f:
+            assert f.read() == expected
+
+    # Streams without a file descriptor
+    with redirect_stdout(io.StringIO()) as out:
+        dostuff.hello_many(lines, flush_size=100)
+    assert out.getvalue().encode("utf-8") == expected
+
+    # Lines written before an error are still flushed
+    with open(str(tmp_path / "out.txt"), "wb") as f:
+        with pytest.raises(TypeError):
+            dostuff.hello_many(["a", "b", 3], fd=f.fileno())
+    with open(str(tmp_path / "out.txt"), "rb") as f:
+        assert f.read() == b"a\nb\n"
+    with redirect_stdout(io.StringIO()) as out:
+        with pytest.raises(TypeError):
+            dostuff.hello_many(["a", "b", 3, "c"])
+    assert out.getvalue() == "a\nb\n"
+
+
+def test_stats(tmp_path):
+    previous = mylibrary.enable_stats(False)
+    try:
+        mylibrary.reset_stats()
+        compute.f(np.ones(10))
+        assert mylibrary.stats()["compute.f"]["calls"] == 0
+
+        mylibrary.enable_stats()
+        compute.f(np.ones(1000))
+        compute.f(np.ones((3, 4), dtype=np.float32).T)
+        compute.map([np.ones(5), np.ones(6, dtype=np.int8)])
+        with redirect_stdout(io.StringIO()):
+            dostuff.hello("Hello")
+        with open(str(tmp_path / "out.txt"), "wb") as f:
+            dostuff.hello_many(["a", "bc"], fd=f.fileno())
+
+        stats = mylibrary.stats(reset=True)
+        f = stats["compute.f"]
+        assert f["calls"] == 2 and f["elements"] == 1012
+        assert f["bytes_in"] == f["bytes_out"] == 8000 + 48
+        assert f["histogram"] == {512: 1, 8: 1}
+        assert f["seconds"] > 0
+        assert stats["compute.map"]["elements"] == 11 and stats["compute.map"]["bytes_in"] == 46
+        assert stats["dostuff.hello"]["calls"] == 1 and stats["dostuff.hello"]["bytes_out"] == 6
+        assert stats["dostuff.hello_many"]["elements"] == 2 and stats["dostuff.hello_many"]["bytes_out"] == 5
+        assert mylibrary.stats()["compute.f"]["calls"] == 0
+    finally:
+        mylibrary.enable_stats(previous)
+        mylibrary.reset_stats()
+
+
+def test_pgo_training():
+    # The training workload of PGO builds (see setup.py) must keep working
+    import mylibrary._pgo_training
+    mylibrary._pgo_training.run(scale=0.1)
+
+
+# Run code in a fresh interpreter, counting the subprocesses it starts
+#
+_count_subprocesses = """
+import subprocess
+_calls = []
+_Popen = subprocess.Popen
+class Popen(_Popen):
+    def __init__(self, *args, **kwargs):
+        _calls.append(args)
+        _Popen.__init__(self, *args, **kwargs)
+subprocess.Popen = Popen
+"""
+
+
+def test_version():
+    # Importing mylibrary must not run git (or even import setuptools)
+    code = "import sys, mylibrary; print(len(_calls), 'setuptools' in sys.modules)"
+    assert subprocess.check_output([sys.executable, "-c", _count_subprocesses + code]).split() == [b"0", b"False"]
+
+    # The version is computed on first access, and cached for the current state
+    # of the checkout if it has been built
+    from mylibrary import _version
+    code = "import mylibrary; print(mylibrary.__version__, len(_calls))"
+    first = subprocess.check_output([sys.executable, "-c", _count_subprocesses + code]).split()
+    second = subprocess.check_output([sys.executable, "-c", _count_subprocesses + code]).split()
+    assert first[0] == second[0]
+    if os.path.isdir(_version.CACHE_DIR):
+        assert second[1] == b"0"
+
+
+def test_version_cache(tmp_path, monkeypatch):
+    # The cache key changes with HEAD (see get_version()), the index and the tags
+    from mylibrary import _version
+    git_dir = tmp_path / ".git"
+    (git_dir / "refs" / "tags").mkdir(parents=True)
+    states = [_version.get_git_state(str(git_dir))]
+    (git_dir / "index").write_bytes(b"DIRC")
+    states.append(_version.get_git_state(str(git_dir)))
+    (git_dir / "refs" / "tags" / "v1.0").write_text(u"0" * 40)
+    states.append(_version.get_git_state(str(git_dir)))
+    (git_dir / "packed-refs").write_text(u"0" * 40 + u" refs/tags/v0.9\n")
+    states.append(_version.get_git_state(str(git_dir)))
+    assert len(set(states)) == 4
+
+    # The cache lives in the build directory, and is not written without one
+    monkeypatch.setattr(_version, "CACHE_DIR", str(tmp_path / "build"))
+    _version.write_cached_version("key", "1.0")
+    assert _version.read_cached_version("key") is None
+    (tmp_path / "build").mkdir()
+    _version.write_cached_version("key", "1.0")
+    assert _version.read_cached_version("key") == "1.0"
+    assert _version.read_cached_version("other") is None
+
+
+def test_compute_threads():
+    # Results must not depend on how the work is split across threads
+    x  = np.arange(1000000, dtype=np.float64)
+    y1 = np.sqrt(x)
+    for num_threads in (1, 2, 7):
+        assert np.array_equal( compute.f(x, num_threads=num_threads), y1 )
+
+    # The process-wide default can be changed and restored
+    default = compute.get_num_threads()
+    try:
+        compute.set_num_threads(3)
+        assert compute.get_num_threads() == (3 if compute.HAVE_OPENMP else 1)
+        assert np.array_equal( compute.f(x), y1 )
+    finally:
+        compute.set_num_threads(default)
+
+    for bad in (0, -1):
+        with pytest.raises(ValueError):
+            compute.f(x, num_threads=bad)
+
+
+def test_compute_out():
+    x  = np.arange(1000, dtype=np.float64)
+    y1 = np.sqrt(x)
+
+    # Preallocated output buffer is filled and returned
+    out = np.empty_like(x)
+    assert compute.f(x, out=out) is out
+    assert np.array_equal( out, y1 )
+
+    # In-place operation
+    z = x.copy()
+    assert compute.f(z, out=z) is z
+    assert np.array_equal( z, y1 )
+
+    # Wrong shape, wrong dtype, or partial overlap with the input are rejected
+    for bad in (np.empty(999), np.empty(1000, dtype=np.float32), np.empty((1000, 1))):
+        with pytest.raises(ValueError):
+            compute.f(x, out=bad)
+    with pytest.raises(ValueError):
+        compute.f(z[:-1], out=z[1:])
+
+
+def test_compute_buffers(tmp_path):
+    import array
+    x = np.arange(100000, dtype=np.float64)
+    y = np.sqrt(x)
+
+    # Read-only inputs, on every path
+    xm = np.memmap(str(tmp_path / "in.bin"), dtype=np.float64, mode="w+", shape=x.shape)
+    xm[:] = x
+    xm.flush()
+    xr = np.memmap(str(tmp_path / "in.bin"), dtype=np.float64, mode="r", shape=x.shape)
+    assert np.array_equal( compute.f(xr, num_threads=2), y )
+    assert np.array_equal( compute.f(xr, precision="fast"), compute.f(x, precision="fast") )
+    assert np.array_equal( compute.f(xr.reshape(100, 1000).T), y.reshape(100, 1000).T )
+    assert np.array_equal( compute.f_chunked(xr, chunk_size=30000), y )
+    assert np.array_equal( asyncio.run(compute.f_async(xr, chunk_size=30000)), y )
+    assert compute.f(np.frombuffer(b"\x10\x00\x00\x00\x51\x00\x00\x00", np.int32)).tolist() == [4, 9]
+
+    # Other buffer exporters, with the result as np.array or of the same type
+    a = array.array("d", [4.0, 9.0])
+    assert isinstance(compute.f(a), np.ndarray)
+    r = compute.f(a, like_input=True)
+    assert isinstance(r, array.array) and r.typecode == "d" and r.tolist() == [2.0, 3.0]
+    assert compute.f(a, out=a) is a and a.tolist() == [2.0, 3.0]
+    r = compute.f(bytes([0, 1, 4, 255]), like_input=True)
+    assert isinstance(r, bytearray) and list(r) == [0, 1, 2, 15]
+    r = compute.f(memoryview(np.array([[16.0], [25.0]])), like_input=True)
+    assert isinstance(r, memoryview) and r.shape == (2, 1) and r.tolist() == [[4.0], [5.0]]
+
+    # ...but never written to, if read-only
+    with pytest.raises(ValueError):
+        compute.f(xr, out=xr)
+
+
+def test_compute_dtypes():
+    # Floating point and complex inputs keep their dtype
+    for dtype in (np.float32, np.float64, np.complex64, np.complex128):
+        x = np.linspace(0, 100, 1001).astype(dtype)
+        y = compute.f(x)
+        assert y.dtype == x.dtype
+        assert np.allclose( y, np.sqrt(x) )
+    z = np.array([-4.0, 3.0 + 4.0j, -1.0j], dtype=np.complex128)
+    assert np.allclose( compute.f(z), np.sqrt(z) )
+
+    # Integer inputs give the exact integer square root
+    for dtype in (np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64):
+        top = np.iinfo(dtype).max
+        x = np.append( np.arange(1000, dtype=dtype) * dtype(top // 999), dtype(top) )
+        y = compute.f(x)
+        assert y.dtype == x.dtype
+        assert all( int(r)**2 <= int(v) < (int(r) + 1)**2 for r, v in zip(y, x) )
+    big = np.array([2**64 - 1, 2**63, (2**32 - 1)**2, (2**32 - 1)**2 - 1], dtype=np.uint64)
+    assert compute.f(big).tolist() == [2**32 - 1, 3037000499, 2**32 - 1, 2**32 - 2]
+
+    for bad, exc in ((np.array([4, -1]), ValueError), (np.array([True]), TypeError)):
+        with pytest.raises(exc):
+            compute.f(bad)
+
+
+def test_compute_layouts():
+    a = np.arange(6000, dtype=np.float64).reshape(60, 100)
+
+    # Contiguous N-d arrays keep their shape and memory order
+    for x in (a, np.asfortranarray(a), a.T, a.reshape(20, 3, 100)):
+        y = compute.f(x)
+        assert y.shape == x.shape
+        assert y.flags.c_contiguous == x.flags.c_contiguous
+        assert y.flags.f_contiguous == x.flags.f_contiguous
+        assert np.array_equal( y, np.sqrt(x) )
+
+    # Strided views are processed without copies, the result is contiguous
+    for x in (a[:, 7], a[3, ::2], a[::2, ::3], a[::-1], a.reshape(20, 3, 100)[:, 1, ::4], a[:0, :0]):
+        y = compute.f(x)
+        assert y.shape == x.shape
+        assert y.flags.c_contiguous or y.flags.f_contiguous
+        assert np.array_equal( y, np.sqrt(x) )
+
+    # Sub-blocks of N-d arrays, in every memory order, also split across threads
+    b = np.arange(-200000, 200000, dtype=np.float64).reshape(-1, 10)
+    for x in (b[:, :3], b.T[:3], b[::-1, 2:5], b.reshape(-1, 8, 10)[:, 1:3, ::4], np.asfortranarray(b)[1:, 1:]):
+        for num_threads in (1, 4):
+            y, bad = compute.f(x, num_threads=num_threads, errors="nan_count")
+            with np.errstate(invalid="ignore"):
+                assert np.array_equal( y, np.sqrt(x), equal_nan=True )
+            assert bad == np.count_nonzero(x < 0)
+        with pytest.raises(ValueError) as info:
+            compute.f(x, errors="raise")
+        assert str(tuple(int(i) for i in np.unravel_index(np.argmax(x < 0), x.shape))) in str(info.value)
+
+    # Output buffers with a different layout than the input, and in-place on strided views
+    out = np.empty((100, 60), dtype=np.float64).T
+    assert compute.f(a, out=out) is out
+    assert np.array_equal( out, np.sqrt(a) )
+    b = a.copy()
+    compute.f(b[:, 7], out=b[:, 7])
+    assert np.array_equal( b[:, 7], np.sqrt(a[:, 7]) )
+    assert np.array_equal( b[:, 8], a[:, 8] )
+
+    # Zero-dimensional input
+    assert compute.f(np.float64(16.0)) == 4.0
+
+
+def test_compute_simd():
+    assert "generic" in compute.supported_simd_kernels()
+    assert compute.get_simd_kernel() in compute.supported_simd_kernels()
+
+    # Every kernel must give correctly rounded results, including the special
+    # values and the tails that don't fill a whole vector
+    special = [0.0, -0.0, -1.0, np.inf, -np.inf, np.nan, 1e-40, 3e38]
+    default = compute.get_simd_kernel()
+    try:
+        for kernel in compute.supported_simd_kernels():
+            compute.set_simd_kernel(kernel)
+            assert compute.get_simd_kernel() == kernel
+            for dtype in (np.float32, np.float64):
+                for n in list(range(40)) + [100003]:
+                    x = np.resize( np.array(special + list(np.random.rand(97) * 1e3), dtype=dtype), n )
+                    with np.errstate(invalid="ignore"):
+                        y = np.sqrt(x)
+                    assert np.array_equal( compute.f(x), y, equal_nan=True )
+                    compute.f(x, out=x)
+                    assert np.array_equal( x, y, equal_nan=True )
+    finally:
+        compute.set_simd_kernel(default)
+
+    with pytest.raises(ValueError):
+        compute.set_simd_kernel("mmx")
+
+
+def test_compute_precision():
+    # Documented bounds of the maximum relative error, per precision and dtype
+    bounds = {"exact": {np.float32: 6e-8, np.float64: 1.2e-16},
+              "fast": {np.float32: 4e-7, np.float64: 5e-16},
+              "approx": {np.float32: 4e-4, np.float64: 4e-4}}
+    default = compute.get_simd_kernel()
+    try:
+        for kernel in compute.supported_simd_kernels():
+            compute.set_simd_kernel(kernel)
+            for dtype in (np.float32, np.float64):
+                special = [0.0, -0.0, -1.0, np.inf, -np.inf, np.nan, np.finfo(dtype).smallest_subnormal]
+                x = np.exp(np.random.uniform(-80, 80, 10003)).astype(dtype)
+                ref = np.sqrt(x.astype(np.float64 if dtype is np.float32 else np.longdouble))
+                with np.errstate(invalid="ignore"):
+                    exact = np.sqrt(np.array(special, dtype=dtype))
+                for precision, bound in bounds.items():
+                    y = compute.f(x, precision=precision)
+                    assert y.dtype == dtype
+                    assert np.max(np.abs(y - ref) / ref) < bound[dtype]
+                    # special values are exact; in place, with tails
+                    for n in range(1, 40):
+                        z = np.resize( np.array(special, dtype=dtype), n )
+                        compute.f(z, out=z, precision=precision)
+                        assert np.array_equal( z, np.resize(exact, n), equal_nan=True )
+                if kernel == "generic":
+                    assert np.array_equal( compute.f(x, precision="approx"), compute.f(x) )
+    finally:
+        compute.set_simd_kernel(default)
+
+    with pytest.raises(ValueError):
+        compute.f(np.ones(3), precision="sloppy")
+
+
+def test_compute_errors():
+    import mylibrary._compute_numpy as fallback
+    for module in (compute, fallback):
+        for dtype in (np.float32, np.float64):
+            # Long enough for several tiles and threads; contiguous and strided
+            x = np.random.rand(100000).astype(dtype)
+            x[[5, 70000, 99999]] = [-1, np.nan, -np.inf]
+            x[6] = -0.0
+            for xs in (x, x.reshape(1000, 100).T, x[::-1]):
+                with np.errstate(invalid="ignore"):
+                    y = np.sqrt(xs)
+                assert np.array_equal( module.f(xs, num_threads=2), y, equal_nan=True )
+                assert np.array_equal( module.f(xs, errors="ignore"), y, equal_nan=True )
+                r, count = module.f(xs, errors="nan_count", num_threads=2)
+                assert count == 3 and np.array_equal( r, y, equal_nan=True )
+                assert np.array_equal( module.f(xs, errors="clip"), np.where(xs < 0, 0, y), equal_nan=True )
+                with pytest.raises(ValueError) as info:
+                    module.f(xs, errors="raise")
+                first = np.argwhere(~(xs >= 0))[0]
+                assert str(tuple(int(i) for i in first)) in str(info.value)
+            assert module.f(x[10:60000], errors="raise", precision="fast")[0] >= 0
+            assert module.f(x[:5].copy(), errors="nan_count")[1] == 0
+
+        # Integers raise by default; the other policies give 0
+        x = np.array([[4, -9], [16, -1]], dtype=np.int16)
+        for kwargs in ({}, {"errors": "raise"}):
+            with pytest.raises(ValueError) as info:
+                module.f(x, **kwargs)
+            assert "(0, 1)" in str(info.value)
+        assert module.f(x, errors="ignore").tolist() == [[2, 0], [4, 0]]
+        assert module.f(x, errors="clip").tolist() == [[2, 0], [4, 0]]
+        r, count = module.f(x, errors="nan_count")
+        assert count == 2 and r.tolist() == [[2, 0], [4, 0]]
+
+        # Complex inputs are never invalid
+        assert module.f(np.array([-4 + 0j]), errors="nan_count")[1] == 0
+
+        with pytest.raises(ValueError):
+            module.f(x, errors="warn")
+
+
+def test_compute_ufunc():
+    assert isinstance(compute.sqrt, np.ufunc)
+
+    # Same results and dtypes as f()
+    for dtype in (np.float32, np.float64, np.complex64, np.complex128, np.int16, np.uint64):
+        x = np.arange(1000).astype(dtype)
+        y = compute.sqrt(x)
+        assert y.dtype == x.dtype
+        assert np.array_equal( y, compute.f(x) )
+
+    # Broadcasting, out=, where=, strided views, array-likes and subclasses
+    a = np.arange(12.0).reshape(3, 4)
+    assert np.array_equal( compute.sqrt(a[:, ::2]), np.sqrt(a[:, ::2]) )
+    out = np.full_like(a, -1.0)
+    assert compute.sqrt(a, out=out, where=a > 5) is out
+    assert np.array_equal( out, np.where(a > 5, np.sqrt(a), -1.0) )
+    assert compute.sqrt([1, 4, 9]).tolist() == [1, 2, 3]
+    assert isinstance( compute.sqrt(np.ma.masked_array(a)), np.ma.MaskedArray )
+
+    # Negative integers are reported like invalid floating-point operations
+    with np.errstate(invalid="raise"):
+        with pytest.raises(FloatingPointError):
+            compute.sqrt(np.array([4, -1]))
+
+
+def test_compute_capi():
+    # The C-level API is exported for cimport (see mylibrary/compute.pxd)
+    assert set(compute.__pyx_capi__) >= {"sqrt_d", "sqrt_f", "isqrt", "sqrt_array_d", "sqrt_array_f"}
+
+    # ...and used by the local Cython module
+    x = np.arange(1000, dtype=np.float64)
+    assert np.isclose( cython_module.norm(x), np.sqrt(np.sum(x * x)) )
+    y = x.copy()
+    cython_module.sqrt_inplace(y)
+    assert np.array_equal( y, np.sqrt(x) )
+    cython_module.sqrt_inplace(np.empty(0))
+
+
+def test_compute_async():
+    # asyncio and the executor are only imported by the first call
+    for backend in ("cython", "numpy"):
+        code = "import sys, mylibrary.compute; print(mylibrary.compute.BACKEND, 'asyncio' in sys.modules, 'concurrent.futures' in sys.modules)"
+        env = dict(os.environ, MYLIBRARY_BACKEND=backend)
+        assert subprocess.check_output([sys.executable, "-c", code], env=env).split() == [backend.encode(), b"False", b"False"]
+
+    x = np.arange(100000, dtype=np.float64)
+    y = np.sqrt(x)
+
+    async def main():
+        # Single arrays, whole or in blocks, interleaved with other coroutines
+        ticks = []
+        async def ticker():
+            for i in range(10):
+                ticks.append(i)
+                await asyncio.sleep(0)
+        results = await asyncio.gather( compute.f_async(x), compute.f_async(x.reshape(100, 1000), chunk_size=3000), ticker() )
+        assert np.array_equal( results[0], y )
+        assert np.array_equal( results[1], y.reshape(100, 1000) )
+        assert len(ticks) == 10
+
+        # Batches
+        outs = [np.empty(10), None]
+        results = await compute.f_async_batch([x[:10], x], outs=outs)
+        assert results[0] is outs[0]
+        assert np.array_equal( results[0], y[:10] )
+        assert np.array_equal( results[1], y )
+
+        # Cancellation drops the blocks that have not started yet (here: all
+        # of them, as the single worker is busy until then)
+        out = np.full_like(x, -1.0)
+        busy = threading.Event()
+        compute._common.get_async_executor().submit(busy.wait)
+        task = asyncio.ensure_future( compute.f_async(x, out=out, chunk_size=10) )
+        await asyncio.sleep(0)
+        task.cancel()
+        try:
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        finally:
+            busy.set()
+        assert (out == -1.0).all()
+
+    workers = compute.get_async_workers()
+    try:
+        compute.set_async_workers(1)
+        asyncio.run(main())
+    finally:
+        compute.set_async_workers(workers)
+
+
+def test_compute_map():
+    xs = [np.arange(10, dtype=np.float64), np.arange(24, dtype=np.float32).reshape(4, 6),
+          np.arange(100, dtype=np.int32)[::3], np.arange(24.0).reshape(4, 6).T[::2],
+          np.arange(3 * compute.DEFAULT_CHUNK_SIZE // 2, dtype=np.float64)]
+    for workers in (1, 2):
+        results = compute.map(xs, workers=workers)
+        assert len(results) == len(xs)
+        for x, res in zip(xs, results):
+            assert res.dtype == x.dtype and res.shape == x.shape
+            assert np.array_equal( res, np.sqrt(x).astype(x.dtype) )
+
+    # Preallocated output arrays, and a single ragged buffer
+    outs = [np.empty(10), np.empty(5)]
+    results = compute.map([xs[0], xs[0][:5]], out=outs)
+    assert results[0] is outs[0] and results[1] is outs[1]
+    assert np.array_equal( outs[1], np.sqrt(xs[0][:5]) )
+    buf = np.empty(10 + 12)
+    results = compute.map([xs[0], xs[3]], out=buf)
+    assert np.shares_memory(results[1], buf) and results[1].shape == (3, 4)
+    assert np.array_equal( buf, np.sqrt(np.concatenate([xs[0], xs[3].ravel()])) )
+    assert compute.map([]) == []
+
+    # New results share one buffer, keeping the order of contiguous inputs
+    f_order = np.asfortranarray(xs[1])
+    results = compute.map([xs[0], f_order, np.empty(0), np.float64(4.0)])
+    assert results[1].flags.f_contiguous and np.array_equal( results[1], np.sqrt(f_order) )
+    assert results[2].shape == (0,) and results[3].shape == () and results[3] == 2.0
+    assert results[0].base is results[1].base
+
+    # A ragged buffer may hold the inputs themselves (in place), but not overlap them otherwise
+    buf = np.arange(20.0)
+    results = compute.map([buf[:10], buf[10:]], out=buf)
+    assert np.array_equal( buf, np.sqrt(np.arange(20.0)) )
+    with pytest.raises(ValueError):
+        compute.map([buf[1:11], buf[11:]], out=buf[:19])
+
+    for args, kw, error in (([[np.arange(3) - 1]], {}, ValueError),
+                            ([[np.zeros(3, dtype=np.float16)]], {}, TypeError),
+                            ([xs[:2]], dict(out=np.empty(34)), ValueError),
+                            ([xs[:2]], dict(out=[np.empty(10)]), ValueError)):
+        with pytest.raises(error):
+            compute.map(*args, **kw)
+
+
+def test_compute_processes(tmp_path):
+    def segments():
+        return set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+    before = segments()
+
+    x = np.arange(100000, dtype=np.float64)
+    y = np.sqrt(x)
+    workers = compute.get_process_workers()
+    try:
+        compute.set_process_workers(2)
+        assert np.array_equal( compute.f_processes(x, chunk_size=30000), y )
+        assert np.array_equal( compute.f_processes(x.reshape(100, 1000).T, chunk_size=7000), y.reshape(100, 1000).T )
+
+        # In place, and memory-mapped input and output (shared through their files)
+        z = x.copy()
+        assert compute.f_processes(z, out=z) is z
+        assert np.array_equal( z, y )
+        xm = np.memmap(str(tmp_path / "in.bin"), dtype=np.float64, mode="w+", shape=x.shape)
+        xm[:] = x
+        om = np.memmap(str(tmp_path / "out.bin"), dtype=np.float64, mode="w+", shape=x.shape)
+        assert compute.f_processes(xm, out=om) is om
+        assert np.array_equal( om, y )
+
+        with pytest.raises(ValueError):
+            compute.f_processes(np.arange(10) - 3)
+
+        # The workers are reused, and restarted after a shutdown
+        compute.shutdown_processes()
+        assert np.array_equal( compute.f_processes(x[:10]), y[:10] )
+    finally:
+        compute.set_process_workers(workers)
+        compute.shutdown_processes()
+    assert not {name for name in segments() - before if not name.startswith("sem.")}
+
+
+def test_expr():
+    a = np.random.rand(100003)
+    b = np.random.rand(100003)
+    x, y = expr.var("x"), expr.var("y")
+
+    # Same results as the step-by-step computation, in one pass
+    e = 2.5 * expr.sqrt(x * x + y * y)
+    assert np.array_equal( e.evaluate(x=a, y=b), 2.5 * compute.f(a * a + b * b) )
+    for num_threads in (1, 2):
+        assert np.array_equal( expr.evaluate(e, x=a, y=b, num_threads=num_threads), 2.5 * np.sqrt(a * a + b * b) )
+
+    # All operators, with constants on either side, and bound arrays
+    e = (1 - x) / 3 + abs(-y) ** 2 - 2 / (x + 1) + x ** 0.5 * expr.asexpr(b[::-1])
+    assert np.allclose( e.evaluate(x=a, y=b), (1 - a) / 3 + b ** 2 - 2 / (a + 1) + np.sqrt(a) * b[::-1] )
+
+    # Broadcasting, other dtypes and layouts, a single variable, and in-place
+    m = np.arange(12).reshape(3, 4)
+    assert np.array_equal( (x * y + 1).evaluate(x=m.T, y=np.arange(3.0)), m.T * np.arange(3.0) + 1 )
+    assert np.array_equal( x.evaluate(x=m), m )
+    c = a.copy()
+    assert expr.sqrt(x * x + y).evaluate(x=c, y=b, out=c) is c
+    assert np.array_equal( c, np.sqrt(a * a + b) )
+
+    # Strided, broadcast and converted inputs are read block by block
+    n = np.arange(3 * 2000, dtype=np.int16).reshape(3, 2000)
+    for num_threads in (1, 2):
+        assert np.array_equal( (x + y).evaluate(x=n[:, ::-2], y=a[:1000:, None].T.astype(np.float32), num_threads=num_threads),
+                               n[:, ::-2] + a[:1000].astype(np.float32).astype(np.float64) )
+
+    # out overlapping with an input other than element for element
+    buf = np.arange(1.0, 4001.0)
+    expected = np.sqrt(buf[:-1]) + 1
+    assert np.array_equal( (expr.sqrt(x) + 1).evaluate(x=buf[:-1], out=buf[1:]), expected )
+
+    # Compiled once per structure, whatever the constants and arrays
+    expr._compile.cache_clear()
+    for k in range(5):
+        (x * k + expr.asexpr(a)).evaluate(x=b)
+    info = expr._compile.cache_info()
+    assert info.misses == 1 and info.hits == 4
+
+    for e, values in ((x + y, dict(x=a)), (x + y, dict(x=a, y=np.ones(3)))):
+        with pytest.raises(ValueError):
+            e.evaluate(**values)
+    with pytest.raises(ValueError):
+        x.evaluate(x=a, num_threads=0)
+
+
+@pytest.mark.skipif(not os.environ.get("MYLIBRARY_TEST_LARGE"),
+                    reason="needs 2 GB of disk space; set MYLIBRARY_TEST_LARGE=1 to run")
+def test_compute_large(tmp_path):
+    # More elements than fit into a 32-bit index, in a (sparse) memory-mapped file
+    n = 2**31 + 4096
+    x = np.memmap(str(tmp_path / "large.bin"), dtype=np.uint8, mode="w+", shape=(n,))
+    x[[2**31 - 1, 2**31, n - 1]] = [4, 9, 16]
+    compute.f(x, out=x)
+    assert x[[0, 2**31 - 1, 2**31, n - 1]].tolist() == [0, 2, 3, 4]
+
+
+def test_compute_streaming(tmp_path):
+    x = np.arange(100000, dtype=np.float64)
+    y = np.sqrt(x)
+
+    # Memory-mapped input and output, processed in blocks
+    xm = np.memmap(str(tmp_path / "in.bin"), dtype=np.float64, mode="w+", shape=x.shape)
+    xm[:] = x
+    om = np.memmap(str(tmp_path / "out.bin"), dtype=np.float64, mode="w+", shape=x.shape)
+    assert compute.f_chunked(xm, out=om, chunk_size=4096) is om
+    assert np.array_equal( om, y )
+
+    # N-d arrays are split along the first axis; chunk_size need not divide the length
+    x2 = x.reshape(1000, 100)
+    assert np.array_equal( compute.f_chunked(x2, chunk_size=350), y.reshape(1000, 100) )
+
+    # out is checked as a whole, not only block by block
+    buf = np.arange(1.0, 13.0)
+    with pytest.raises(ValueError):
+        compute.f_chunked(buf[:8], out=buf[4:], chunk_size=4)
+    with pytest.raises(ValueError):
+        asyncio.run(compute.f_async(buf[:8], out=buf[4:], chunk_size=4))
+    with pytest.raises(ValueError):
+        compute.f_chunked(x, out=[0.0] * 3)
+
+    # Streams of blocks
+    blocks = (x[i:i + 3000] for i in range(0, x.size, 3000))
+    assert np.array_equal( np.concatenate(list(compute.f_stream(blocks))), y )
+
+    # File to file, with reading, computing and writing overlapped
+    x.tofile(str(tmp_path / "in.raw"))
+    report = compute.f_file(tmp_path / "in.raw", tmp_path / "out.raw", chunk_size=7000, num_threads=2)
+    assert np.array_equal( np.fromfile(str(tmp_path / "out.raw")), y )
+    assert report["elements"] == x.size and report["bytes"] == x.nbytes and report["throughput"] > 0
+    compute.f_file(str(tmp_path / "in.raw"), str(tmp_path / "in.raw"), chunk_size=30000)
+    assert np.array_equal( np.fromfile(str(tmp_path / "in.raw")), y )
+    np.arange(10, dtype=np.int16).tofile(str(tmp_path / "int.raw"))
+    assert compute.f_file(tmp_path / "int.raw", tmp_path / "out.raw", dtype=np.int16)["elements"] == 10
+    assert np.fromfile(str(tmp_path / "out.raw"), dtype=np.int16).tolist() == [0, 1, 1, 1, 2, 2, 2, 2, 2, 3]
+
+    (np.arange(100000, dtype=np.int32) - 50000).tofile(str(tmp_path / "int.raw"))
+    (tmp_path / "odd.raw").write_bytes(b"12345")
+    for args, exc in (((tmp_path / "int.raw", tmp_path / "out.raw", np.int32, 1000), ValueError),
+                      ((tmp_path / "odd.raw", tmp_path / "out.raw", np.float64), ValueError),
+                      ((tmp_path / "odd.raw", tmp_path / "out.raw", np.float16), TypeError),
+                      ((tmp_path / "missing.raw", tmp_path / "out.raw"), OSError)):
+        with pytest.raises(exc):
+            compute.f_file(*args)
+    assert not [t for t in threading.enumerate() if t.name.startswith("mylibrary.compute.f_file")]
+
+
+def test_compute_numpy_backend(tmp_path):
+    # The pure NumPy fallback computes the same as the compiled extension
+    import mylibrary._compute_numpy as fallback
+    assert compute.BACKEND == "cython" and fallback.BACKEND == "numpy"
+    assert mylibrary.backend() == "cython"
+
+    for dtype in compute._types:
+        x = (np.arange(3000) * 7919 % 128).astype(dtype)
+        assert np.array_equal( fallback.f(x), compute.f(x) )
+        assert np.array_equal( fallback.f(x.reshape(60, 50).T[::2]), compute.f(x.reshape(60, 50).T[::2]) )
+    x = np.array([0, 1, 2**53 + 1, 2**63 - 1, 2**64 - 1], dtype=np.uint64)
+    assert np.array_equal( fallback.f(x), compute.f(x) )
+    with np.errstate(invalid="ignore"):
+        assert np.array_equal( fallback.sqrt(np.array([-4, 4], np.int8)), compute.sqrt(np.array([-4, 4], np.int8)) )
+    with np.errstate(invalid="raise"):
+        for module in (fallback, compute):
+            with pytest.raises(FloatingPointError):
+                module.sqrt(np.array([-4.0, 4.0], np.float32))
+            assert np.isnan( module.f(np.array([-4.0]))[0] )
+
+    # Threads, blocks, out=, and errors
+    x = np.random.rand(300000)
+    fallback.DEFAULT_CHUNK_SIZE, chunk_size = 10000, fallback.DEFAULT_CHUNK_SIZE
+    try:
+        assert np.array_equal( fallback.f(x, num_threads=4), np.sqrt(x) )
+        assert np.array_equal( fallback.f(x.reshape(600, 500)[:, ::3]), np.sqrt(x.reshape(600, 500)[:, ::3]) )
+    finally:
+        fallback.DEFAULT_CHUNK_SIZE = chunk_size
+    z = x.copy()
+    assert fallback.f(z, out=z) is z
+    assert np.array_equal( z, np.sqrt(x) )
+    outs = fallback.map([x[:10], x[:5].reshape(5, 1)], out=np.empty(15))
+    assert np.array_equal( outs[1].ravel(), np.sqrt(x[:5]) )
+    for bad, exc in ((lambda: fallback.f(np.arange(5) - 1), ValueError),
+                     (lambda: fallback.f(x, out=z[:-1]), ValueError),
+                     (lambda: fallback.f(x, precision="rough"), ValueError),
+                     (lambda: fallback.f(np.array(["a"])), TypeError)):
+        with pytest.raises(exc):
+            bad()
+
+    # Selected with MYLIBRARY_BACKEND, or automatically when the extension is
+    # missing (as with setup-purepython.py)
+    code = "import mylibrary, mylibrary.compute as c; print(mylibrary.backend(), c.f(c.np.arange(5))[-1])"
+    r = fallback.f(memoryview(b"\x00\x01\x04"), like_input=True)
+    assert isinstance(r, memoryview) and r.tolist() == [0, 1, 2]
+    env = dict(os.environ, MYLIBRARY_BACKEND="numpy")
+    assert subprocess.check_output([sys.executable, "-c", code], env=env).split() == [b"numpy", b"2"]
+
+    package = os.path.dirname(mylibrary.__file__)
+    (tmp_path / "mylibrary").mkdir()
+    for name in ("__init__.py", "_version.py", "_static_version.py", "_compute_numpy.py", "_compute_common.py",
+                 "_file_pipeline.py"):
+        with open(os.path.join(package, name), "rb") as src:
+            (tmp_path / "mylibrary" / name).write_bytes(src.read())
+    env = dict(os.environ, PYTHONPATH=str(tmp_path))
+    env.pop("MYLIBRARY_BACKEND", None)
+    assert subprocess.check_output([sys.executable, "-c", code], env=env, cwd=str(tmp_path)).split() == [b"numpy", b"2"]
+    env["MYLIBRARY_BACKEND"] = "cython"
+    assert subprocess.call([sys.executable, "-c", code], env=env, cwd=str(tmp_path), stderr=subprocess.DEVNULL) != 0
+
+
+def test_lazy_import():
+    # import mylibrary loads neither the submodules nor NumPy
+    code = ("import sys, mylibrary; print('numpy' in sys.modules, "
+            "any(m.startswith('mylibrary.') for m in sys.modules))")
+    assert subprocess.check_output([sys.executable, "-c", code]).split() == [b"False", b"False"]
+
+    # The submodules are loaded on first access, and dostuff does without NumPy
+    code = "import sys, mylibrary; print('mylibrary.compute' in sys.modules, mylibrary.subpackage.__name__, 'compute' in dir(mylibrary))"
+    assert subprocess.check_output([sys.executable, "-c", code]).split() == [b"False", b"mylibrary.subpackage", b"True"]
+    code = "import sys, mylibrary.dostuff; print('numpy' in sys.modules, 'mylibrary.compute' in sys.modules)"
+    assert subprocess.check_output([sys.executable, "-c", code]).split() == [b"False", b"False"]
+    code = "import sys, mylibrary; mylibrary.dostuff; print('numpy' in sys.modules, mylibrary.compute.f([4.0])[0])"
+    assert subprocess.check_output([sys.executable, "-c", code]).split() == [b"False", b"2.0"]
+
+
+def test_free_threading(tmp_path):
+    # On free-threaded Python, importing the extension modules must not enable the GIL
+    import sysconfig
+    if sysconfig.get_config_var("Py_GIL_DISABLED"):
+        assert not sys._is_gil_enabled()
+
+    # Many threads calling into all modules at once, while the SIMD kernel is
+    # switched and the counters are on; the results must be as computed alone
+    nthreads, rounds = 8, 20
+    x = np.random.rand(50000)
+    y = np.sqrt(x)
+    lines = ["thread {} line {}".format(t, i) for t in range(nthreads) for i in range(1000)]
+    path = str(tmp_path / "lines.txt")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    start = threading.Barrier(nthreads + 2)  # workers, switcher and this thread
+    done = threading.Event()
+    failures = []
+
+    def worker(t):
+        try:
+            start.wait()
+            e = expr.sqrt(expr.var("a") * 4)
+            for _ in range(rounds):
+                assert np.array_equal( compute.f(x, num_threads=1), y )
+                assert compute.f(x - 0.5, errors="nan_count")[1] == np.count_nonzero(x < 0.5)
+                assert np.array_equal( compute.map([x, x[:100]])[1], y[:100] )
+                assert np.array_equal( e.evaluate(a=x), 2 * y )
+            dostuff.hello_many(lines[t * 1000:(t + 1) * 1000], fd=fd, flush_size=512)
+        except BaseException as exc:
+            failures.append(exc)
+
+    def switcher():
+        start.wait()
+        while not done.is_set():
+            for kernel in compute.supported_simd_kernels():
+                compute.set_simd_kernel(kernel)
+
+    previous = mylibrary.enable_stats(True)
+    kernel = compute.get_simd_kernel()
+    mylibrary.reset_stats()
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(nthreads)]
+    threads.append(threading.Thread(target=switcher))
+    try:
+        for thread in threads:
+            thread.start()
+        start.wait()
+        for thread in threads[:-1]:
+            thread.join()
+    finally:
+        done.set()
+        threads[-1].join()
+        os.close(fd)
+        compute.set_simd_kernel(kernel)
+        counters = mylibrary.stats(reset=True)
+        mylibrary.enable_stats(previous)
+    if failures:
+        raise failures[0]
+
+    assert counters["compute.f"]["calls"] == nthreads * rounds * 2
+    assert counters["compute.map"]["calls"] == nthreads * rounds
+    assert counters["dostuff.hello_many"]["elements"] == len(lines)
+    with open(path) as f:
+        assert sorted(f.read().splitlines()) == sorted(lines)
+
+
 if __name__ == '__main__':
-    test()
+    sys.exit(pytest.main([__file__]))
@@ -9,7 +9,7 @@ Note: This is essentially a stripped down version of the setup.py template
 in the top level directory, adapted to facilitate the build_ext --inplace
 required to build the cython module being tested.
 
-Supports Python 2.7 and 3.4.
+Supports Python 3.8 and higher.
 
 Usage:
     python setup.py build_ext --inplace
@@ -28,8 +28,8 @@ from setuptools           import setup
 from setuptools           import Command
 from setuptools.extension import Extension
 
-if sys.version_info < (2,7):
-    sys.exit('Sorry, Python < 2.7 is not supported')
+if sys.version_info < (3,8):
+    sys.exit('Sorry, Python < 3.8 is not supported')
 
 
 #-------------------------------------------------------------------------------